@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+#
+# Cpppo_positioner -- Actuator position control
+#
+# Copyright (c) 2014, Hard Consulting Corporation.
+#
+# Cpppo_positioner is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.  See the COPYING file at the top of the source tree.
+#
+# Cpppo_positioner is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+
+#
+# cpppo_positioner.benchmark
+#
+#     Measure the latency of each positioning operation and handshake phase, driving a local
+# simulator over a pair of (virtual) serial ports, at each combination of baud rate, poll rate and
+# number of actuators.  Eg. using the ttyV0 <-> ttyV1 virtual serial ports from ttyV-setup.py:
+#
+#     python3 ttyV-setup.py 2 &
+#     python -m cpppo_positioner.benchmark --address ttyV0 --simulator ttyV1 \
+#         --baudrate 38400,115200 --rate .5,.1 --actuators 1,4 --output benchmark.json
+#
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry@hardconsulting.com"
+__copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
+__license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+import cpppo
+import tabulate
+
+if __name__ == "__main__" and __package__ is None:
+    # Ensure that importing works (whether cpppo_positioner installed or not) with:
+    #   python -m cpppo_positioner.benchmark ...
+    #   ./cpppo_positioner/benchmark.py ...
+    #   ./benchmark.py ...
+    __package__			= "cpppo_positioner"
+
+try:
+    from . import smc, simulator
+except ImportError:
+    try:
+        from cpppo_positioner import smc, simulator
+    except ImportError:
+        sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))))
+        from cpppo_positioner import smc, simulator
+
+
+# The timed gateway operations, and the positioning handshake phases (see smc.POLL_RATES):
+# SVON-->SVRE, SETUP-->SETON, step data write, D9100 operation start acknowledgement, BUSY clear.
+OPERATIONS			= ( 'status', 'outputs', 'alarm', 'position', 'complete' )
+PHASES				= ( 'svon', 'seton', 'data', 'start', 'busy' )
+
+
+def distribution( samples ):
+    """Summarize latency samples (in seconds): the count, min, mean, 50th/90th/99th percentiles and max.
+    Without samples, all but the count are None."""
+    ordered			= sorted( samples )
+    if not ordered:
+        return dict( count=0, min=None, mean=None, p50=None, p90=None, p99=None, max=None )
+
+    def percentile( p ):
+        return ordered[min( len( ordered ) - 1, int( p * len( ordered )))]
+
+    return dict(
+        count		= len( ordered ),
+        min		= ordered[0],
+        mean		= sum( ordered ) / len( ordered ),
+        p50		= percentile( .50 ),
+        p90		= percentile( .90 ),
+        p99		= percentile( .99 ),
+        max		= ordered[-1],
+    )
+
+
+def benchmark( address, port, baudrate=smc.PORT_BAUDRATE, rate=smc.POLL_RATE, actuators=1, repeat=10,
+               period=.01, timeout=smc.smc_modbus.TIMEOUT ):
+    """Run each gateway operation 'repeat' times on each of the simulated actuators (units 1 through
+    'actuators') on serial 'port', via an smc_modbus gateway on serial 'address'.  The simulator
+    responds to each handshake within 'period' seconds.  Returns the {name: [seconds, ...]} latency
+    samples of each operation and positioning phase.
+
+    """
+    samples			= dict( (name,[]) for name in OPERATIONS + PHASES )
+
+    def phased( unit, phase, seconds ):
+        if phase in samples:
+            samples[phase].append( seconds )
+
+    def timed( name, operation, *args, **kwds ):
+        begin			= cpppo.timer()
+        result			= operation( *args, **kwds )
+        samples[name].append( cpppo.timer() - begin )
+        return result
+
+    units			= list( range( 1, actuators + 1 ))
+    running			= simulator.actuator_simulator( port, units, period=period, baudrate=baudrate )
+    next( running )
+    try:
+        gateway			= smc.smc_modbus( address=address, baudrate=baudrate, rate=rate, phased=phased )
+        try:
+            for i in range( repeat ):
+                for a in units:
+                    timed( 'status', gateway.status, actuator=a )
+                    timed( 'outputs', gateway.outputs, "IN0" if i % 2 else "in0", actuator=a )
+                    timed( 'alarm', gateway.alarm, actuator=a )
+                    timed( 'position', gateway.position, actuator=a, position=1000 * ( i % 2 ),
+                           home=( i == 0 ), timeout=timeout )
+                for a in units:
+                    timed( 'complete', gateway.complete, actuator=a, timeout=timeout )
+        finally:
+            gateway.close()
+    finally:
+        next( running, None ) # Shuts down the simulator
+    return samples
+
+
+def main( argv=None ):
+    """Benchmark every combination of the specified baud rates, poll rates and numbers of actuators,
+    printing the latency distributions and optionally writing them to a JSON --output file.
+
+    """
+    ap				= argparse.ArgumentParser(
+        description = "Benchmark SMC actuator positioning latencies against a local simulator.",
+        epilog = "" )
+
+    ap.add_argument( '-v', '--verbose', default=0, action="count",
+                     help="Display logging information." )
+    ap.add_argument( '-a', '--address', default=smc.PORT_MASTER,
+                     help="Serial port of the gateway (default: %s)" % ( smc.PORT_MASTER ))
+    ap.add_argument( '-s', '--simulator', required=True,
+                     help="Serial port of the simulated actuators, connected to --address" )
+    ap.add_argument( '-b', '--baudrate', default=str( smc.PORT_BAUDRATE ),
+                     help="Baud rate(s), comma-separated (default: %s)" % ( smc.PORT_BAUDRATE ))
+    ap.add_argument( '-r', '--rate', default=str( smc.POLL_RATE ),
+                     help="Poll rate(s) in seconds, comma-separated (default: %s)" % ( smc.POLL_RATE ))
+    ap.add_argument( '-n', '--actuators', default="1",
+                     help="Number(s) of actuators, comma-separated (default: 1)" )
+    ap.add_argument( '-i', '--repeat', default=10, type=int,
+                     help="Iterations of each operation on each actuator (default: 10)" )
+    ap.add_argument( '-p', '--period', default=.01, type=float,
+                     help="Simulator response period in seconds (default: .01)" )
+    ap.add_argument( '-o', '--output',
+                     help="JSON results file, if desired" )
+
+    args			= ap.parse_args( argv )
+
+    cpppo.log_cfg['level']	= { 0: logging.WARNING, 1: logging.NORMAL, 2: logging.DETAIL,
+                                    3: logging.INFO }.get( args.verbose, logging.DEBUG )
+    logging.basicConfig( **cpppo.log_cfg )
+
+    results			= []
+    for baudrate,rate,actuators in itertools.product(
+            map( int, args.baudrate.split( ',' )), map( float, args.rate.split( ',' )),
+            map( int, args.actuators.split( ',' ))):
+        logging.normal( "Benchmark: %d baud, %.3fs poll rate, %d actuators", baudrate, rate, actuators )
+        samples			= benchmark( args.address, args.simulator, baudrate=baudrate, rate=rate,
+                                             actuators=actuators, repeat=args.repeat, period=args.period )
+        for name in OPERATIONS + PHASES:
+            results.append( dict(
+                baudrate	= baudrate,
+                rate		= rate,
+                actuators	= actuators,
+                kind		= 'operation' if name in OPERATIONS else 'phase',
+                name		= name,
+                **distribution( samples[name] ) ))
+
+    print( tabulate.tabulate(
+        [ [ r[k] for k in ( 'baudrate', 'rate', 'actuators', 'name', 'count', 'min', 'mean', 'p50', 'p90', 'p99', 'max' ) ]
+          for r in results ],
+        headers=[ "Baud", "Rate", "Actuators", "Latency", "Count", "Min", "Mean", "50%", "90%", "99%", "Max" ],
+        floatfmt=".4f", tablefmt='orgtbl' ))
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( dict(
+                time		= time.time(),
+                repeat		= args.repeat,
+                period		= args.period,
+                results		= results,
+            ), f, indent=4 )
+        logging.normal( "Benchmark: results written to %s", args.output )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -37,12 +37,18 @@ USAGE
 __all__				= ['main']
 
 import argparse
+import asyncio
+import contextlib
 import itertools
 import json
 import logging
 import os
+import select
 import signal
+import socketserver
+import stat
 import sys
+import threading
 import time
 import traceback
 
@@ -52,6 +58,12 @@ import cpppo
 # serial port like /dev/ttyS0 or /dev/tty.usbserial-B0019I24.
 address				= '/dev/ttyS1'
 
+# Failed commands are retried after an exponential backoff delay, bounded by these.  Up to --recover
+# consecutive failures are recovered in place (gateway.recover( <actuator>, ... ), if supported),
+# before the gateway is closed and reconnected.
+backoff_min			= 0.1
+backoff_max			= 5.0
+
 
 # Signal Handling
 
@@ -148,6 +160,301 @@ def signal_service():
                      int( uptime // 3600 ), int( uptime % 3600 // 60 ), uptime % 60 )
 
 
+def describe( dat ):
+    """Describe the actuator(s) targeted by a command: a position dict, a list of them, or a flag list
+    (optionally prefixed by a numeric actuator)."""
+    if isinstance( dat, dict ) and ( 'sequence' in dat or 'sync' in dat ):
+        return ','.join( str( a ) for a in actuators( dat ))
+    if isinstance( dat, dict ):
+        return dat.get( 'actuator', 'N/A' )
+    if dat and all( isinstance( d, dict ) for d in dat ):
+        return ','.join( str( describe( d )) for d in dat )
+    return dat[0]
+
+
+def actuators( dat ):
+    """The actuator numbers targeted by a command (see describe)."""
+    if isinstance( dat, dict ) and 'sequence' in dat:
+        return sorted( set( m.get( 'actuator', dat.get( 'actuator', 1 ))
+                            for m in dat['sequence'] if isinstance( m, dict )))
+    if isinstance( dat, dict ) and 'sync' in dat:
+        return actuators( dat['sync'] )
+    if isinstance( dat, dict ):
+        return [ dat.get( 'actuator', 1 ) ]
+    if dat and all( isinstance( d, dict ) for d in dat ):
+        return sum( ( actuators( d ) for d in dat ), [] )
+    return [ dat[0] if isinstance( dat[0], int ) else 1 ]
+
+
+def parse( inp ):
+    """Parse a line of input into a command: a numeric delay, a position dict (or list of them), a motion
+    sequence, a synchronized start or a flag list.  Returns None if blank or a comment; raises a ValueError if invalid.
+
+    """
+    # Ignore whitespace and comments
+    inp				= inp.strip()
+    if not inp or inp.startswith( '#' ):
+        return None
+    # A non-empty non-comment input in 'inp'; parse it as JSON into 'dat'; allow numeric and dict
+    try:
+        dat			= json.loads( inp )
+    except Exception as exc:
+        raise ValueError( "Invalid position data: %s; %s" % ( inp, exc ))
+    if isinstance( dat, cpppo.natural.num_types ):
+        pass
+    elif isinstance( dat, dict ) and isinstance( dat.get( 'sequence' ), list ):
+        # A motion sequence of position dicts and numeric dwells, with default position parameters;
+        # each move's step data is staged while the prior move is in motion:
+        # { "sequence": [ { "position": <position>, ... }, <dwell>, ... ], "actuator": <actuator>, ... }
+        logging.normal( "Sequence: actuator %3s parsed ; params: %r", describe( dat ), dat )
+    elif isinstance( dat, dict ) and isinstance( dat.get( 'sync' ), list ) and dat['sync'] \
+         and all( isinstance( d, dict ) for d in dat['sync'] ):
+        # A list of position dicts for distinct actuators, staged and then started together (by one
+        # broadcast frame, if "broadcast" is true; see smc_modbus.position_sync):
+        # { "sync": [ { "actuator": <actuator>, ... }, ... ], "broadcast": <bool>, ... }
+        logging.normal( "Sync    : actuator %3s parsed ; params: %r", describe( dat ), dat )
+    elif isinstance( dat, dict ):
+        # A position dict in 'dat'; attempt to position to it.  We'll wait forever to establish a
+        # connection to the gateway, and then attempt each positioning command until it succeeds.
+        logging.normal( "Position: actuator %3s parsed ; params: %r", dat.get( 'actuator', 'N/A' ), dat )
+    elif isinstance( dat, list ) and dat and all( isinstance( d, dict ) for d in dat ):
+        # A list of position dicts, for distinct actuators; position them all concurrently:
+        # [ { "actuator": <actuator>, ... }, { "actuator": <actuator>, ... } ]
+        logging.normal( "Position: actuator %3s parsed ; params: %r", describe( dat ), dat )
+    elif isinstance( dat, list ) and dat:
+        # A list of flags to SET/clear, optionally prefixed by a numeric actuator number:
+        # An [ <actuator>, "FLAG", "flag", ... ]
+        logging.normal( "Outputs : actuator %3s parsed ; params: %r", dat[0], dat[1:] )
+    else:
+        raise ValueError( "Unknown command: %s: %r" % ( type( dat ), dat ))
+    return dat
+
+
+class positioner( object ):
+    """Owns a Gateway, (re)connecting it as required, and executes commands on it; each command is
+    attempted until it succeeds (or shutdown is signalled), recovering or reconnecting the Gateway
+    after failures.  Commands may be executed concurrently (eg. by several --serve clients); the
+    commands on each actuator are executed one at a time.  Once the Gateway is .shared (eg. while
+    serving), a failing command only ever recovers its own actuators; it never disconnects the
+    Gateway, which would abort every other client's commands.
+
+    """
+    def __init__( self, gateway_class, address, timeout=None, recover=3, **config ):
+        self.gateway_class	= gateway_class
+        self.address		= address
+        self.timeout		= timeout
+        self.recover		= recover
+        self.config		= config
+        self.gateway		= None # None --> never, False --> failed, truthy --> connected
+        self.lock		= threading.Lock()
+        self.actuators		= {}		# {actuator: threading.Lock, ...}
+        self.shared		= False		# True --> never disconnect the Gateway on failures
+
+    def connect( self ):
+        """Return the connected Gateway, connecting if necessary; False if the connection failed."""
+        with self.lock:
+            if not self.gateway:
+                try:
+                    # A pymodbus client requires an event loop in the Thread creating it (eg. a client's)
+                    try:
+                        asyncio.get_event_loop()
+                    except RuntimeError:
+                        asyncio.set_event_loop( asyncio.new_event_loop() )
+                    self.gateway = self.gateway_class( address=self.address, timeout=self.timeout, **self.config )
+                    logging.normal( "Gateway:  %s connected", self.address )
+                except Exception as exc:
+                    logging.warning("Gateway:  %s connection failed: %s; %s", self.address,
+                                    exc, traceback.format_exc() if self.gateway is None else "" )
+                    self.gateway = False
+            return self.gateway
+
+    def disconnect( self, gateway ):
+        """Discard the failed Gateway, unless it has already been replaced."""
+        with self.lock:
+            if self.gateway is gateway:
+                gateway.close()
+                self.gateway	= None
+
+    def close( self ):
+        with self.lock:
+            if self.gateway:
+                self.gateway.close()
+            self.gateway	= None
+
+    @contextlib.contextmanager
+    def exclusive( self, dat ):
+        """Execute commands on each of the actuators targeted by 'dat' one at a time."""
+        with self.lock:
+            locks		= [ self.actuators.setdefault( a, threading.Lock() )
+                                    for a in sorted( set( actuators( dat ))) ]
+        with contextlib.ExitStack() as stack:
+            for l in locks:
+                stack.enter_context( l )
+            yield
+
+    def execute( self, dat, retries=None, abandoned=None ):
+        """Execute the parsed command on the Gateway, returning its status once it succeeds.  Raises an
+        exception if shutdown is signalled first, after 'retries' failed attempts (if not None), or
+        once 'abandoned()' returns True (eg. its client has disconnected)."""
+        backoff			= 0
+        recovered		= 0
+        failures		= 0
+        with self.exclusive( dat ):
+            while not shutdown_signalled:
+                if abandoned and abandoned():
+                    raise RuntimeError( "Abandoned before command completed" )
+                if backoff:
+                    time.sleep( backoff ) # avoid tight loop on failures
+                gateway		= self.connect()
+                if not gateway:
+                    failures   += 1
+                    if retries is not None and failures > retries:
+                        raise RuntimeError( "Gateway connection failed; %d attempts" % ( failures ))
+                    backoff	= min( max( backoff * 2, backoff_min ), backoff_max )
+                    continue
+                if logging.getLogger().isEnabledFor( logging.NORMAL ):
+                    logging.normal( "%r", gateway )
+
+                # Have a gateway; issue the set/position command, recovering (or discarding) the Gateway
+                # on failure and looping; otherwise, return after success.  A positioning command with no
+                # position data (eg. only actuator and/or timeout) should just confirm that the previous
+                # positioning operation is complete.
+                try:
+                    if isinstance( dat, dict ) and 'sequence' in dat:
+                        status	= gateway.sequence( *dat['sequence'],
+                                                    **dict( (k,v) for k,v in dat.items() if k != 'sequence' ))
+                    elif isinstance( dat, dict ) and 'sync' in dat:
+                        status	= gateway.position_sync( *dat['sync'],
+                                                         **dict( (k,v) for k,v in dat.items() if k != 'sync' ))
+                    elif isinstance( dat, list ) and isinstance( dat[0], dict ):
+                        status	= gateway.position_many( *dat )
+                    elif isinstance( dat, list ):
+                        if isinstance( dat[0], int ):
+                            status = gateway.outputs( *dat[1:], actuator=dat[0] )
+                        else:
+                            status = gateway.outputs( *dat )  # All are flags; default actuator
+                    else:
+                        status	= gateway.position( **dat )
+                    logging.normal(  "Success : actuator %3s status: %r\n%r",
+                                     describe( dat ), status, gateway )
+                    return status
+                except Exception as exc:
+                    logging.warning( "Failure : actuator %3s raised : %s\n%r\n%s\n%r",
+                                     describe( dat ), exc, dat, traceback.format_exc(), gateway )
+                failures       += 1
+                if retries is not None and failures > retries:
+                    raise RuntimeError( "Command failed; %d attempts" % ( failures ))
+                backoff		= min( max( backoff * 2, backoff_min ), backoff_max )
+                if ( self.shared or recovered < self.recover ) and hasattr( gateway, 'recover' ):
+                    recovered  += 1
+                    try:
+                        gateway.recover( *actuators( dat ))
+                        logging.normal( "Recover : actuator %3s recovery %d/%d; retrying in %7.3fs",
+                                        describe( dat ), recovered, self.recover, backoff )
+                        continue
+                    except Exception as exc:
+                        logging.warning( "Recover : actuator %3s recovery failed: %s", describe( dat ), exc )
+                if self.shared:
+                    continue # Other clients' commands may be using the Gateway; never disconnect it
+                recovered	= 0
+                self.disconnect( gateway )
+        raise RuntimeError( "Shutdown before command completed" )
+
+
+class command_handler( socketserver.StreamRequestHandler ):
+    """Executes each line of commands (as accepted on the command-line) received from a --serve client,
+    replying to each non-blank, non-comment line with a line of JSON:
+
+        {"command": <command>, "status": <status>}	-- success; the actuator(s) status
+        {"command": <command>, "error": "<reason>"}	-- failure, or shutdown before completion
+        {"error": "<reason>"}				-- invalid command
+        {"delay": <seconds>}				-- delay completed
+
+    A command is abandoned after the server's .retries failed attempts, or as soon as its client
+    closes the connection (merely shutting down the client's sending side is fine).
+
+    """
+    def handle( self ):
+        logging.normal( "Client:   %s connected", self.client_address or "(local)" )
+        for line in self.rfile:
+            try:
+                dat		= parse( line.decode( 'utf-8', 'replace' ))
+            except ValueError as exc:
+                logging.warning( "%s", exc )
+                self.reply( error=str( exc ))
+                continue
+            if dat is None:
+                continue
+            if isinstance( dat, cpppo.natural.num_types ):
+                time.sleep( dat )
+                self.reply( delay=dat )
+                continue
+            self.server.tally( 'count' )
+            try:
+                status		= self.server.service.execute( dat, retries=self.server.retries,
+                                                               abandoned=self.disconnected )
+                self.server.tally( 'success' )
+                self.reply( command=dat, status=status )
+            except Exception as exc:
+                logging.warning( "Failure : actuator %3s abandoned: %s", describe( dat ), exc )
+                self.reply( command=dat, error=str( exc ))
+        logging.normal( "Client:   %s disconnected", self.client_address or "(local)" )
+
+    def disconnected( self ):
+        """Detect if the client has closed (or reset) its connection; a hang-up or error is reported by
+        poll regardless of the events registered."""
+        detector		= select.poll()
+        detector.register( self.connection, 0 )
+        return bool( detector.poll( 0 ))
+
+    def reply( self, **kwds ):
+        try:
+            self.wfile.write( ( json.dumps( kwds, default=str ) + "\n" ).encode( 'utf-8' ))
+        except OSError as exc:
+            logging.warning( "Client:   %s reply failed: %s", self.client_address or "(local)", exc )
+
+
+def serve( service, address, retries=None ):
+    """Return a server (not yet serving) executing commands from any number of concurrent clients on
+    the positioner 'service', via a Unix domain socket at 'address' (a path), or via TCP if 'address'
+    is [<host>]:<port> (default host: localhost).  Call .serve_forever, then .shutdown and
+    .server_close; the .count of commands received and their .success are tallied.  Each command is
+    abandoned after 'retries' failed attempts (if not None), and the service's Gateway is thereafter
+    .shared by all clients.
+
+    """
+    host,_,port			= address.rpartition( ':' )
+    if port.isdigit() and '/' not in address:
+        class server( socketserver.ThreadingTCPServer ):
+            allow_reuse_address	= True
+        bind			= ( host or 'localhost', int( port ))
+    else:
+        class server( socketserver.ThreadingUnixStreamServer ):
+            def server_close( self ):
+                super( server, self ).server_close()
+                if os.path.exists( self.server_address ):
+                    os.unlink( self.server_address )
+        if os.path.exists( address ):
+            assert stat.S_ISSOCK( os.stat( address ).st_mode ), \
+                "Cannot serve on %s; not a socket" % ( address )
+            os.unlink( address ) # A stale socket, eg. from a prior server
+        bind			= address
+    srv				= server( bind, command_handler )
+    srv.daemon_threads		= True
+    srv.service			= service
+    srv.service.shared		= True
+    srv.retries			= retries
+    srv.count			= 0
+    srv.success			= 0
+    srv.counting		= threading.Lock()
+
+    def tally( counter ):
+        with srv.counting:
+            setattr( srv, counter, getattr( srv, counter ) + 1 )
+    srv.tally			= tally
+    return srv
+
+
 # 
 # main		-- Run the EtherNet/IP actuator positioner
 # 
@@ -157,7 +464,8 @@ def main( argv=None, idle_service=None, **kwds ):
     defined.
 
     Takes a sequence of blocks of actuator position information (in JSON format), either from the
-    command-line, or (if '-' provided) from stdin.
+    command-line, or (if '-' provided) from stdin.  Then, if --serve'ing, keeps the Gateway open and
+    executes the same commands from any number of clients (see command_handler), 'til shutdown.
 
     """
     ap				= argparse.ArgumentParser(
@@ -165,7 +473,7 @@ def main( argv=None, idle_service=None, **kwds ):
         epilog = "" )
 
     ap.add_argument( '-g', '--gateway', default='smc.smc_modbus',
-                     help="Gateway module.class for positioning actuator (default: smc.smc_modbus)" )
+                     help="Gateway module.class for positioning actuator (default: smc.smc_modbus; smc.smc_multi for several serial ports)" )
     ap.add_argument( '-c', '--config', default=None,
                      help="Gateway module.class configuration JSON (default: None)" )
     ap.add_argument( '-v', '--verbose', default=0, action="count",
@@ -174,13 +482,26 @@ def main( argv=None, idle_service=None, **kwds ):
                      help="Address of actuator gateway to connect to (default: %s)" % ( address ))
     ap.add_argument( '-l', '--log',
                      help="Log file, if desired" )
-    ap.add_argument( '-t', '--timeout', default=5,
-                     help="Gateway I/O timeout" )
-
-    ap.add_argument( 'position', nargs="+",
-                     help="Any JSON position dictionaries, or numeric delays (in seconds)")
+    ap.add_argument( '-t', '--timeout', default=None, type=float,
+                     help="Gateway I/O timeout (default: derived from the serial port's baud rate, etc.)" )
+    ap.add_argument( '-r', '--recover', default=3, type=int,
+                     help="Consecutive failures to recover without reconnecting the Gateway (default: 3)" )
+    ap.add_argument( '--retries', default=10, type=int,
+                     help="Failed attempts at each --serve'd client command before abandoning it (default: 10)" )
+    ap.add_argument( '--record', default=None,
+                     help="Record the actuators' polled motion to this file (see recorder.py)" )
+    ap.add_argument( '--publish', default=None, nargs='?', const='',
+                     help="Publish the actuators' status for other processes to this (or the default) shared-memory file (see publisher.py)" )
+
+    ap.add_argument( '-s', '--serve', default=None,
+                     help="Then, serve commands from clients 'til shutdown, on this Unix domain socket path or TCP [<host>]:<port>" )
+
+    ap.add_argument( 'position', nargs="*",
+                     help="Any JSON position dictionaries (or lists of them, to position concurrently), motion sequences, flag lists, or numeric delays (in seconds)")
 
     args			= ap.parse_args( argv )
+    if not args.position and not args.serve:
+        ap.error( "Supply positions (or '-' for stdin), and/or --serve" )
 
     # Set up logging level (-v...) and --log <file>
     cpppo.log_cfg['level']	= ( logging_levelmap[args.verbose] 
@@ -228,6 +549,21 @@ def main( argv=None, idle_service=None, **kwds ):
             logging.warning( "Invalid Gateway config: %s; %s", args.config, exc )
             raise
 
+    # Record the actuators' motion, across any reconnections of the Gateway
+    recording			= None
+    if args.record:
+        __import__( 'recorder', globals(), locals(), [], 0 )
+        recording		= sys.modules['recorder'].recorder( path=args.record )
+        gateway_config['recorder'] = recording
+
+    # Publish the actuators' status for other local processes, across any reconnections of the Gateway
+    publishing			= None
+    if args.publish is not None:
+        __import__( 'publisher', globals(), locals(), [], 0 )
+        publisher		= sys.modules['publisher']
+        publishing		= publisher.publisher( path=args.publish or publisher.PUBLISH_PATH )
+        gateway_config['publisher'] = publishing
+
     # Read and process JSON position and delay inputs; '-' means read from sys.stdin 'til EOF.  Can be mixed, eg:
     # 
     #     '{ <initial position> }' '# a comment, followed by a delay' 1.5 - '{ <final position> }'
@@ -239,84 +575,56 @@ def main( argv=None, idle_service=None, **kwds ):
     else:
         positer			= iter( args.position )
 
+    service			= positioner( gateway_class, address=args.address, timeout=args.timeout,
+                                              recover=args.recover, **gateway_config )
     start			= cpppo.timer()
     count,success		= 0,0
-    gateway			= None # None --> never, False --> failed, truthy --> connected
-    while not shutdown_signalled:
+    for pos in positer:
         # Perform all idle_services, and get next position, terminate loop when done
-        map( lambda f: f(), idle_service )
-        try:
-            pos			= next( positer )
-        except StopIteration:
+        for f in idle_service:
+            f()
+        if shutdown_signalled:
             break
-
-        # Ignore whitespace and comments
-        inp			= pos.strip()
-        if inp.startswith( '#' ):
-            inp			= ''
-        if not inp:
-            continue
-        # A non-empty non-comment input in 'inp'; parse it as JSON into 'dat'; allow numeric and dict
-
-        if gateway and logging.getLogger().isEnabledFor( logging.NORMAL ):
-            logging.normal( "%r", gateway )
-
         try:
-            dat			= json.loads( inp )
-        except Exception as exc:
-            logging.warning( "Invalid position data: %s; %s", inp, exc )
+            dat			= parse( pos )
+        except ValueError as exc:
+            logging.warning( "%s", exc )
+            continue
+        if dat is None:
             continue
         if isinstance( dat, cpppo.natural.num_types ):
             logging.normal( "Delaying: %7.3fs", dat )
             time.sleep( dat )
             continue
-        elif isinstance( dat, dict ):
-            # A position dict in 'dat'; attempt to position to it.  We'll wait forever to establish a
-            # connection to the gateway, and then attempt each positioning command until it succeeds.
-            logging.normal( "Position: actuator %3s parsed ; params: %r", dat.get( 'actuator', 'N/A' ), dat )
-        elif isinstance( dat, list ) and dat:
-            # A list of flags to SET/clear, optionally prefixed by a numeric actuator number:
-            # An [ <actuator>, "FLAG", "flag", ... ]
-            logging.normal( "Outputs : actuator %3s parsed ; params: %r", dat[0], dat[1:] )
-        else:
-            logging.warning( "Unknown command: %s: %r", type( dat ), dat )
-            continue
-
         count		       += 1
-        while success < count:
-            if not gateway:
-                try:
-                    gateway	= gateway_class( address=args.address, timeout=args.timeout, **gateway_config )
-                    logging.normal( "Gateway:  %s connected", args.address )
-                except Exception as exc:
-                    logging.warning("Gateway:  %s connection failed: %s; %s", args.address,
-                                    exc, traceback.format_exc() if gateway is None else "" )
-                    gateway	= False
-                    time.sleep( 1 ) # avoid tight loop on connection failures
-                    continue
-
-            # Have a gateway; issue the set/position command, discarding the Gateway on failure and
-            # looping; otherwise, fall thru after success (gateway is Truthy) and get next command.
-            # A positioning command with no position data (eg. only actuator and/or timeout) should
-            # just confirm that the previous positioning operation is complete.
-            try:
-                if isinstance( dat, list ):
-                    if isinstance( dat[0], int ):
-                        status	= gateway.outputs( *dat[1:], actuator=dat[0] )
-                    else:
-                        status	= gateway.outputs( *dat )  # All are flags; default actuator
-                else:
-                    status	= gateway.position( **dat )
-                success	       += 1
-                logging.normal(  "Success : actuator %3s status: %r\n%r", 
-                                 dat[0] if isinstance( dat, list ) else dat.get( 'actuator', 'N/A' ),
-                                 status, gateway )
-            except Exception as exc:
-                logging.warning( "Failure : actuator %3s raised : %s\n%r\n%s\n%r",
-                                 dat[0] if isinstance( dat, list ) else dat.get( 'actuator', 'N/A' ),
-                                 exc, dat, traceback.format_exc(), gateway )
-                gateway.close()
-                gateway		= None
+        try:
+            service.execute( dat )
+            success	       += 1
+        except Exception as exc:
+            logging.warning( "Failure : actuator %3s abandoned: %s", describe( dat ), exc )
+            break
 
+    # Any --serve'd clients' commands after those given on the command-line, 'til shutdown
+    if args.serve:
+        server			= serve( service, args.serve, retries=args.retries )
+        logging.normal( "Serving:  %s", args.serve )
+        threading.Thread( target=server.serve_forever, name="Serving: %s" % ( args.serve ), daemon=True ).start()
+        try:
+            while not shutdown_signalled:
+                for f in idle_service:
+                    f()
+                time.sleep( .1 )
+        except KeyboardInterrupt:
+            logging.normal( "Serving:  %s interrupted", args.serve )
+        server.shutdown()
+        server.server_close()
+        count		       += server.count
+        success		       += server.success
+
+    service.close()
+    if recording:
+        recording.close()
+    if publishing:
+        publishing.close()
     logging.normal( "Completed %d/%d actuator commands in %7.3fs", success, count, cpppo.timer() - start )
     return 0 if success == count else 1
@@ -0,0 +1,201 @@
+#
+# Cpppo_positioner -- Actuator position control
+#
+# Copyright (c) 2014, Hard Consulting Corporation.
+#
+# Cpppo_positioner is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.  See the COPYING file at the top of the source tree.
+#
+# Cpppo_positioner is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+
+#
+# cpppo_positioner.protocol_rs485
+#
+#     A pyserial URL handler for in-process virtual RS-485 buses, eg. rs485://<bus>/<name>[?pace].
+# Every port opened on the same <bus> is an endpoint on a multi-drop network: the bytes written to
+# one are received by all the others (like the ttyV-setup.py relay, but without any pseudo-TTYs).
+# Once smc.py has registered this package in serial.protocol_handler_packages, such a URL may be
+# used wherever a serial port name is, eg. by the smc_modbus gateway and the actuator simulator:
+#
+#     simulator.actuator_simulator( "rs485://test/1", [1, 2] )
+#     gateway = smc.smc_modbus( address="rs485://test/0" )
+#
+#     Each endpoint receives on one of a connected pair of sockets, so its fileno() may be used by
+# asyncio for both reading and writing.
+# By default, bytes are delivered immediately; with '?pace', each write is delayed for the time it
+# would take to transmit at the port's baud rate and framing.
+#
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry@hardconsulting.com"
+__copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
+__license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
+
+import fcntl
+import logging
+import select
+import socket
+import struct
+import termios
+import threading
+import time
+
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError, Timeout, to_bytes
+
+buses				= {}		# {bus: [endpoint, ...], ...}
+buses_lock			= threading.Lock()
+
+
+class Serial( SerialBase ):
+    """An endpoint on an in-process virtual RS-485 bus."""
+
+    def __init__( self, *args, **kwds ):
+        self.bus		= None
+        self.pace		= False
+        self.receiver		= None		# The (read, write) connected socket pair
+        super( Serial, self ).__init__( *args, **kwds )
+
+    def open( self ):
+        if self.is_open:
+            raise SerialException( "Port is already open." )
+        if self._port is None:
+            raise SerialException( "Port must be configured before it can be used." )
+        self.from_url( self.port )
+        self.receiver		= socket.socketpair()
+        for s in self.receiver:
+            s.setblocking( False )
+        with buses_lock:
+            buses.setdefault( self.bus, [] ).append( self )
+        self._reconfigure_port()
+        self.is_open		= True
+        logging.info( "%s: opened on bus %r%s", self.port, self.bus, " (paced)" if self.pace else "" )
+
+    def close( self ):
+        if self.receiver:
+            with buses_lock:
+                endpoints	= buses.get( self.bus, [] )
+                if self in endpoints:
+                    endpoints.remove( self )
+                if not endpoints:
+                    buses.pop( self.bus, None )
+                for s in self.receiver:
+                    s.close()
+                self.receiver	= None
+        self.is_open		= False
+
+    def from_url( self, url ):
+        """Extract the bus name and any 'pace' option from an rs485://<bus>[/<name>][?pace] URL."""
+        parts			= urlparse.urlsplit( url )
+        if parts.scheme != "rs485" or not parts.netloc:
+            raise SerialException(
+                'expected a string in the form "rs485://<bus>[/<name>][?pace]": {!r}'.format( url ))
+        self.bus		= parts.netloc
+        for option,values in urlparse.parse_qs( parts.query, True ).items():
+            if option == 'pace':
+                self.pace	= values[0].lower() not in ( '0', 'false', 'no' )
+            else:
+                raise SerialException( 'unknown option {!r} in {!r}'.format( option, url ))
+
+    def _reconfigure_port( self ):
+        """The framing is only used to pace the writes."""
+
+    def _update_rts_state( self ):
+        pass
+
+    def _update_dtr_state( self ):
+        pass
+
+    def _update_break_state( self ):
+        pass
+
+    def fileno( self ):
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self.receiver[0].fileno()
+
+    @property
+    def in_waiting( self ):
+        if not self.is_open:
+            raise PortNotOpenError()
+        return struct.unpack( 'I', fcntl.ioctl( self.receiver[0].fileno(), termios.FIONREAD, b'\0\0\0\0' ))[0]
+
+    @property
+    def out_waiting( self ):
+        return 0
+
+    def read( self, size=1 ):
+        """Read up to 'size' bytes, within the port's timeout; once data arrives, stop if none follows
+        within any inter_byte_timeout."""
+        if not self.is_open:
+            raise PortNotOpenError()
+        read			= bytearray()
+        timeout			= Timeout( self._timeout )
+        while len( read ) < size:
+            ready,_,_		= select.select( [ self.receiver[0] ], [], [], timeout.time_left() )
+            if not ready:
+                break
+            try:
+                buf		= self.receiver[0].recv( size - len( read ))
+            except BlockingIOError:
+                continue
+            read.extend( buf )
+            if self._inter_byte_timeout is not None and buf:
+                timeout.restart( self._inter_byte_timeout )
+            if timeout.expired():
+                break
+        return bytes( read )
+
+    def write( self, data ):
+        """Deliver the data to every other endpoint on the bus; any endpoint that has fallen a socket
+        buffer behind in reading loses it (or the rest of it, receiving a truncated frame), as a
+        receiver would on a real bus.  If 'pace', first waits the time required to transmit the
+        data."""
+        if not self.is_open:
+            raise PortNotOpenError()
+        data			= to_bytes( data )
+        if self.pace:
+            bits		= 1 + self._bytesize + ( 0 if self._parity == 'N' else 1 ) + self._stopbits
+            time.sleep( len( data ) * bits / self._baudrate )
+        with buses_lock:
+            for e in buses.get( self.bus, [] ):
+                if e is self:
+                    continue
+                try:
+                    sent	= e.receiver[1].send( data )
+                except BlockingIOError:
+                    sent	= 0
+                if sent < len( data ):
+                    logging.warning( "%s: lost %d of %d bytes to %s", self.port, len( data ) - sent,
+                                     len( data ), e.port )
+        return len( data )
+
+    def reset_input_buffer( self ):
+        if not self.is_open:
+            raise PortNotOpenError()
+        try:
+            while self.receiver[0].recv( 4096 ):
+                pass
+        except BlockingIOError:
+            pass
+
+    def reset_output_buffer( self ):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    def flush( self ):
+        pass
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+#
+# Cpppo_positioner -- Actuator position control
+#
+# Copyright (c) 2014, Hard Consulting Corporation.
+#
+# Cpppo_positioner is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.  See the COPYING file at the top of the source tree.
+#
+# Cpppo_positioner is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+
+#
+# cpppo_positioner.publisher
+#
+#     Publish each actuator's decoded status into a fixed-layout shared-memory segment (a file,
+# normally in /dev/shm), so that any number of other local processes (eg. an HMI, or monitoring)
+# can read consistent live status snapshots, without any bus traffic or IPC round trip.  Only the
+# process owning the serial port publishes; attach one to a gateway's pollers:
+#
+#     pub = publisher.publisher()
+#     gateway = smc.smc_modbus( address="ttyS0", publisher=pub )
+#
+# and, in any other process:
+#
+#     sub = publisher.subscriber()
+#     sub.status( 1 )['current_position']
+#
+# or, from the command line:
+#
+#     python -m cpppo_positioner.publisher --watch 1
+#
+#     The segment begins with a header (magic, publishing pid, slot count, field count and slot
+# size), followed by the NUL-separated field names; the slots follow, one per Modbus unit id.  Each
+# slot is protected by a seqlock: the publisher increments the slot's sequence number (to odd)
+# before changing it, and again (to even) afterwards.  A subscriber copies the slot, and only
+# accepts the copy if the sequence number was even, and unchanged after copying.
+#
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry@hardconsulting.com"
+__copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
+__license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import cpppo
+import tabulate
+
+if __name__ == "__main__" and __package__ is None:
+    # Ensure that importing works (whether cpppo_positioner installed or not) with:
+    #   python -m cpppo_positioner.publisher ...
+    #   ./cpppo_positioner/publisher.py ...
+    #   ./publisher.py ...
+    __package__			= "cpppo_positioner"
+
+try:
+    from . import smc
+except ImportError:
+    try:
+        from cpppo_positioner import smc
+    except ImportError:
+        sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))))
+        from cpppo_positioner import smc
+
+
+PUBLISH_PATH			= os.path.join( '/dev/shm' if os.path.isdir( '/dev/shm' ) else tempfile.gettempdir(),
+                                                'cpppo_positioner.status' )
+PUBLISH_UNITS			= 248		# Slots for Modbus unit ids 0-247
+PUBLISH_TIMEOUT			= 1.0		# Seconds a subscriber retries an inconsistent slot
+
+# The segment header, followed by the field names, and then (at SEGMENT_ALIGN) the slots
+SEGMENT_MAGIC			= b'SMCSTAT1'
+SEGMENT_HEADER			= struct.Struct( '<8sIHHI' )	# magic, pid, units, fields, slot size
+SEGMENT_ALIGN			= 64
+# Each slot: sequence, generation, time, online, and a mask of the fields with valid values
+SLOT_HEADER			= struct.Struct( '<QQdB7xQ' )
+SLOT_SEQUENCE			= struct.Struct( '<Q' )
+
+
+def layout( names, units ):
+    """The (encoded names, slot codec, offset of the first slot) of a segment with the given field
+    names."""
+    assert len( names ) <= 64, "Too many status fields to publish: %d" % ( len( names ))
+    encoded			= b''.join( n.encode( 'ascii' ) + b'\0' for n in names )
+    codec			= struct.Struct( SLOT_HEADER.format + '%dq' % ( len( names )))
+    offset			= SEGMENT_HEADER.size + len( encoded )
+    offset		       += -offset % SEGMENT_ALIGN
+    return encoded,codec,offset
+
+
+class publisher( object ):
+    """Publishes each unit's status snapshot to a shared-memory segment.  A gateway's pollers invoke
+    .publish( unit, poller ) after each poll; the slot is only rewritten once the poller's .generation
+    has advanced.  Each unit is published by only its own poller Thread.
+
+    The segment is created afresh (and atomically replaces any prior one at 'path'); it is removed
+    when closed (unless since replaced by another publisher).
+
+    """
+    def __init__( self, path=PUBLISH_PATH, units=PUBLISH_UNITS, names=None ):
+        self.path		= path
+        self.names		= list( smc.registers.names if names is None else names )
+        self.units		= units
+        encoded,self.codec,self.offset = layout( self.names, units )
+        self.published		= {}		# {unit: generation, ...}
+        size			= self.offset + self.codec.size * units
+        temporary		= "%s.%d" % ( path, os.getpid() )
+        with open( temporary, 'w+b' ) as f:
+            f.truncate( size )
+            self.map		= mmap.mmap( f.fileno(), size )
+            self.inode		= os.fstat( f.fileno() ).st_ino
+        SEGMENT_HEADER.pack_into( self.map, 0, SEGMENT_MAGIC, os.getpid(), units, len( self.names ), self.codec.size )
+        self.map[SEGMENT_HEADER.size:SEGMENT_HEADER.size+len( encoded )] = encoded
+        os.replace( temporary, path )
+        logging.normal( "Publishing status of %d units to %s", units, path )
+
+    def publish( self, unit, poller ):
+        """Publish the poller's status, if changed since last published."""
+        generation		= poller.generation
+        if self.map is None or self.published.get( unit ) == generation:
+            return
+        if not 0 <= unit < self.units:
+            logging.warning( "Cannot publish status of unit %d; only %d slots", unit, self.units )
+            self.published[unit] = generation
+            return
+        status			= poller.status()
+        self.write( unit, status, status.generation, poller.online )
+        self.published[unit]	= status.generation
+
+    def write( self, unit, status, generation, online=True, when=None ):
+        """Write the {name: value, ...} status to the unit's slot; any missing (or None) values are
+        marked invalid."""
+        valid			= 0
+        values			= []
+        for i,k in enumerate( self.names ):
+            v			= status.get( k )
+            if v is not None:
+                valid	       |= 1 << i
+            values.append( int( v or 0 ))
+        offset			= self.offset + self.codec.size * unit
+        sequence,		= SLOT_SEQUENCE.unpack_from( self.map, offset )
+        SLOT_SEQUENCE.pack_into( self.map, offset, sequence + 1 )	# odd: being changed
+        self.codec.pack_into( self.map, offset, sequence + 1, generation or 0,
+                              time.time() if when is None else when, 1 if online else 0, valid, *values )
+        SLOT_SEQUENCE.pack_into( self.map, offset, sequence + 2 )	# even: consistent
+
+    def close( self ):
+        if self.map is None:
+            return
+        self.map.close()
+        self.map		= None
+        try:
+            if os.stat( self.path ).st_ino == self.inode:
+                os.unlink( self.path )
+        except OSError as exc:
+            logging.warning( "Failed to remove published status %s: %s", self.path, exc )
+
+
+class subscriber( object ):
+    """Reads consistent unit status snapshots from a publisher's shared-memory segment.  The field
+    names and layout are taken from the segment itself.
+
+    """
+    def __init__( self, path=PUBLISH_PATH, timeout=PUBLISH_TIMEOUT ):
+        self.path		= path
+        self.timeout		= timeout
+        with open( path, 'rb' ) as f:
+            self.inode		= os.fstat( f.fileno() ).st_ino
+            self.map		= mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        magic,self.pid,self.units,fields,size = SEGMENT_HEADER.unpack_from( self.map, 0 )
+        assert magic == SEGMENT_MAGIC, \
+            "Not an SMC status segment: %s" % ( path )
+        self.names		= [ n.decode( 'ascii' ) for n in
+                                    self.map[SEGMENT_HEADER.size:].split( b'\0', fields )[:fields] ]
+        _,self.codec,self.offset = layout( self.names, self.units )
+        assert self.codec.size == size, \
+            "Unexpected SMC status slot size %d; expected %d" % ( size, self.codec.size )
+
+    def stale( self ):
+        """True if the segment has since been replaced (or removed), eg. by a restarted publisher."""
+        try:
+            return os.stat( self.path ).st_ino != self.inode
+        except OSError:
+            return True
+
+    def read( self, unit ):
+        """Returns a consistent (online, time, snapshot) of the unit's published status, or None if
+        never published.  Retries while the slot is being changed, for up to .timeout seconds."""
+        offset			= self.offset + self.codec.size * unit
+        deadline		= None
+        while True:
+            before,		= SLOT_SEQUENCE.unpack_from( self.map, offset )
+            if not before & 1:
+                record		= self.codec.unpack( self.map[offset:offset+self.codec.size] )
+                after,		= SLOT_SEQUENCE.unpack_from( self.map, offset ) # re-read, after copying
+                if after == before:
+                    break
+            if deadline is None:
+                deadline	= cpppo.timer() + self.timeout
+            assert cpppo.timer() < deadline, \
+                "Unit %d status in %s inconsistent for %.3fs" % ( unit, self.path, self.timeout )
+            time.sleep( 0 )
+        sequence,generation,when,online,valid = record[:5]
+        if not sequence:
+            return None
+        values			= dict( ( k, v if valid & ( 1 << i ) else None )
+                                        for i,(k,v) in enumerate( zip( self.names, record[5:] )))
+        return bool( online ), when, smc.snapshot( values, generation )
+
+    def status( self, actuator=1 ):
+        """The unit's published status snapshot (None if never published)."""
+        record			= self.read( actuator )
+        return record and record[2]
+
+    def actuators( self ):
+        """The units whose status has been published."""
+        return [ u for u in range( self.units )
+                 if SLOT_SEQUENCE.unpack_from( self.map, self.offset + self.codec.size * u )[0] ]
+
+    def close( self ):
+        self.map.close()
+
+
+def main( argv=None ):
+    """Print the published status of the actuators."""
+    ap				= argparse.ArgumentParser(
+        description = "Print the status of SMC actuators, as published by a running gateway.",
+        epilog = "" )
+
+    ap.add_argument( '-v', '--verbose', default=0, action="count",
+                     help="Display logging information." )
+    ap.add_argument( '-n', '--actuator', default=None, type=int, action='append',
+                     help="Only print the status of this actuator (may be repeated)" )
+    ap.add_argument( '-w', '--watch', default=None, type=float,
+                     help="Re-print the status every so many seconds" )
+    ap.add_argument( 'path', nargs='?', default=PUBLISH_PATH,
+                     help="Published status segment (default: %s)" % ( PUBLISH_PATH ))
+
+    args			= ap.parse_args( argv )
+
+    cpppo.log_cfg['level']	= { 0: logging.WARNING, 1: logging.NORMAL, 2: logging.DETAIL,
+                                    3: logging.INFO }.get( args.verbose, logging.DEBUG )
+    logging.basicConfig( **cpppo.log_cfg )
+
+    sub				= subscriber( args.path )
+    try:
+        while True:
+            if sub.stale():
+                sub.close()
+                sub		= subscriber( args.path )
+            units		= args.actuator or sub.actuators()
+            rows		= []
+            for name in sub.names:
+                rows.append( [ name ] )
+            header		= [ "" ]
+            for u in units:
+                record		= sub.read( u )
+                header.append( "%d%s" % ( u, "" if record and record[0] else " (offline)" ))
+                for row,name in zip( rows, sub.names ):
+                    row.append( record[2][name] if record else None )
+            print( tabulate.tabulate( rows, headers=header, tablefmt='orgtbl' ))
+            if not args.watch:
+                break
+            time.sleep( args.watch )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sub.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+#
+# Cpppo_positioner -- Actuator position control
+#
+# Copyright (c) 2014, Hard Consulting Corporation.
+#
+# Cpppo_positioner is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.  See the COPYING file at the top of the source tree.
+#
+# Cpppo_positioner is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+
+#
+# cpppo_positioner.recorder
+#
+#     Record each actuator's polled motion (current_position, current_speed, current_thrust, BUSY
+# and INP) as timestamped samples in fixed-size array-backed ring buffers, optionally spilling them
+# to a fixed-size memory-mapped binary file (itself a ring, retaining the latest samples) for later
+# analysis.  Attach one to a gateway's pollers:
+#
+#     rec = recorder.recorder( path="motion.rec" )
+#     gateway = smc.smc_modbus( address="ttyS0", recorder=rec )
+#     ...
+#     rec.samples( 1 )['current_position']	# array('i', [...])
+#     rec.close()
+#
+# and later, dump the spilled samples:
+#
+#     python -m cpppo_positioner.recorder motion.rec
+#
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry@hardconsulting.com"
+__copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
+__license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
+
+import argparse
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import cpppo
+import tabulate
+
+if __name__ == "__main__" and __package__ is None:
+    # Ensure that importing works (whether cpppo_positioner installed or not) with:
+    #   python -m cpppo_positioner.recorder ...
+    #   ./cpppo_positioner/recorder.py ...
+    #   ./recorder.py ...
+    __package__			= "cpppo_positioner"
+
+try:
+    from . import smc
+except ImportError:
+    try:
+        from cpppo_positioner import smc
+    except ImportError:
+        sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))))
+        from cpppo_positioner import smc
+
+
+# The recorded columns, and their array typecodes.  The BUSY and INP flags are packed into 'flags'.
+COLUMNS				= ( ('time', 'd'), ('current_position', 'i'), ('current_speed', 'H'),
+                                    ('current_thrust', 'H'), ('flags', 'B') )
+FLAG_BUSY			= 0x01
+FLAG_INP			= 0x02
+
+RECORD_CAPACITY			= 4096		# Samples retained in memory, per actuator
+RECORD_INTERVAL			= 5.0		# Seconds between spills to the file
+
+# The spill file: a header of magic, the capacity (in records) and the count of records ever written,
+# followed by a ring of 'capacity' records; the record with count n is at index n % capacity.
+FILE_MAGIC			= b'SMCREC02'
+FILE_HEADER			= struct.Struct( '<8sQQ' )
+FILE_RECORD			= struct.Struct( '<dHiHHBx' )	# time, actuator, position, speed, thrust, flags
+FILE_CAPACITY			= 1 << 20	# Records retained in the file (20MB)
+
+
+class ring( object ):
+    """The latest 'capacity' samples of one actuator, in preallocated column arrays.  The .count of
+    samples ever appended increases monotonically; the sample with count n is at index n % capacity.
+
+    """
+    def __init__( self, capacity=RECORD_CAPACITY ):
+        self.capacity		= capacity
+        self.count		= 0
+        self.columns		= dict( (name, array.array( code, bytes( array.array( code ).itemsize * capacity )))
+                                        for name,code in COLUMNS )
+
+    def append( self, values ):
+        index			= self.count % self.capacity
+        for name,_ in COLUMNS:
+            self.columns[name][index] = values[name]
+        self.count	       += 1
+
+    def since( self, count ):
+        """The (first, columns) of the retained samples appended after the first 'count', in order."""
+        first			= max( count, self.count - self.capacity )
+        result			= dict( (name, array.array( code )) for name,code in COLUMNS )
+        if first >= self.count:
+            return first,result
+        lo,hi			= first % self.capacity, self.count % self.capacity
+        for name,_ in COLUMNS:
+            column		= self.columns[name]
+            if lo < hi:
+                result[name].extend( column[lo:hi] )
+            else:
+                result[name].extend( column[lo:] )
+                result[name].extend( column[:hi] )
+        return first,result
+
+
+def spans( capacity, count ):
+    """The (index, records) spans of a ring of 'capacity' holding the latest of 'count' records, in
+    order; at most 2, if the retained records wrap around the end of the ring."""
+    first			= max( 0, count - capacity )
+    lo,n			= first % capacity, count - first
+    if lo + n <= capacity:
+        return [ ( lo, n ) ] if n else []
+    return [ ( lo, capacity - lo ), ( 0, lo + n - capacity ) ]
+
+
+class spill( object ):
+    """A memory-mapped binary file ring of the latest 'capacity' FILE_RECORD samples, so its size never
+    changes once created.  An existing recording retains its own capacity."""
+    def __init__( self, path, capacity=FILE_CAPACITY ):
+        self.path		= path
+        self.file		= open( path, 'a+b' )
+        if os.fstat( self.file.fileno() ).st_size < FILE_HEADER.size:
+            self.file.truncate( FILE_HEADER.size + FILE_RECORD.size * capacity )
+        self.map		= mmap.mmap( self.file.fileno(), 0 )
+        magic,self.capacity,self.count = FILE_HEADER.unpack_from( self.map, 0 )
+        if magic != FILE_MAGIC:
+            assert magic == bytes( len( FILE_MAGIC )), \
+                "Not an SMC motion recording: %s" % ( path )
+            self.capacity,self.count = capacity,0
+            FILE_HEADER.pack_into( self.map, 0, FILE_MAGIC, self.capacity, self.count )
+        assert len( self.map ) == FILE_HEADER.size + FILE_RECORD.size * self.capacity, \
+            "Corrupt SMC motion recording: %s" % ( path )
+
+    def write( self, records ):
+        """Append the (time, actuator, position, speed, thrust, flags) records (overwriting the oldest),
+        then the new count."""
+        for r in records[-self.capacity:]:
+            offset		= FILE_HEADER.size + FILE_RECORD.size * ( self.count % self.capacity )
+            FILE_RECORD.pack_into( self.map, offset, *r )
+            self.count	       += 1
+        if records:
+            FILE_HEADER.pack_into( self.map, 0, FILE_MAGIC, self.capacity, self.count )
+
+    def close( self ):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+def load( path ):
+    """Read a spilled recording, returning {actuator: {column: array, ...}, ...} of its samples."""
+    result			= {}
+    with open( path, 'rb' ) as f:
+        with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as m:
+            magic,capacity,count = FILE_HEADER.unpack_from( m, 0 )
+            assert magic == FILE_MAGIC, \
+                "Not an SMC motion recording: %s" % ( path )
+            for index,n in spans( capacity, count ):
+                offset		= FILE_HEADER.size + FILE_RECORD.size * index
+                for t,a,position,speed,thrust,flags in FILE_RECORD.iter_unpack(
+                        m[offset:offset + FILE_RECORD.size * n] ):
+                    columns	= result.get( a )
+                    if columns is None:
+                        columns	= result[a] = dict( (name, array.array( code )) for name,code in COLUMNS )
+                    for name,v in zip( ( 'time', 'current_position', 'current_speed', 'current_thrust', 'flags' ),
+                                       ( t, position, speed, thrust, flags )):
+                        columns[name].append( v )
+    return result
+
+
+class recorder( object ):
+    """Records each actuator's motion, as it is polled.  A gateway's pollers invoke .sample( unit,
+    reader ) after each successful poll, where reader( address ) returns the latest polled value; this
+    only copies a few values into the actuator's ring buffer, so never stalls the bus.
+
+    If a 'path' is supplied, a background Thread spills each actuator's new samples to the file every
+    'interval' seconds (and when closed); any samples overwritten in a ring before they could be
+    spilled are counted in .dropped.  The file retains only the latest 'file_capacity' samples (of
+    all actuators), so neither its size nor its mapping grow while recording continuously.
+
+    """
+    def __init__( self, path=None, capacity=RECORD_CAPACITY, interval=RECORD_INTERVAL,
+                  file_capacity=FILE_CAPACITY ):
+        self.capacity		= capacity
+        self.interval		= interval
+        self.rings		= {}		# {actuator: ring, ...}
+        self.spilled		= {}		# {actuator: count, ...} of samples spilled
+        self.dropped		= 0
+        self.lock		= threading.Lock()
+        self.writing		= threading.Lock()	# Serializes spills (and close) of the file
+        self.file		= None if path is None else spill( path, capacity=file_capacity )
+        self.done		= threading.Event()
+        self.thread		= None
+        if self.file:
+            self.thread		= threading.Thread( target=self.run, name="SMC recorder: %s" % ( path ))
+            self.thread.daemon	= True
+            self.thread.start()
+
+    def sample( self, actuator, reader, when=None ):
+        """Record the current motion of 'actuator', using reader( address ) to obtain the latest polled
+        values; skipped until its position has been polled."""
+        position		= reader( smc.data.current_position.addr )
+        lower			= reader( smc.data.current_position.addr + 1 )
+        if position is None or lower is None:
+            return
+        values			= dict(
+            time		= time.time() if when is None else when,
+            current_position	= struct.unpack( '>i', struct.pack( '>HH', position, lower ))[0],
+            current_speed	= reader( smc.data.current_speed.addr ) or 0,
+            current_thrust	= reader( smc.data.current_thrust.addr ) or 0,
+            flags		= ( FLAG_BUSY if reader( smc.data.X48_BUSY.addr ) else 0 )
+                                  | ( FLAG_INP if reader( smc.data.X4B_INP.addr ) else 0 ),
+        )
+        with self.lock:
+            r			= self.rings.get( actuator )
+            if r is None:
+                r		= self.rings[actuator] = ring( self.capacity )
+            r.append( values )
+
+    def samples( self, actuator ):
+        """The retained samples of 'actuator' as {column: array, ...}, oldest first; the 'flags' are
+        also unpacked into 'busy' and 'inp' columns."""
+        with self.lock:
+            r			= self.rings.get( actuator )
+            _,columns		= ( 0, dict( (name, array.array( code )) for name,code in COLUMNS )) \
+                                  if r is None else r.since( 0 )
+        columns['busy']		= array.array( 'B', ( 1 if f & FLAG_BUSY else 0 for f in columns['flags'] ))
+        columns['inp']		= array.array( 'B', ( 1 if f & FLAG_INP else 0 for f in columns['flags'] ))
+        return columns
+
+    def actuators( self ):
+        with self.lock:
+            return sorted( self.rings )
+
+    def run( self ):
+        while not self.done.wait( self.interval ):
+            self.spill()
+
+    def spill( self ):
+        """Write every actuator's samples not yet spilled to the file.  Sampling is only blocked while
+        the samples are collected, not while they're written; concurrent spills (eg. the background
+        Thread's, and the final one in close) are written one at a time."""
+        with self.writing:
+            if not self.file:
+                return
+            records		= []
+            with self.lock:
+                for a,r in self.rings.items():
+                    count	= self.spilled.get( a, 0 )
+                    first,columns	= r.since( count )
+                    self.dropped       += first - count
+                    self.spilled[a]	= r.count
+                    records.extend( zip( columns['time'], [ a ] * len( columns['time'] ),
+                                         columns['current_position'], columns['current_speed'],
+                                         columns['current_thrust'], columns['flags'] ))
+            records.sort()
+            try:
+                self.file.write( records )
+            except Exception as exc:
+                logging.warning( "Failed to spill %d motion samples to %s: %s", len( records ), self.file.path, exc )
+
+    def close( self ):
+        self.done.set()
+        if self.thread and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join( timeout=1 )
+        self.spill()
+        with self.writing:
+            if self.file:
+                self.file.close()
+                self.file	= None
+
+
+def main( argv=None ):
+    """Print the samples of a spilled motion recording."""
+    ap				= argparse.ArgumentParser(
+        description = "Print an SMC actuator motion recording.",
+        epilog = "" )
+
+    ap.add_argument( '-v', '--verbose', default=0, action="count",
+                     help="Display logging information." )
+    ap.add_argument( '-n', '--actuator', default=None, type=int,
+                     help="Only print the samples of this actuator" )
+    ap.add_argument( 'path',
+                     help="Motion recording file" )
+
+    args			= ap.parse_args( argv )
+
+    cpppo.log_cfg['level']	= { 0: logging.WARNING, 1: logging.NORMAL, 2: logging.DETAIL,
+                                    3: logging.INFO }.get( args.verbose, logging.DEBUG )
+    logging.basicConfig( **cpppo.log_cfg )
+
+    for a,columns in sorted( load( args.path ).items() ):
+        if args.actuator is not None and a != args.actuator:
+            continue
+        print( "Actuator %d:" % ( a ))
+        print( tabulate.tabulate(
+            [ ( t, p, s, h, 1 if f & FLAG_BUSY else 0, 1 if f & FLAG_INP else 0 )
+              for t,p,s,h,f in zip( *( columns[name] for name,_ in COLUMNS )) ],
+            headers=[ "Time", "Position", "Speed", "Thrust", "BUSY", "INP" ],
+            floatfmt=".3f", tablefmt='orgtbl' ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -20,9 +20,9 @@
 # cpppo_positioner.simulator
 # 
 #     Provision a simulated SMC controller on the specified serial port, responding to 1 or more
-# actuator numbers.
+# actuator numbers (or ranges) with kinematically simulated actuators.
 # 
-#     python -m cpppo_positioner.simulator /dev/ttyS0 1 2
+#     python -m cpppo_positioner.simulator /dev/ttyS0 1 2 10-200
 # 
 
 from __future__ import absolute_import
@@ -34,11 +34,20 @@ __email__                       = "perry@hardconsulting.com"
 __copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
 __license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
 
-import sys
+import argparse
+import asyncio
+import logging
 import os
-import json
+import sys
+import threading
+import time
 
-from cpppo.bin.modbus_sim import main as main_modbus_sim
+from contextlib import suppress
+
+import cpppo
+from cpppo.remote.pymodbus_fixes import modbus_server_rtu
+from pymodbus.framer import FramerType
+from pymodbus.datastore import ModbusServerContext, ModbusSlaveContext, ModbusSparseDataBlock
 
 if __name__ == "__main__" and __package__ is None:
     # Ensure that importing works (whether cpppo_positioner installed or not) with:
@@ -48,61 +57,397 @@ if __name__ == "__main__" and __package__ is None:
     __package__			= "cpppo_positioner"
 
 try:
-    from cpppo_positioner import smc
+    from . import smc
 except ImportError:
-    sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))))
-    from cpppo_positioner import smc
+    try:
+        from cpppo_positioner import smc
+    except ImportError:
+        sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))))
+        from cpppo_positioner import smc
+
+
+def location( addr ):
+    """The datastore (function code, 0-based offset) of a Modbus register 'addr'; eg. 10001 + 0x48
+    (X48_BUSY) ==> (2, 0x48).  Only the Coil, Discrete Input and Holding Register ranges are used."""
+    if addr >= 40001:
+        return 3, addr - 40001
+    if addr >= 10001:
+        return 2, addr - 10001
+    return 1, addr - 1
+
+
+class actuator( ModbusSlaveContext ):
+    """A kinematically simulated SMC actuator unit's registers.
+
+    Responds to the positioning handshake (see smc.py smc_modbus.position) like an SMC Actuator:
+
+    1   - Y30 (input invalid flag) is ignored
+    2   - Y19 (SVON) is reflected in X49 (SVRE)
+    3   - Y1C (SETUP) is reflected in X4A (SETON)
+    4   - D9102-D9111 step data is latched when the operation starts (initially, the smc.data[...]
+          .default values, as a configured controller would hold)
+    5   - D9100 Operation Start (0x0100) is acknowledged (returned to 0) and, with the servo on and no
+          alarm, the move begins: X48 (BUSY) is set and X4B (INP) cleared, and the actuator follows a
+          trapezoidal speed profile (limited by the speed, acceleration and deceleration) to the
+          absolute (movement_mode 1) or relative (2) position.  At the target, BUSY clears, and INP
+          is set while within in_position of it.  X4C (AREA) is set while between area_1 and area_2.
+
+    Alternatively, a rising edge of Y1A (DRIVE) starts the stored step data point (at D0400 + 10h * n)
+    whose number is selected on Y10-Y15 (IN0-IN5); its number is reported in D9006 (driving_data_no)
+    and X40-X45 (OUT0-OUT5).
+
+    The D9000 current_position, D9002 current_speed and D9004 target_position are updated as it
+    moves; a current_position written by the client is adopted.  Starting without SVRE sets the
+    X4F_ALARM (reverse logic), as does Y18 (HOLD) which also suspends any motion; the alarm is
+    cleared on a rising edge of Y1B (RESET).  Pushing operations (pushing_force, etc.) are not
+    simulated.
+
+    Every client write adds the unit to the shared 'changed' set, so the actuator_updater need only
+    update those units that were written, or are in motion.
+
+    """
+    STEP		= ( 'movement_mode', 'speed', 'position', 'acceleration', 'deceleration',
+                            'area_1', 'area_2', 'in_position' )
+    CURRENT		= location( smc.data.current_position.addr )[1]
+
+    #    '    17 -     64 = 0',	# Coil           0x10   - 0x30   (     1 +) (rounded to 16 bits)
+    #    ' 10065 -  10080 = 0',	# Discrete Input 0x40   - 0x4F   ( 10001 +)
+    #    ' 76865 -  77138 = 0',	# Holding Regs   0x9000 - 0x9111 ( 40001 +)
+    #    ' 41025 -  42048 = 0',	# Holding Regs   0x0400 - 0x07FF ( 40001 +) (step data points)
+    POINTS		= location( smc.POINT_TABLE )[1]
+    def __init__( self, unit, changed=None ):
+        registers		= dict( (a,0) for a in range( 0x9000, 0x911F+1 ))
+        registers.update( (a,0) for a in range( self.POINTS, self.POINTS + smc.POINTS * smc.POINT_SIZE + 1 ))
+        super( actuator, self ).__init__(
+            co=ModbusSparseDataBlock(dict( (a,0) for a in range(   0x10,   0x3F+1 ))),
+            di=ModbusSparseDataBlock(dict( (a,0) for a in range(   0x40,   0x50+1 ))),
+            hr=ModbusSparseDataBlock(registers),
+            ir=ModbusSparseDataBlock(dict()),
+        )
+        self.unit		= unit
+        self.changed		= set() if changed is None else changed
+        self.position		= 0.0		# .01mm
+        self.speed		= 0.0		# mm/s
+        self.target		= None		# .01mm; None unless in motion
+        self.step		= None		# The latched step data of the last move
+        self.updated		= None		# The cpppo.timer() of the last update
+        self.reset		= False		# The last Y1B_RESET observed
+        self.drive		= False		# The last Y1A_DRIVE observed
+        self.put( 'X4F_ALARM', 1 )		# ALARM Clear (reverse logic)
+        for k in smc.registers.names:
+            if 'default' in smc.data[k]:		# Only the step data has defaults
+                self.put( k, smc.data[k].default )
+
+    def get( self, name, point=None ):
+        """Decode the named smc.data field's value from the datastore (or that step data field of the
+        stored step data 'point')."""
+        addr,count,codec	= smc.registers.fields[name]
+        if point is not None:
+            addr	       += smc.point_address( point ) - smc.STEP_DATA_BEG
+        values			= self.getValues( *location( addr ), count=count )
+        if codec is None:
+            return values[0]
+        return codec.unpack( smc.registers.words[count].pack( *values ))[0]
+
+    def put( self, name, value ):
+        """Encode the named smc.data field's value into the datastore, without marking the unit changed."""
+        addr,count,_		= smc.registers.fields[name]
+        super( actuator, self ).setValues( *location( addr ), smc.registers.encode( {name: value}, addr, count ))
+
+    def setValues( self, fc_as_hex, address, values ):
+        """A client write; adopt any written current_position, and mark the unit as changed."""
+        super( actuator, self ).setValues( fc_as_hex, address, values )
+        if self.decode( fc_as_hex ) == 'h' and address <= self.CURRENT + 1 and self.CURRENT < address + len( values ):
+            self.position	= float( self.get( 'current_position' ))
+        self.changed.add( self.unit )
+
+    def start( self, point=None ):
+        """Latch the step data (or the stored step data 'point') and begin moving, if the servo is on and
+        there is no alarm."""
+        if not self.get( 'X49_SVRE' ) or not self.get( 'X4F_ALARM' ):
+            logging.warning( "SMC Actuator Simulator unit {unit}; START w/ SVRE: {SVRE!r}, ALARM: {ALARM!r} (reverse logic) *SET ALARM*".format(
+                unit=self.unit, SVRE=self.get( 'X49_SVRE' ), ALARM=self.get( 'X4F_ALARM' )))
+            self.put( 'X4F_ALARM', 0 )
+            return
+        self.step		= dict( (k,self.get( k, point=point )) for k in self.STEP )
+        self.target		= self.step['position']
+        if self.step['movement_mode'] == 2:
+            self.target	       += round( self.position )
+        self.speed		= 0.0
+        logging.detail( "SMC Actuator Simulator unit {unit}; START: {position:9.0f} ==> {target:9d} at {speed} mm/s".format(
+            unit=self.unit, position=self.position, target=self.target, speed=self.step['speed'] ))
+        self.put( 'target_position', self.target )
+        self.put( 'X48_BUSY', 1 )
+        self.put( 'X4B_INP', 0 )
+
+    def move( self, dt ):
+        """Advance the move by 'dt' seconds: accelerate toward the step data speed, until the remaining
+        distance requires deceleration to stop at the target."""
+        remaining		= ( self.target - self.position ) / 100	# mm
+        distance		= abs( remaining )
+        speed			= self.speed
+        deceleration		= max( 1, self.step['deceleration'] )
+        if speed ** 2 / ( 2 * deceleration ) >= distance:
+            speed		= max( 0.0, speed - deceleration * dt )
+        else:
+            speed		= min( max( 1, self.step['speed'] ), speed + max( 1, self.step['acceleration'] ) * dt )
+        travel			= ( self.speed + speed ) / 2 * dt
+        if travel >= distance or not speed:
+            logging.detail( "SMC Actuator Simulator unit {unit}; STOP:  {target:9d}".format(
+                unit=self.unit, target=self.target ))
+            self.position	= float( self.target )
+            self.speed		= 0.0
+            self.target		= None
+            self.put( 'X48_BUSY', 0 )
+            return
+        self.position	       += travel * 100 * ( 1 if remaining > 0 else -1 )
+        self.speed		= speed
+
+    def update( self, now ):
+        """Respond to the latest client writes, and advance any motion to time 'now'.  Returns True
+        while the actuator remains in motion (and so requires further updates)."""
+        dt			= 0.0 if self.updated is None else now - self.updated
+        self.updated		= now
+
+        # If a reset->RESET edge has been indicated, clear any existing X4F_ALARM (reverse logic)
+        RESET			= bool( self.get( 'Y1B_RESET' ))
+        if RESET and not self.reset and not self.get( 'X4F_ALARM' ):
+            logging.detail( "SMC Actuator Simulator unit {unit}; reset --> RESET *CLEAR ALARM*".format(
+                unit=self.unit ))
+            self.put( 'X4F_ALARM', 1 )
+        self.reset		= RESET
+
+        # SVON is reflected in SVRE; turning the servo off stops any motion immediately
+        SVON			= bool( self.get( 'Y19_SVON' ))
+        if SVON != bool( self.get( 'X49_SVRE' )):
+            logging.detail( "SMC Actuator Simulator unit {unit}; SVON (== {SVON}) ==> SVRE".format(
+                unit=self.unit, SVON=SVON ))
+            self.put( 'X49_SVRE', int( SVON ))
+        if not SVON and self.target is not None:
+            self.target		= None
+            self.speed		= 0.0
+            self.put( 'X48_BUSY', 0 )
+
+        # SETUP is reflected in SETON
+        SETUP			= bool( self.get( 'Y1C_SETUP' ))
+        if SETUP != bool( self.get( 'X4A_SETON' )):
+            logging.detail( "SMC Actuator Simulator unit {unit}; SETUP (== {SETUP}) ==> SETON".format(
+                unit=self.unit, SETUP=SETUP ))
+            self.put( 'X4A_SETON', int( SETUP ))
+
+        # While HOLD is set, turns on ALARM.  This is probably not what a real device does, but we
+        # need something to set the ALARM and it seems close in concept to the STOP signal used by
+        # other SMC devices, so that's what we'll do...  However, we won't reset it when HOLD is
+        # released, so we can test the ALARM reset procedure.
+        HOLD			= bool( self.get( 'Y18_HOLD' ))
+        if HOLD and self.get( 'X4F_ALARM' ):
+            logging.detail( "SMC Actuator Simulator unit {unit}; *SET ALARM* (due to HOLD)".format(
+                unit=self.unit ))
+            self.put( 'X4F_ALARM', 0 )
+
+        # Acknowledge any Operation Start by returning it to 0, and begin the move
+        if self.get( 'operation_start' ):
+            self.put( 'operation_start', 0 )
+            self.start()
+            dt			= 0.0		# The move begins now
+
+        # A rising edge of DRIVE starts the stored step data point selected on IN0-IN5
+        DRIVE			= bool( self.get( 'Y1A_DRIVE' ))
+        if DRIVE and not self.drive:
+            point		= sum( 1 << b for b in range( 6 ) if self.get( 'Y1%d_IN%d' % ( b, b )))
+            logging.detail( "SMC Actuator Simulator unit {unit}; drive --> DRIVE point {point}".format(
+                unit=self.unit, point=point ))
+            self.put( 'driving_data_no', point )
+            for b in range( 6 ):
+                self.put( 'X4%d_OUT%d' % ( b, b ), ( point >> b ) & 1 )
+            self.start( point=point )
+            dt			= 0.0
+        self.drive		= DRIVE
+
+        if self.target is not None and not HOLD and dt > 0:
+            self.move( dt )
+
+        self.put( 'current_position', round( self.position ))
+        self.put( 'current_speed', round( self.speed ))
+        if self.step:
+            position		= round( self.position )
+            self.put( 'X4B_INP', int( abs( self.get( 'target_position' ) - position ) <= self.step['in_position'] ))
+            self.put( 'X4C_AREA', int( self.step['area_1'] <= position <= self.step['area_2'] ))
+        return self.target is not None
 
 
-if __name__ == "__main__": 
+async def actuator_updater( context, period=.05, changed=None ):
+    """Update the simulated actuator units in the server context.
 
-    # Some initial setup before the main loop; no logging set up yet...
+    This task runs continuously beside the server, updating each actuator unit in the context that
+    has been written by the client (is in the shared 'changed' set), or is in motion, every 'period'
+    seconds.  Idle units cost nothing, so a single process can simulate hundreds of actuators.
 
-    # Find the SMC Simulator related arguments, and pull them out of the sys.argv list
+    Since the server and this task share the asyncio event loop, the unit's getValues and setValues
+    are never used concurrently.
+
+    """
+    logging.detail( "SMC Actuator Updater running on units {units}".format( units=context.slaves() ))
+    active			= set( context.slaves() )
+    if changed is None:
+        changed			= set()
+    while True:
+        await asyncio.sleep( period )
+        now			= cpppo.timer()
+        active		       |= changed
+        changed.clear()
+        for unit in list( active ):
+            try:
+                if not context[unit].update( now ):
+                    active.discard( unit )
+            except Exception as exc:
+                logging.warning( "Failed simulator unit {unit} update: {exc}".format( unit=unit, exc=exc ))
+                active.discard( unit )
+
+
+def actuator_simulator( tty, units, period=.05, **kwds ):
+    """Initiates an asyncio-run Modbus/RTU kinematic actuator simulator in a Thread.
+
+    Executes an asyncio task to respond to positioning inputs and advance any motion, every 'period'
+    seconds.  Any 'kwds' override the serial port settings.  Yields the TTY while the simulator runs.
+
+    """
+    serial_args			= dict(
+        timeout		= smc.PORT_TIMEOUT,
+        # retries	= 3,
+        baudrate	= smc.PORT_BAUDRATE,
+        bytesize	= smc.PORT_BYTESIZE,
+        parity		= smc.PORT_PARITY,
+        stopbits	= smc.PORT_STOPBITS,
+        # handle_local_echo = False,
+    )
+    serial_args.update( kwds )
+    if serial_args['timeout'] is None:
+        serial_args['timeout']	= smc.rs485_timing( **dict(
+            (k,serial_args[k]) for k in ( 'baudrate', 'bytesize', 'parity', 'stopbits' ))).timeout
+
+    # The asyncio-run actuator, which emits globals as_info['server'] and 'loop' for later cleanup
+    async def actuator_start( port, units, as_info ):
+
+        logging.detail( "Starting Modbus Serial SMC Actuator Simulator units {units!r} on {port}".format(
+            units=units, port=port ))
+
+        changed			= set()
+        context			= ModbusServerContext(
+            single	= False,
+            slaves	= dict( (unit,actuator( unit, changed=changed )) for unit in units ),
+        )
+
+        # When communication is established, initiate the actuator updater task
+        class modbus_server_actuator( modbus_server_rtu ):
+            def callback_communication(self, established):
+                if hasattr( self, 'updater_task' ):
+                    if not established:
+                        # If the updater_task has been created, cancel it
+                        logging.info( "SMC Actuator Positioning Updater stopping" )
+                        self.updater_task.cancel()
+                else:
+                    if established:
+                        logging.info( "SMC Actuator Positioning Updater starting" )
+                        self.updater_task = asyncio.create_task( actuator_updater(
+                            context	= self.context,
+                            period	= period,
+                            changed	= changed,
+                        ))
+                        self.updater_task.set_name( "SMC Actuator Positioning" )
+                super(modbus_server_actuator, self).callback_communication( established )
+
+        server			= modbus_server_actuator(
+            port	= port,
+            context	= context,
+            framer	= FramerType.RTU,
+            ignore_missing_slaves = True,
+            broadcast_enable = True,	# Writes to unit 0 reach every actuator, w/o response
+            **serial_args,
+        )
+
+        as_info['server']	= server
+        as_info['loop']		= asyncio.get_event_loop()
+
+        with suppress(asyncio.exceptions.CancelledError):
+            await server.serve_forever()
+
+        logging.detail( "Stopping Modbus Serial SMC Actuator Simulator units {units!r} on {port}".format(
+            units=units, port=port ))
+
+
+    as_info			= dict()
     
-    # The first argument must be a device
-    address			= ''
-    if '--address' in sys.argv:
-        i			= sys.argv.index( '--address' )
-        sys.argv.pop( i )
-        address			= sys.argv.pop( i )
-    elif len( sys.argv ) > 1:
-        address			= sys.argv.pop( 1 )
-        
-    # The actuator number(s) assigned to this simulator.
+    # Start the asyncio-run server in a Thread on the TTY, w/ as designated RS-485 units
+    thread			= threading.Thread(
+            target	= lambda **kwds: asyncio.run( actuator_start( **kwds )),
+            kwargs	= dict(
+                port	= tty,
+                units	= units,
+                as_info	= as_info,   # Thread 
+            )
+        )
+    thread.daemon		= True
+    thread.start()
+
+    # Indicate to the caller what TTY the simulator has been started on
+    yield tty
+
+    # Shut down the asyncio-run server, and join its thread
+    asyncio.run_coroutine_threadsafe( as_info['server'].shutdown(), as_info['loop'] )
+    thread.join()
+
+
+def main( argv=None ):
+    """Simulate the actuator units (eg. 1 2 5-8) on a serial port until interrupted."""
+    ap				= argparse.ArgumentParser(
+        description = "Simulate kinematic SMC actuators on a Modbus/RTU serial port.",
+        epilog = "" )
+
+    ap.add_argument( '-v', '--verbose', default=0, action="count",
+                     help="Display logging information." )
+    ap.add_argument( '-a', '--address', default=None,
+                     help="Serial port of the simulated actuators, eg. /dev/ttyS0" )
+    ap.add_argument( '--actuator', default=[], action="append",
+                     help="Actuator unit number(s) (or ranges, eg. 1-200) to simulate" )
+    ap.add_argument( '-b', '--baudrate', default=smc.PORT_BAUDRATE, type=int,
+                     help="Baud rate (default: %s)" % ( smc.PORT_BAUDRATE ))
+    ap.add_argument( '-p', '--period', default=.05, type=float,
+                     help="Simulator update period in seconds (default: .05)" )
+    ap.add_argument( 'positional', nargs="*",
+                     help="The serial port (if no --address), followed by any actuator unit numbers" )
+
+    args			= ap.parse_args( argv )
+
+    cpppo.log_cfg['level']	= { 0: logging.WARNING, 1: logging.NORMAL, 2: logging.DETAIL,
+                                    3: logging.INFO }.get( args.verbose, logging.DEBUG )
+    logging.basicConfig( **cpppo.log_cfg )
+
+    address			= args.address
+    positional			= list( args.positional )
+    if address is None and positional:
+        address			= positional.pop( 0 )
     actuators			= []
-    while True:
-        if '--actuator' in sys.argv:
-            i			= sys.argv.index( '--actuator' )
-            sys.argv.pop( i )
-            actuators.append( int( sys.argv.pop( i )))
-        elif len( sys.argv ) > 1 and sys.argv[1].isdigit():
-            actuators.append( int( sys.argv.pop( 1 )))
-        else:
-            break
+    for a in args.actuator + positional:
+        lo,_,hi			= a.partition( '-' )
+        actuators.extend( range( int( lo ), int( hi or lo ) + 1 ))
     assert address, \
         "Must supply a serial port --address name, eg. /dev/ttyS0"
     assert actuators, \
         "Must supply 1 or more --actuator <id> numbers, eg 1"
 
-    # Does NOT simulate the behaviors of an SMC Actuator; just the required registers
-    argv			= [
-        '-vvv', '--log', '.'.join( [
-            'simulator', 'log', 'actuator_'+'_'.join( map( str, actuators )) ] ),
-        '--address', address,
-        '    17 -     64 = 0',	# Coil           0x10   - 0x3F   (     1 +) (rounded to 16 bits)
-        ' 10065 -  10081 = 0',	# Discrete Input 0x40   - 0x50   ( 10001 +)
-        ' 76865 -  77376 = 0',	# Holding Regs   0x9000 - 0x911F ( 40001 +)
-        # Configure Modbus/RTU simulator to use specified port serial framing
-        '--config', json.dumps( {
-            'stopbits': smc.PORT_STOPBITS,
-            'bytesize': smc.PORT_BYTESIZE,
-            'parity':   smc.PORT_PARITY,
-            'baudrate': smc.PORT_BAUDRATE,
-            'slaves':	actuators,
-            'timeout':  smc.PORT_TIMEOUT,
-            'ignore_missing_slaves': True,
-        } )
-    ]
-
-    sys.exit( main_modbus_sim( argv=argv ))
+    running			= actuator_simulator( address, actuators, period=args.period, baudrate=args.baudrate )
+    logging.normal( "Simulating SMC actuators {actuators} on {address}".format(
+        actuators=actuators, address=next( running )))
+    try:
+        while True:
+            time.sleep( 1 )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        next( running, None ) # Shuts down the simulator
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -24,18 +24,28 @@ __email__                       = "perry@hardconsulting.com"
 __copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
 __license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
 
-__all__				= ["smc_modbus"]
+__all__				= ["smc_modbus", "smc_multi"]
 
+import contextlib
 import logging
+import os
 import struct
+import threading
 import time
+import traceback
 
 import cpppo
 import serial
 import tabulate
 
 from cpppo.remote.pymodbus_fixes import modbus_client_rtu, Defaults
-from cpppo.remote.plc_modbus import poller_modbus
+from cpppo.remote.plc_modbus import poller_modbus, merge
+from pymodbus.exceptions import ModbusException, ModbusIOException
+from pymodbus.pdu.register_message import WriteMultipleRegistersRequest
+
+# Any port may be an in-process virtual RS-485 bus endpoint, eg. rs485://test/0 (see protocol_rs485)
+if __package__ and __package__ not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append( __package__ )
 
 #
 # All the defaults supplied to smc_modbus().
@@ -47,9 +57,56 @@ PORT_STOPBITS			= 1
 PORT_BYTESIZE			= 8
 PORT_PARITY			= serial.PARITY_NONE
 PORT_BAUDRATE			= 38400
-PORT_TIMEOUT			= 0.075		# RS-485 I/O timeout
+PORT_TIMEOUT			= None		# RS-485 I/O timeout (None: derived; see rs485_timing)
+PORT_TURNAROUND			= 0.010		# Actuator's delay before responding to a request
+PORT_MARGIN			= 3		# Derived I/O timeout's multiple of the longest round trip
+RECV_INTERVAL_BUS		= 50e-6		# Response arrival check interval on an rs485:// bus
 
 POLL_RATE			= .5		# Nyquist Rate for 1Hz Updates
+POLL_REACH			= 100		# Merge addresses this close into a single read
+
+# Poll rates (in seconds) for each positioning phase of an actuator.  The active phases are entered
+# by the positioning handshakes while they await the actuator; between them, a unit's passive phase
+# is deduced from its polled status: 'busy' while moving, 'idle' when servo on, else 'svoff' (or
+# the smc_modbus rate=..., if offline or not yet polled).  An
+# active phase's rate lingers for POLL_LINGER seconds after it ends, to catch the ensuing changes.
+POLL_RATES			= dict(
+    svon			= .05,		# Awaiting X49_SVRE after Y19_SVON
+    seton			= .05,		# Awaiting X4A_SETON after Y1C_SETUP
+    data			= .05,		# Writing the D9102-D9111 step data
+    start			= .05,		# Awaiting D9100 operation start acknowledgement
+    busy			= .05,		# Awaiting X48_BUSY clear (motion complete)
+    alarm			= .05,		# Awaiting X4F_ALARM
+    write			= .05,		# Confirming the effects of a write
+    idle			= POLL_RATE,	# Servo on, not moving (defaults to smc_modbus rate=...)
+    svoff			= POLL_RATE * 4,# Servo off (defaults to 4x the smc_modbus rate=...)
+)
+POLL_LINGER			= 1.0
+
+
+def poll_rates( rate=POLL_RATE, rates=None ):
+    """The poll rate of each phase for a gateway polling at 'rate': the POLL_RATES, with the passive
+    'idle' and 'svoff' phases derived from 'rate', updated with any specific 'rates'."""
+    result			= dict( POLL_RATES, idle=rate, svoff=rate * 4 )
+    result.update( rates or {} )
+    return result
+
+# Per-transaction bus statistics (see smc_modbus.stats).  The response latency histogram's bucket
+# upper bounds (in seconds), and the interval between writes of any Prometheus textfile.
+STATS_BUCKETS			= ( .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5 )
+STATS_INTERVAL			= 15.0
+
+# Each transaction on a serial port is of one of these priority classes, highest first (see
+# bus_scheduler): 'command' writes (eg. SVON, step data, operation start), 'handshake' polls of a
+# unit awaiting a positioning handshake, and background 'status' polls.  Any transaction waiting
+# longer than its class' deadline (in seconds) is overdue, and is granted the bus first (oldest
+# first), so no class is starved.
+BUS_PRIORITIES			= ( 'command', 'handshake', 'status' )
+BUS_DEADLINES			= dict(
+    command			= .05,
+    handshake			= .25,
+    status			= 1.0,
+)
 
 
 # 
@@ -214,6 +271,854 @@ data.in_position.addr		= 40001 + 0x9110# == 77137 or 437137
 data.in_position.format		= 'i'		# == 77138 or 437138 (4 bytes, 2 words!)
 STEP_DATA_END		= 40001 + 0x9111
 
+# Running with step data No.
+# 
+# The controller stores up to 64 step data points, each in the same layout as D9102-D9111, at D0400 +
+# 10h * n.  A stored point is selected by its number (binary) on IN0-IN5, and started by a rising
+# edge of DRIVE (Y1A); the number of the point being driven is reported in D9006 (driving_data_no)
+# and on OUT0-OUT5.
+POINTS				= 64		# Step data points No. 0-63
+POINT_TABLE			= 40001 + 0x0400# == 41025; step data point No. 0
+POINT_SIZE			= STEP_DATA_END + 1 - STEP_DATA_BEG # == 16 registers per point
+POINT_SPAN			= 7		# Points per read/write (112 of the max. 123 registers)
+
+# Step data defaults, used to fill any gaps in a batched step data write (see smc_modbus.position)
+# when a value is neither supplied nor yet polled from the actuator.  These are the values from
+# the example in 7.3 Operation (P12) of LEC-OM02201; there is deliberately no default 'position'.
+data.movement_mode.default	= 1
+data.speed.default		= 500
+data.acceleration.default	= 5000
+data.deceleration.default	= 5000
+data.pushing_force.default	= 0
+data.trigger_level.default	= 0
+data.pushing_speed.default	= 20
+data.moving_force.default	= 100
+data.area_1.default		= 0
+data.area_2.default		= 0
+data.in_position.default	= 100
+
+
+class register_map( object ):
+    """A compiled view of a register map dotdict (eg. smc.data), built once.  Groups all field
+    addresses into the fewest contiguous Modbus read spans (using the same merge the poller uses to
+    build its reads), and decodes each whole span into every one of its fields in a single pass.
+
+    Each span is an (address, count, fields) tuple, where fields is a list of (name, offset, count,
+    codec); codec is a struct.Struct for multi-register 'format' fields, or None for simple values.
+    The big-endian 16-bit register struct.Struct for every field and span count is precompiled in
+    words, and the writable Y... (Coil) outputs are indexed in outputs by every suffix of their name
+    that no other output's name shares, eg. 'Y19_SVON', 'SVON' and 'VON'.
+
+    """
+    def __init__( self, data, reach=POLL_REACH ):
+        self.names		= list( data.iterkeys( depth=0 ))
+        self.fields		= {}		# {name: (address, count, codec), ...}
+        self.addresses		= []		# Every address occupied by a field, sorted
+        self.words		= {}		# {count: struct.Struct( '><count>H' ), ...}
+        self.outputs		= {}		# {'Y19_SVON': address, 'SVON': address, ...}
+        fields			= []		# [(address, name, count, codec), ...]
+        suffixes		= {}		# {'SVON': {'Y19_SVON'}, 'ON': {'Y19_SVON', ...}, ...}
+        for k in self.names:
+            addr		= data[k].addr
+            format		= data[k].get( 'format' )
+            codec		= None
+            count		= 1
+            if format is not None:
+                assert 40001 <= addr <= 100000 or 400001 <= addr, \
+                    "Must be a Holding Register address to support data format: %s" % k
+                codec		= struct.Struct( '>'+format )
+                count		= ( codec.size + 1 ) // 2
+            fields.append( (addr, k, count, codec) )
+            if k.startswith( 'Y' ):
+                for i in range( len( k )):
+                    suffixes.setdefault( k[i:], set() ).add( k )
+            self.fields[k]	= (addr, count, codec)
+            self.addresses.extend( range( addr, addr + count ))
+        self.addresses.sort()
+        fields.sort()
+        for suffix,names in suffixes.items():
+            if len( names ) == 1:
+                self.outputs[suffix] = data[names.pop()].addr
+
+        self.spans		= []		# [(address, count, [(name, offset, count, codec), ...]), ...]
+        for address,count in merge( ( (a,1) for a in self.addresses ), reach=reach ):
+            self.spans.append( ( address, count, [
+                ( k, a - address, n, codec )
+                for a,k,n,codec in fields
+                if address <= a < address + count
+            ] ))
+        for count in set( n for _,n,_ in self.fields.values() ) | set( n for _,n,_ in self.spans ):
+            self.words[count]	= struct.Struct( '>%dH' % count )
+
+    def decode( self, reader ):
+        """Decode every field, using reader( address, count ) to obtain each span's latest (host-ordered
+        16-bit register, or bit) values.  Any field with a missing (None) value decodes as None.
+
+        Multi-register fields arrive with the biggest end of the target format in the first
+        register, eg. for D9000 (current_position):
+
+            Sent: Read position data (D9000)
+                01 03 90 00 00 02 E9 0B
+            Reply:
+                01 03 04 00 00 3A 98 E9 39
+            3A98h = 15000 --> 150.00mm
+
+        So, the whole span is output as one big-endian buffer, and each format field is unpacked from
+        its offset within it.
+
+        """
+        result			= dict.fromkeys( self.names )
+        for address,count,fields in self.spans:
+            values		= reader( address, count )
+            buffer		= None
+            for k,offset,n,codec in fields:
+                if codec is None:
+                    result[k]	= values[offset]
+                    continue
+                if any( v is None for v in values[offset:offset+n] ):
+                    continue
+                if buffer is None:
+                    buffer	= self.words[count].pack( *( v or 0 for v in values ))
+                result[k]	= codec.unpack_from( buffer, offset * 2 )[0]
+        return result
+
+    def encode( self, values, address, count ):
+        """Encode the supplied {name: value, ...} into a list of the 'count' 16-bit registers
+        starting at 'address', biggest end first; any register not covered by a supplied field
+        remains None.
+
+        """
+        result			= [ None ] * count
+        for k,v in values.items():
+            addr,n,codec	= self.fields[k]
+            assert address <= addr and addr + n <= address + count, \
+                "Field %s (%d registers at %d) not within %d-%d" % ( k, n, addr, address, address + count - 1 )
+            if codec is None:
+                result[addr-address] = v
+            else:
+                result[addr-address:addr-address+n] = self.words[n].unpack( codec.pack( v ))
+        return result
+
+
+registers			= register_map( data )
+
+
+class rs485_timing( object ):
+    """A Modbus/RTU timing model of an RS-485 serial port's framing.  Derives the character time, the
+    inter-character and (3.5 character) inter-frame silent intervals (fixed at 750us and 1.75ms above
+    19200 baud, per the Modbus over Serial Line specification), and the expected round trip of each
+    request to an actuator (including its 'turnaround' delay before responding).
+
+    From these, an I/O 'timeout' allowing PORT_MARGIN times the longest round trip of polling the
+    'regmap' register map (default: registers), or writing its step data, and the minimum period (and so maximum rate) of
+    polling all of a number of actuators' registers are computed.
+
+    """
+    def __init__( self, baudrate=PORT_BAUDRATE, bytesize=PORT_BYTESIZE, parity=PORT_PARITY,
+                  stopbits=PORT_STOPBITS, turnaround=PORT_TURNAROUND, regmap=None ):
+        self.baudrate		= baudrate
+        self.bits		= 1 + bytesize + ( 0 if parity == serial.PARITY_NONE else 1 ) + stopbits
+        self.character		= self.bits / baudrate
+        self.interchar		= .00075 if baudrate > 19200 else 1.5 * self.character
+        self.interframe		= .00175 if baudrate > 19200 else 3.5 * self.character
+        self.turnaround		= turnaround
+        self.regmap		= regmap or registers
+
+    @staticmethod
+    def function( address, write=False, count=1 ):
+        """The Modbus function code used to read (or write) 'count' of the entities at 'address'."""
+        if 40001 <= address <= 99999:
+            return 16 if write else 3
+        if 10001 <= address <= 19999:
+            assert not write, "Discrete Inputs are not writable: %d" % ( address )
+            return 2
+        assert 1 <= address <= 9999, "Invalid Modbus address: %d" % ( address )
+        return ( 15 if count > 1 else 5 ) if write else 1
+
+    @staticmethod
+    def frames( function, count=1 ):
+        """The (request, response) RTU frame sizes in bytes (incl. unit, function and CRC) of a
+        transaction of 'count' bits/registers."""
+        return {
+            1:	( 8,		5 + ( count + 7 ) // 8 ),
+            2:	( 8,		5 + ( count + 7 ) // 8 ),
+            3:	( 8,		5 + 2 * count ),
+            5:	( 8,		8 ),
+            15:	( 9 + ( count + 7 ) // 8, 8 ),
+            16:	( 9 + 2 * count, 8 ),
+        }[function]
+
+    def round_trip( self, function, count=1 ):
+        """Expected seconds from the start of a request 'til the end of its response, and the silent
+        interval required before the next request may begin."""
+        request,response	= self.frames( function, count )
+        return ( request + response ) * self.character + self.turnaround + self.interframe * 2
+
+    def transactions( self, regmap=None ):
+        """The (function, count) of every transaction to poll the register map, and to write its step
+        data (incl. the operation start; see position( chain=True ))."""
+        return [ ( self.function( address ), count ) for address,count,_ in ( regmap or self.regmap ).spans ] \
+            + [ ( 16, STEP_DATA_END + 1 - data.operation_start.addr ) ]
+
+    @property
+    def timeout( self ):
+        """A sensible I/O timeout: PORT_MARGIN times the longest expected round trip."""
+        return PORT_MARGIN * max( self.round_trip( f, n ) for f,n in self.transactions() )
+
+    def poll_period( self, actuators=1, regmap=None ):
+        """The minimum seconds to poll all the register map's spans of each of 'actuators'."""
+        return actuators * sum( self.round_trip( f, n )
+                                for f,n in self.transactions( regmap )[:-1] )
+
+    def poll_rate( self, actuators=1, regmap=None ):
+        """The maximum achievable rate (in Hz) of polling all 'actuators' registers."""
+        return 1 / self.poll_period( actuators=actuators, regmap=regmap )
+
+
+def output( flag ):
+    """Return the (address, value) of the Y... (Coil) output 'flag' matching 'NAME' (set), or all
+    lower case 'name' (clear).  See smc_modbus.outputs."""
+    NAM				= flag.upper()
+    addr			= registers.outputs.get( NAM )
+    assert addr is not None and flag in (NAM,flag.lower()), "invalid key name %s" % ( flag )
+    return addr, 1 if flag == NAM else 0
+
+
+# Coils that trigger an action when set; never rewritten to bridge a gap between changed coils
+COIL_TRIGGERS			= ( data.Y1A_DRIVE.addr, data.Y1B_RESET.addr )
+
+
+def coil_writes( changes, image ):
+    """Coalesce the {address: value, ...} coil changes into the fewest contiguous [(address, [value,
+    ...]), ...] writes.  A gap between changed coils is bridged (rewriting the coils unchanged) only if
+    each of its coils' values is known from the 'image' (eg. a unit's shadow of the values it wrote
+    .get), and none of them is a COIL_TRIGGERS coil."""
+    writes			= []
+    for addr in sorted( changes ):
+        if writes:
+            start,values	= writes[-1]
+            between		= range( start + len( values ), addr )
+            gap			= [ None if a in COIL_TRIGGERS else image( a ) for a in between ]
+            if None not in gap:
+                values.extend( int( v ) for v in gap )
+                values.append( changes[addr] )
+                continue
+        writes.append( (addr, [ changes[addr] ]) )
+    return writes
+
+
+def step_keywords( kwds ):
+    """Ensure all the positioning keywords name step data D9102-D9111."""
+    for k,v in kwds.items():
+        assert k in data, \
+            "Unrecognized positioning keyword: %s == %r" % ( k, v )
+        assert STEP_DATA_BEG <= data[k].addr <= STEP_DATA_END, \
+            "Invalid positioning keyword: %s == %r; not within position data address range" % ( k, v )
+
+
+def step_data( kwds, status, chained=False ):
+    """Compile all the step data D9102-D9111 for a single multi-register write, filling gaps in the
+    positioning 'kwds' from the 'status' values, or from the data[...].default values.  If 'chained',
+    the write begins at D9100 with the operation start (D9101 is unused; 0).  Returns the (address,
+    values, registers) to write.
+
+    """
+    address			= data.operation_start.addr if chained else STEP_DATA_BEG
+    values			= {}
+    for k in registers.names:
+        if not STEP_DATA_BEG <= data[k].addr <= STEP_DATA_END:
+            continue
+        v			= kwds.get( k, status.get( k ))
+        if v is None:
+            v			= data[k].get( 'default' )
+        assert v is not None, \
+            "Missing positioning keyword: %s; no value supplied, polled or default" % ( k )
+        values[k]		= v
+    if chained:
+        values['operation_start'] = 0x0100
+    block			= [ 0 if r is None else r
+                                    for r in registers.encode( values, address, STEP_DATA_END + 1 - address ) ]
+    return address, values, block
+
+
+def point_address( point ):
+    """The address of the stored step data 'point'."""
+    assert 0 <= point < POINTS, \
+        "Invalid step data point No. %r; must be 0-%d" % ( point, POINTS - 1 )
+    return POINT_TABLE + POINT_SIZE * point
+
+
+def point_spans( points ):
+    """Group the step data point numbers into the fewest [(first, count), ...] runs of contiguous
+    points, each of at most POINT_SPAN points (ie. one read or write transaction each)."""
+    spans			= []
+    for p in sorted( set( points )):
+        point_address( p )
+        if spans and sum( spans[-1] ) == p and spans[-1][1] < POINT_SPAN:
+            spans[-1]		= ( spans[-1][0], spans[-1][1] + 1 )
+        else:
+            spans.append( (p, 1) )
+    return spans
+
+
+def point_decode( block ):
+    """Decode the POINT_SIZE registers of a stored step data point into its {name: value, ...}."""
+    result			= {}
+    for k in registers.names:
+        addr,n,codec		= registers.fields[k]
+        if not STEP_DATA_BEG <= addr <= STEP_DATA_END:
+            continue
+        values			= block[addr-STEP_DATA_BEG:addr-STEP_DATA_BEG+n]
+        result[k]		= values[0] if codec is None else codec.unpack( registers.words[n].pack( *values ))[0]
+    return result
+
+
+class snapshot( dict ):
+    """An immutable {name: value, ...} status of a unit, decoded from its polled data as of the unit's
+    .generation.  Being a dict, it may be JSON serialized, or copied (eg. dict( snapshot )) to modify.
+
+    """
+    __slots__			= ( 'generation', )
+
+    def __init__( self, values, generation=None ):
+        super( snapshot, self ).__init__( values )
+        self.generation		= generation
+
+    def immutable( self, *args, **kwds ):
+        raise TypeError( "A status snapshot is immutable" )
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = immutable
+
+
+class lazy( object ):
+    """Defers formatting of a log message argument until (unless) the record is emitted, eg.:
+
+        logging.info( "Status: %s", lazy( tabulate.tabulate, rows ))
+
+    """
+    __slots__			= ( 'function', 'args', 'kwds' )
+
+    def __init__( self, function, *args, **kwds ):
+        self.function		= function
+        self.args		= args
+        self.kwds		= kwds
+
+    def __str__( self ):
+        return str( self.function( *self.args, **self.kwds ))
+
+    __repr__			= __str__
+
+
+class smc_poller( poller_modbus ):
+    """A poller_modbus that can return a whole span of its latest polled values at once.
+
+    Every change to the polled data (or forgetting of a value) increments the poller's .generation,
+    and wakes anyone waiting on its .updated threading.Condition (which may be shared by several
+    pollers, eg. all the units on one gateway).  The decoded status snapshot is cached, and only
+    re-decoded once the .generation has advanced.
+
+    The poll rate adapts to the unit's current positioning phase (see POLL_RATES); a phase is
+    entered for the duration of a 'with <unit>.phase( "svon" ): ...', and the poller immediately
+    adopts its rate.  Otherwise, the self.rate is used for any phase missing from 'rates'.
+
+    A phase may declare the addresses its predicate depends on, eg. 'with <unit>.phase( "busy",
+    data.X48_BUSY.addr ): ...'.  While all active phases declare addresses, only those addresses are
+    polled at the phase's rate (first, and often); the full set of addresses continues to be polled,
+    but only at the rate of the unit's passive phase.
+
+    Each poll requests the bus as a 'handshake' transaction while the unit is in an active phase (or
+    is polling a phase's focus addresses), else as a background 'status' one; writes are 'command'
+    transactions (see bus_scheduler).
+
+    Unless 'shadow' is False, the values last successfully written to the Y... (Coils) and the step
+    data D9102-D9111 are remembered, and a write that would change none of them (and contradicts none
+    of their polled values) is dropped; eg. a repeated SVON, or the unchanged step data of a move
+    differing only in position.  The shadow is discarded when the unit is RESET, its ALARM changes, it
+    goes offline or its serial port is reconnected, or any polled value contradicts it (eg. after a
+    power cycle).  The number of writes dropped is counted in .dropped.
+
+    If supplied, phased( unit, phase, seconds ) is invoked as each phase ends, eg. to collect the
+    latencies of the positioning handshakes, and recorder.sample( unit, reader ) after each successful
+    poll, eg. to record the actuator's motion (see recorder.py).  Likewise, publisher.publish( unit,
+    poller ) after each poll, eg. to share its status with other processes (see publisher.py).
+
+    """
+    def __init__( self, description, updated=None, rates=None, linger=POLL_LINGER, phased=None,
+                  recorder=None, publisher=None, shadow=True, **kwds ):
+        self.generation		= 0
+        self.shadow		= {} if shadow else None # {address: value last written, ...}
+        self.dropped		= 0		# Writes dropped as redundant
+        self.updated		= threading.Condition() if updated is None else updated
+        self.rates		= dict( POLL_RATES if rates is None else rates )
+        self.linger		= linger
+        self.phases		= []		# Stack of active (phase, addresses)
+        self.lingering		= None,0	# (phase, until) after the last active phase ends
+        self.wakeup		= threading.Event()
+        self.phased		= phased
+        self.recorder		= recorder
+        self.publisher		= publisher
+        self.snapshot		= None		# The cached status snapshot
+        super( smc_poller, self ).__init__( description, **kwds ) # starts the poller Thread
+
+    @contextlib.contextmanager
+    def phase( self, name, *addresses ):
+        """Poll at the rate of the named phase for the duration; if any 'addresses' are supplied, poll
+        just those at that rate."""
+        entry			= name,addresses
+        began			= cpppo.timer()
+        self.phases.append( entry )
+        self.wakeup.set()
+        try:
+            yield self
+        finally:
+            ended		= cpppo.timer()
+            self.phases.remove( entry )
+            self.lingering	= name,ended + self.linger
+            self.wakeup.set()
+            if self.phased:
+                self.phased( self.unit, name, ended - began )
+
+    def focus( self ):
+        """The set of addresses the active phases depend on; empty if none (or any phase needs all)."""
+        phases			= list( self.phases )
+        if not phases or not all( addresses for _,addresses in phases ):
+            return set()
+        return set( a for _,addresses in phases for a in addresses )
+
+    @staticmethod
+    def shadowed( address ):
+        """If writes to the address are shadowed: the Y... (Coils) except RESET, and step data D9102-D9111."""
+        return ( 1 <= address < 10001 and address != data.Y1B_RESET.addr
+                 or STEP_DATA_BEG <= address <= STEP_DATA_END )
+
+    def invalidate( self, reason ):
+        """Discard the shadow of the values written; the next write of each is performed."""
+        if self.shadow:
+            logging.detail( "%s shadow invalidated: %s", self.description, reason )
+            self.shadow.clear()
+
+    def redundant( self, address, values ):
+        """If writing the values would change nothing, as far as the shadow and polled data indicate."""
+        if self.shadow is None:
+            return False
+        for a,v in enumerate( values, address ):
+            polled		= self._data.get( a )
+            if not self.shadowed( a ) or a not in self.shadow or self.shadow[a] != v \
+               or ( polled is not None and polled != v ):
+                return False
+        return True
+
+    def write( self, address, value, **kwargs ):
+        values			= list( value ) if hasattr( value, '__iter__' ) else [ value ]
+        if self.redundant( address, values ):
+            logging.detail( "%s/%6d == (%3d) %s; unchanged", self.description, address, len( values ),
+                            cpppo.reprlib.repr( value ))
+            self.dropped       += 1
+            return
+        if self.shadow is not None:
+            for a in range( address, address + len( values )):
+                self.shadow.pop( a, None ) # Unknown, 'til the write succeeds
+        with self.phase( 'write' ), self.client.priority( 'command' ):
+            super( smc_poller, self ).write( address, value, **kwargs )
+        if self.shadow is None:
+            return
+        if address <= data.Y1B_RESET.addr < address + len( values ):
+            self.invalidate( "RESET" )
+            return
+        for a,v in enumerate( values, address ):
+            if self.shadowed( a ):
+                self.shadow[a]	= v
+
+    def current( self ):
+        """Deduce the unit's current positioning phase; None if unknown."""
+        phases			= list( self.phases )
+        if phases:
+            return phases[-1][0]
+        name,until		= self.lingering
+        if name and cpppo.timer() < until:
+            return name
+        return self.passive()
+
+    def passive( self ):
+        """Deduce the unit's passive phase from its polled status; None if unknown."""
+        if not self.online:
+            return None
+        if self._data.get( data.X48_BUSY.addr ):
+            return 'busy'
+        svre			= self._data.get( data.X49_SVRE.addr )
+        if svre is None:
+            return None
+        return 'idle' if svre else 'svoff'
+
+    def interval( self, phase=None ):
+        """The poll interval for the unit's current (or the specified) phase."""
+        return self.rates.get( self.current() if phase is None else phase, self.rate )
+
+    def _poller( self, *args, **kwargs ):
+        """Poll all the known registers, at the rate appropriate to the unit's current phase.  Unlike
+        poller_modbus, a change of phase takes effect immediately, even in the midst of awaiting the
+        next poll.  Any focus addresses are polled first, at the current phase's rate, and the rest
+        at the passive phase's rate.
+
+        """
+        logging.info( "Poller starts: %r, %r ", args, kwargs )
+        polled			= None		# Last poll of all addresses
+        focused			= None		#   and of just the focus addresses
+        while not self.done and logging:	# Module may be gone in shutting down
+            if not self._data:
+                self.wakeup.wait( .1 )
+                self.wakeup.clear()
+                continue
+            focus		= self.focus()
+            rate		= self.interval()
+            every		= self.interval( self.passive() ) if focus else rate
+            now			= cpppo.timer()
+            if focus and ( focused is None or now >= focused + rate ):
+                focused		= now
+                self._poll_ranges( set( merge( ( (a,1) for a in focus ), reach=self.reach )), rate,
+                                   every=False )
+                continue
+            if polled is None or now >= polled + every:
+                if polled is not None and now - polled > 2 * every:
+                    logging.info( "Polling: PLC %s slipped; %.3fs since last poll at %.3fs rate",
+                                  self.description, now - polled, every )
+                polled		= focused = now
+                self._poll_ranges( set( merge( ( (a,1) for a in self._data ), reach=self.reach )), every )
+                continue
+            self.wakeup.wait( min( polled + every, focused + rate if focus else polled + every ) - now )
+            self.wakeup.clear()
+
+    def _poll_ranges( self, rngs, rate, every=True ):
+        """Poll the (address,count) ranges once, maintaining online state.  If polling 'every' known
+        address, also maintain the polling statistics and load."""
+        succ			= set()
+        fail			= set()
+        busy			= 0.0 # time spent polling (excluding time blocked, ie. writes)
+        # Polls of a unit awaiting a positioning handshake precede the background status polls
+        priority		= 'handshake' if not every or self.phases else 'status'
+        for address, count in rngs:
+            with self.client.priority( priority ), self.client: # block 'til scheduled
+                begin		= cpppo.timer()
+                try:
+                    value	= self._read( address, count, unit=self.unit )
+                    if not self.online:
+                        self.online = True
+                        logging.critical( "Polling: PLC %s online; success polling %s: %s",
+                                          self.description, address, cpppo.reprlib.repr( value ))
+                        self.changed()
+                    if every and (address,count) not in self.polling:
+                        logging.detail( "Polling: PLC %s %6d-%-6d (%5d)", self.description,
+                                        address, address+count-1, count )
+                    succ.add( (address, count) )
+                    self._store( address, value, create=False ) # Handle scalar or list/tuple value(s)
+                except ModbusException as exc:
+                    fail.add( (address, count) )
+                    if ( (address, count) not in self.failing ) if every else self.online:
+                        logging.warning( "Failing: PLC %s %6d-%-6d (%5d): %s", self.description,
+                                         address, address+count-1, count, str( exc ))
+                except Exception:
+                    fail.add( (address, count) )
+                    logging.warning( "Failing: PLC %s %6d-%-6d (%5d): %s", self.description,
+                                     address, address+count-1, count, traceback.format_exc() )
+                busy	       += cpppo.timer() - begin
+
+        if succ and self.recorder:
+            self.recorder.sample( self.unit, self._data.get )
+
+        if self._data and not succ and self.online:
+            logging.critical( "Polling: PLC %s offline", self.description )
+            self.online		= False
+            self.invalidate( "offline" )
+            self.changed()
+        if self.publisher:
+            self.publisher.publish( self.unit, self )
+        if not every:
+            return
+
+        for address, count in self.polling - succ - fail:
+            logging.info( "Ceasing: PLC %s %6d-%-6d (%5d)", self.description,
+                          address, address+count-1, count )
+        self.polling		= succ
+        self.failing		= fail
+        self.duration		= busy
+
+        # The load is the proportion of the current poll rate consumed by poll activity, over
+        # approximately the last 1, 5 and 15 minutes worth of polls.
+        load			= ( busy / rate ) if rate > 0 else 1.0
+        ppm			= ( 60.0 / rate ) if rate > 0 else 1.0
+        self.load		= tuple(
+            cpppo.exponential_moving_average( cur, load, 1.0 / ( minutes * ppm ))
+            for minutes,cur in zip((1, 5, 15), self.load ))
+        self.counter	       += 1
+
+    def changed( self ):
+        """Polled data has changed; notify anyone waiting for fresh data."""
+        with self.updated:
+            self.generation    += 1
+            self.updated.notify_all()
+
+    def _store( self, address, value, create=True ):
+        values			= value if hasattr( value, '__getitem__' ) else [ value ]
+        before			= [ self._data.get( address + o ) for o in range( len( values )) ]
+        if self.shadow:
+            for a,v in enumerate( values, address ):
+                if a == data.X4F_ALARM.addr and before[a - address] is not None and v != before[a - address]:
+                    self.invalidate( "ALARM %s" % ( "set" if v else "clear" ))
+                elif a in self.shadow and v is not None and v != self.shadow[a]:
+                    self.invalidate( "%6d polled %r; written %r" % ( a, v, self.shadow[a] ))
+                if not self.shadow:
+                    break
+        super( smc_poller, self )._store( address, value, create=create )
+        if any( self._data.get( address + o ) != v for o,v in enumerate( before )):
+            self.changed()
+
+    def _forget( self, address ):
+        super( smc_poller, self )._forget( address )
+        self.changed()
+
+    def span( self, address, count ):
+        """Return the latest known values for the 'count' addresses starting at 'address'; None for
+        any address not (yet) polled, or for all of them if offline."""
+        self._receive()
+        if not self.online:
+            return [ None ] * count
+        return [ self._data.get( a ) for a in range( address, address + count ) ]
+
+    def status( self ):
+        """The status snapshot of all the register map's decoded values, as of the current generation."""
+        self._receive()
+        generation		= self.generation
+        cached			= self.snapshot
+        if cached is None or cached.generation != generation:
+            cached		= self.snapshot = snapshot( registers.decode( self.span ), generation )
+        return cached
+
+
+class positioning( threading.Thread ):
+    """An in-progress gateway.position( **kwds ) of one actuator, performed in its own Thread, so that
+    the positioning handshakes of several actuators may be interleaved on the same bus, and their
+    motions overlap.
+
+    """
+    def __init__( self, gateway, **kwds ):
+        self.gateway		= gateway
+        self.kwds		= kwds
+        self.actuator		= kwds.get( 'actuator', 1 )
+        self.status		= None
+        self.error		= None
+        super( positioning, self ).__init__( name="SMC %s position" % ( self.actuator ))
+        self.daemon		= True
+        self.start()
+
+    def run( self ):
+        try:
+            self.status		= self.gateway.position( **self.kwds )
+        except Exception as exc:
+            self.error		= exc
+
+    def wait( self, timeout=None, complete=False ):
+        """Await the positioning, returning its status (or raising its failure).  If 'complete', also
+        await completion of the actuator's motion w/in 'timeout' (default: the gateway's TIMEOUT)."""
+        self.join( timeout=timeout )
+        assert not self.is_alive(), \
+            "Failed to complete actuator %s positioning within timeout %r" % ( self.actuator, timeout )
+        if self.error is not None:
+            raise self.error
+        if complete:
+            assert self.gateway.complete( actuator=self.actuator, timeout=timeout ), \
+                "Current actuator %s position incomplete within timeout %r" % ( self.actuator, timeout )
+            self.status		= self.gateway.status( actuator=self.actuator )
+        return self.status
+
+    @staticmethod
+    def wait_all( handles, timeout=None, complete=False ):
+        """Await all the positioning handles, returning a list of their statuses.  Waits for every one,
+        even if some fail; then, raises the first failure (if any)."""
+        statuses,errors		= [],[]
+        for h in handles:
+            try:
+                statuses.append( h.wait( timeout=timeout, complete=complete ))
+            except Exception as exc:
+                statuses.append( None )
+                errors.append( exc )
+        if errors:
+            raise errors[0]
+        return statuses
+
+
+class transaction_stats( object ):
+    """Counters and a response latency histogram of the Modbus transactions with each unit, by function
+    code.  Each transaction is a request, and its outcome is one of its responses, exceptions (a
+    Modbus exception response), or a failure.  Each failed attempt (including those retried) is
+    counted as one of its timeouts (nothing received), or errors (something received, but no valid
+    response frame; eg. a CRC or framing error).  The bytes sent and received on the wire include
+    all attempts.
+
+    """
+    COUNTERS			= ( 'requests', 'responses', 'exceptions', 'failures', 'timeouts', 'errors',
+                                    'retries', 'sent', 'received' )
+
+    def __init__( self, buckets=STATS_BUCKETS ):
+        self.buckets		= buckets
+        self.lock		= threading.Lock()
+        self.units		= {}		# {unit: {function: {counter: #, ..., latency: {...}}}}
+
+    def record( self, unit, function, latency, outcome, **counts ):
+        """Record a transaction's latency and 'outcome' (responses, exceptions or failures), and add any
+        other 'counts' (eg. timeouts=1, sent=8)."""
+        with self.lock:
+            stats		= self.units.setdefault( unit, {} ).get( function )
+            if stats is None:
+                stats		= self.units[unit][function] = dict.fromkeys( self.COUNTERS, 0 )
+                stats['latency'] = dict( sum=0.0, count=0, buckets=[ 0 ] * len( self.buckets ))
+            stats['requests']  += 1
+            stats[outcome]     += 1
+            for k,v in counts.items():
+                stats[k]       += v
+            stats['latency']['sum'] += latency
+            stats['latency']['count'] += 1
+            for i,le in enumerate( self.buckets ):
+                if latency <= le:
+                    stats['latency']['buckets'][i] += 1
+                    break
+
+    def stats( self ):
+        """Returns a copy of the {unit: {function: {counter: #, ..., latency: {sum, count, buckets}}}}.
+        The latency buckets are cumulative, eg. {.005: 3, .01: 7, ...}, as for a Prometheus histogram.
+
+        """
+        with self.lock:
+            result		= {}
+            for unit,functions in self.units.items():
+                for function,stats in functions.items():
+                    copy	= dict( stats )
+                    cumulative	= 0
+                    copy['latency'] = dict( sum=stats['latency']['sum'], count=stats['latency']['count'],
+                                            buckets={} )
+                    for le,n in zip( self.buckets, stats['latency']['buckets'] ):
+                        cumulative += n
+                        copy['latency']['buckets'][le] = cumulative
+                    result.setdefault( unit, {} )[function] = copy
+            return result
+
+
+def prometheus( stats ):
+    """Render the {port: {unit: {function: ...}}} transaction statistics (see transaction_stats.stats)
+    in the Prometheus text exposition format."""
+    lines			= []
+    for counter in transaction_stats.COUNTERS:
+        name			= "smc_modbus_%s%s_total" % ( 'bytes_' if counter in ( 'sent', 'received' ) else '', counter )
+        lines.append( "# TYPE %s counter" % ( name ))
+        for port,units in sorted( stats.items() ):
+            for unit,functions in sorted( units.items() ):
+                for function,values in sorted( functions.items() ):
+                    lines.append( '%s{port="%s",unit="%s",function="%s"} %d' % (
+                        name, port, unit, function, values[counter] ))
+    name			= "smc_modbus_latency_seconds"
+    lines.append( "# TYPE %s histogram" % ( name ))
+    for port,units in sorted( stats.items() ):
+        for unit,functions in sorted( units.items() ):
+            for function,values in sorted( functions.items() ):
+                labels		= 'port="%s",unit="%s",function="%s"' % ( port, unit, function )
+                latency		= values['latency']
+                for le,n in latency['buckets'].items():
+                    lines.append( '%s_bucket{%s,le="%s"} %d' % ( name, labels, le, n ))
+                lines.append( '%s_bucket{%s,le="+Inf"} %d' % ( name, labels, latency['count'] ))
+                lines.append( '%s_sum{%s} %.6f' % ( name, labels, latency['sum'] ))
+                lines.append( '%s_count{%s} %d' % ( name, labels, latency['count'] ))
+    return "\n".join( lines ) + "\n"
+
+
+class stats_textfile( threading.Thread ):
+    """Periodically (and finally, when closed) write a gateway's .prometheus() statistics to a textfile,
+    eg. for the Prometheus node_exporter textfile collector.  Each write atomically replaces the file.
+
+    """
+    def __init__( self, gateway, path, interval=STATS_INTERVAL ):
+        super( stats_textfile, self ).__init__( name="SMC stats: %s" % ( path ))
+        self.gateway		= gateway
+        self.path		= path
+        self.interval		= interval
+        self.done		= threading.Event()
+        self.daemon		= True
+        self.start()
+
+    def run( self ):
+        while not self.done.wait( self.interval ):
+            self.write()
+
+    def write( self ):
+        try:
+            with open( self.path + '.tmp', 'w' ) as f:
+                f.write( self.gateway.prometheus() )
+            os.replace( self.path + '.tmp', self.path )
+        except Exception as exc:
+            logging.warning( "Failed to write statistics to %s: %s", self.path, exc )
+
+    def close( self ):
+        self.done.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join( timeout=1 )
+        self.write()
+
+
+class bus_scheduler( object ):
+    """Grants a serial port to one transaction at a time, in priority order.  Replaces the client's
+    plain lock, so each poller Thread's reads and each foreground write request the bus with their
+    BUS_PRIORITIES class; when released, the bus is handed directly to the highest priority waiter
+    (the oldest, of equal priority).  Any waiter overdue by its class' deadline goes first.
+
+    The .stats() of each class count its transactions, the total and maximum seconds waited for the
+    bus, and those granted because overdue.
+
+    """
+    def __init__( self, deadlines=None ):
+        self.deadlines		= dict( BUS_DEADLINES, **( deadlines or {} ))
+        self.lock		= threading.Lock()
+        self.busy		= False
+        self.waiting		= []		# [(rank, arrival, threading.Event), ...] in arrival order
+        self.counters		= dict( (p, dict( count=0, wait=0.0, maximum=0.0, overdue=0 ))
+                                        for p in BUS_PRIORITIES )
+
+    def acquire( self, priority ):
+        rank			= BUS_PRIORITIES.index( priority )
+        arrival			= cpppo.timer()
+        with self.lock:
+            if not self.busy:
+                self.busy	= True
+                self.counters[priority]['count'] += 1
+                return
+            waiter		= rank,arrival,threading.Event()
+            self.waiting.append( waiter )
+        waiter[2].wait()
+        waited			= cpppo.timer() - arrival
+        with self.lock:
+            counters		= self.counters[priority]
+            counters['count']  += 1
+            counters['wait']   += waited
+            counters['maximum']	= max( counters['maximum'], waited )
+
+    def release( self ):
+        with self.lock:
+            if not self.waiting:
+                self.busy	= False
+                return
+            now			= cpppo.timer()
+            overdue		= [ w for w in self.waiting
+                                    if now - w[1] > self.deadlines[BUS_PRIORITIES[w[0]]] ]
+            if overdue:
+                waiter		= overdue[0]
+                self.counters[BUS_PRIORITIES[waiter[0]]]['overdue'] += 1
+            else:
+                waiter		= min( self.waiting, key=lambda w: w[:2] )
+            self.waiting.remove( waiter )
+            waiter[2].set()	# The bus remains busy; handed to the waiter
+
+    def stats( self ):
+        """A copy of each priority class' {count, wait, maximum, overdue}."""
+        with self.lock:
+            return dict( (p, dict( c )) for p,c in self.counters.items() )
+
 
 class smc_modbus( modbus_client_rtu ):
     """Drive a set of SMC actuators via direct Modbus/RTU protocol to the individual actuator
@@ -224,7 +1129,16 @@ class smc_modbus( modbus_client_rtu ):
 
     def __init__( self, address=PORT_MASTER, timeout=PORT_TIMEOUT, baudrate=PORT_BAUDRATE,
                   stopbits=PORT_STOPBITS, bytesize=PORT_BYTESIZE, parity=PORT_PARITY,
-                  rate=POLL_RATE ):
+                  rate=POLL_RATE, rates=None, linger=POLL_LINGER, batch=False, chain=False, phased=None,
+                  textfile=None, interval=STATS_INTERVAL, recorder=None, publisher=None, deadlines=None,
+                  shadow=True, bus_units=None ):
+        self.timing		= rs485_timing( baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                                stopbits=stopbits )
+        if timeout is None:
+            timeout		= self.timing.timeout
+        if rate < self.timing.poll_period():
+            logging.warning( "Poll rate %.3fs is faster than the %.3fs required to poll an actuator at %d baud",
+                             rate, self.timing.poll_period(), baudrate )
         Defaults.Timeout	= timeout	# RS-485 I/O timeout
 
         super( smc_modbus, self, ).__init__(
@@ -232,7 +1146,23 @@ class smc_modbus( modbus_client_rtu ):
             parity=parity, baudrate=baudrate, timeout=timeout )
 
         self.pollers		= {} # {unit#: <poller_modbus>,}
+        self.updated		= threading.Condition() # Notified when any unit's polled data changes
         self.rate		= rate
+        self.rates		= poll_rates( rate, rates )	# Poll rate for each phase
+        self.linger		= linger
+        self.batch		= batch		# position() step data in one multi-register write
+        self.chain		= chain		#   including the D9100 operation start
+        self.shadow		= shadow	# Drop redundant Y... and step data writes (see smc_poller)
+        self.phased		= phased	# Invoked w/ ( unit, phase, seconds ) as each phase ends
+        self.recorder		= recorder	# Records each unit's motion as polled (see recorder.py)
+        self.publisher		= publisher	# Shares each unit's status with other processes (see publisher.py)
+        self.device		= address
+        self.bus_units		= bus_units	# Every unit on the serial port, if declared (see trigger)
+        self.statistics		= transaction_stats()
+        self.attempt		= None		# The current transaction's attempts, bytes sent/received
+        self.scheduler		= bus_scheduler( deadlines )
+        self.scheduled		= threading.local() # Each Thread's current transaction .priority
+        self.textfile		= None if textfile is None else stats_textfile( self, textfile, interval )
 
     def close( self ):
         """Shut down all poller_modbus threads before closing serial port.  We might be getting
@@ -244,83 +1174,206 @@ class smc_modbus( modbus_client_rtu ):
                 poller.join( timeout=1 )
             except RuntimeError:
                 pass
+        if getattr( self, 'textfile', None ):
+            self.textfile.close()
         super( smc_modbus, self ).close()
 
     __del__			= close
 
     def __repr__( self ):
+        """Tabulates every unit's status; only re-formatted once some unit's status snapshot changes."""
+        statuses		= [ (uid, unit.description, self.status( actuator=uid ))
+                                    for uid,unit in list( self.pollers.items() ) ]
+        generations		= tuple( (uid, status.generation) for uid,_,status in statuses )
+        cached			= getattr( self, 'formatted', None )
+        if cached and cached[0] == generations:
+            return cached[1]
         row			= {}
-        for uid,unit in self.pollers.items():
-            row.setdefault( '', [] ).append( unit.description )
-            for k,v in self.status( actuator=uid ).items():
+        for uid,description,status in statuses:
+            row.setdefault( '', [] ).append( description )
+            for k,v in status.items():
                 row.setdefault( k, [] ).append( v )
         out			= []
         for label in sorted( row ):
             out.append( "%20s: %s" % ( label, ''.join( "%8s" % ( col ) for col in row[label] )))
-        return "SMC Modbus/RTU Gateway" + ( ":\n" if out else "" ) + "\n".join( out )
+        formatted		= "SMC Modbus/RTU Gateway" + ( ":\n" if out else "" ) + "\n".join( out )
+        self.formatted		= generations,formatted
+        return formatted
+
+    @contextlib.contextmanager
+    def priority( self, name ):
+        """Request the bus for this Thread's transactions with the named BUS_PRIORITIES class, eg.:
+
+            with client.priority( 'status' ), client:
+                ... # the transaction
+
+        Otherwise, transactions are of the 'command' class.
+
+        """
+        assert name in BUS_PRIORITIES, \
+            "Unknown bus priority %r; expected one of %s" % ( name, ', '.join( BUS_PRIORITIES ))
+        prior			= getattr( self.scheduled, 'priority', None )
+        self.scheduled.priority	= name
+        try:
+            yield self
+        finally:
+            self.scheduled.priority = prior
+
+    def __enter__( self ):
+        """Block 'til the bus scheduler grants this Thread's transaction the serial port."""
+        self.scheduler.acquire( getattr( self.scheduled, 'priority', None ) or 'command' )
+        return self
+
+    def __exit__( self, typ, val, tbk ):
+        self.scheduler.release()
+        return False
+
+    @contextlib.contextmanager
+    def transfer( self, function, count ):
+        """Hold the bus for a 'command' transaction of the Modbus 'function' on 'count' registers (eg. of
+        the point table), with the I/O timeout extended to PORT_MARGIN times its expected round trip,
+        if longer than usual.  Use the pollers' unlocked _read/_write within."""
+        with self.priority( 'command' ), self:
+            usual		= self.comm_params.timeout_connect
+            self.comm_params.timeout_connect = max( usual, PORT_MARGIN * self.timing.round_trip( function, count ))
+            try:
+                yield self
+            finally:
+                self.comm_params.timeout_connect = usual
+
+    def connect( self ):
+        """An unpaced in-process virtual RS-485 bus (see protocol_rs485) delivers each frame whole, so
+        need not await an inter-frame silence to detect the end of a response.  Once reconnected, the
+        actuators' state is unknown, so their pollers' shadows of written values are discarded."""
+        wasconnected		= self.connected
+        connected		= super( smc_modbus, self ).connect()
+        if connected and not wasconnected:
+            if getattr( self.socket, 'bus', None ) and not self.socket.pace:
+                self._recv_interval = RECV_INTERVAL_BUS
+            for poller in list( self.pollers.values() ):
+                poller.invalidate( "reconnected" )
+        return connected
+
+    def execute( self, no_response_expected=False, request=None ):
+        """Execute a Modbus transaction, recording its statistics (see stats).  The pollers' client lock
+        ensures only one transaction at a time is underway."""
+        self.attempt		= dict( sends=0, sent=0, received=0, timeouts=0, errors=0, heard=0 )
+        outcome			= 'failures'
+        begin			= cpppo.timer()
+        try:
+            response		= super( smc_modbus, self ).execute( no_response_expected, request )
+            outcome		= 'exceptions' if response.isError() and not no_response_expected else 'responses'
+            return response
+        except ModbusIOException:
+            self.failed()
+            raise
+        finally:
+            attempt		= self.attempt
+            self.attempt	= None
+            self.statistics.record(
+                request.dev_id, request.function_code, cpppo.timer() - begin, outcome,
+                timeouts=attempt['timeouts'], errors=attempt['errors'],
+                retries=max( 0, attempt['sends'] - 1 ), sent=attempt['sent'], received=attempt['received'] )
+
+    def failed( self ):
+        """The current transaction's last attempt failed; was anything received?"""
+        if self.attempt['sends']:
+            self.attempt['errors' if self.attempt['heard'] else 'timeouts'] += 1
+
+    def send( self, request, addr=None ):
+        size			= super( smc_modbus, self ).send( request, addr=addr )
+        if self.attempt is not None and request:
+            self.failed()		# If a retry, the prior attempt failed
+            self.attempt['sends'] += 1
+            self.attempt['sent'] += size
+            self.attempt['heard'] = 0
+        return size
+
+    def recv( self, size ):
+        result			= super( smc_modbus, self ).recv( size )
+        if self.attempt is not None:
+            self.attempt['received'] += len( result )
+            self.attempt['heard'] += len( result )
+        return result
+
+    def stats( self ):
+        """The Modbus transaction statistics of each unit on this gateway's serial port, by function code
+        (see transaction_stats.stats)."""
+        return self.statistics.stats()
+
+    def prometheus( self ):
+        """The transaction statistics, in the Prometheus text exposition format."""
+        return prometheus( { self.device: self.stats() } )
+
+    def recover( self, *actuators ):
+        """Recover from a (probably transient) failure involving the given actuators (all, if none),
+        without tearing down the gateway: discard any partial frames from the serial line, and
+        restart only those units' pollers, with freshly polled data.  Returns True iff the serial port
+        is (re)connected.
+
+        """
+        for uid in actuators or list( self.pollers ):
+            poller		= self.pollers.pop( uid, None )
+            if poller:
+                poller.done	= True
+                poller.wakeup.set()
+                try:
+                    poller.join( timeout=1 )
+                except RuntimeError:
+                    pass
+            logging.normal( "Recover:  actuator %3d poller restarted", uid )
+            self.unit( uid=uid )
+        with self: # block 'til we can resynchronize the serial line between transactions
+            if self.socket:
+                self.socket.reset_output_buffer()
+                self.socket.reset_input_buffer()
+            return self.connect()
 
     def unit( self, uid ):
         """Return the poller to access data for the given unit uid."""
         if uid not in self.pollers:
-            self.pollers[uid]	= poller_modbus( "SMC %s" % ( uid ), client=self,
-                                                 multi=True, unit=uid, rate=self.rate )
+            unit		= smc_poller( "SMC %s" % ( uid ), client=self, reach=POLL_REACH,
+                                              multi=True, unit=uid, rate=self.rate, updated=self.updated,
+                                              rates=self.rates, linger=self.linger, phased=self.phased,
+                                              recorder=self.recorder, publisher=self.publisher,
+                                              shadow=self.shadow )
+            # Establish polling of every address in the register map, so the poller's merged reads
+            # are the compiled spans from the very first poll.
+            for a in registers.addresses:
+                unit.poll( a )
+            self.pollers[uid]	= unit
         return self.pollers[uid]
-    
+
     def status( self, actuator=1 ):
-        """Decode the raw position data, status and control indicators, returning all status values as a
-        dictionary.  Will return None for any values not yet polled (or when communications fails).
+        """Decode the raw position data, status and control indicators, returning all status values as an
+        immutable snapshot dictionary.  Will return None for any values not yet polled (or when
+        communications fails).  Unless the unit's polled data has changed, the same snapshot is returned.
 
         """
-        unit			= self.unit( uid=actuator )
-        result			= {}
+        return self.unit( uid=actuator ).status()
 
-        # Roughly equivalent to dict key iteration, rather than dotdict full-depth keys            
-        for k in data.iterkeys( depth=0 ):
-            addr		= data[k].addr
-            format		= data[k].get( 'format' )
-            values		= [ unit.read( data[k].addr ) ]
-            if format is None:
-                # Simple data value (eg. Coil, Discrete, simple value)
-                result[k]	= values[0]
-                continue
-            # A 'struct' format; get all necessary values from subsequent addresses
-            assert 40001 <= addr <= 100000 or 400001 <= addr, "Must be a Holding Register address to support data format"
-            while 2 * len( values ) < struct.calcsize( format ):
-                addr	       += 1
-                values.append( unit.read( addr ))
-            if any( v is None for v in values ):
-                result[k]	= None
-                continue
-
-            # Got all required values.  Decode each host-ordered 16-bit register into l, and then 
-            # encode in desired format.  Here's an example:
-            # 
-            # Sent: Read position data (D9000)
-            #     01 03 90 00 00 02 E9 0B
-            # Reply:
-            #     01 03 04 00 00 3A 98 E9 39
-            # 3A98h = 15000 --> 150.00mm
-
-            # So, output each 16-bit register in big-endian order (assumes biggest end of target
-            # format comes in first register), and then unpack big-endian buffer into target format.
-            buffer		= b''.join( struct.pack( '>H', v ) for v in values )
-            result[k]		= struct.unpack( '>'+format, buffer )[0]
-
-        return result
+    def generation( self ):
+        """The total number of changes to all units' polled data"""
+        return sum( unit.generation for unit in list( self.pollers.values() ))
 
     def check( self, predicate, deadline=None ):
-        """Check if 'predicate' comes True before 'deadline', every self.rate seconds"""
+        """Check if 'predicate' comes True before 'deadline'.  It is re-evaluated as soon as any unit's
+        polled data changes, or at least every self.rate seconds."""
+        start			= logged = cpppo.timer()
+        seen			= self.generation()
         done			= predicate()
-        start			= cpppo.timer()
         while not done and ( deadline is None or cpppo.timer() < deadline ):
-            time.sleep( self.rate if deadline is None
+            with self.updated:
+                self.updated.wait_for(
+                    lambda: self.generation() != seen,
+                    timeout=self.rate if deadline is None
                         else min( self.rate, max( 0, deadline - cpppo.timer() )))
-            if logging.getLogger().isEnabledFor( logging.INFO ):
-                logging.info( "After {dur:7.2f}s of {ded}:\n{tab}".format(
-                    dur		= cpppo.timer() - start,
-                    ded		= None if not deadline else round( deadline - start, 2 ),
-                    tab		= tabulate.tabulate( self.status().items(), headers=["I/O", "Value"], tablefmt='orgtbl' )
-                ))
+            seen		= self.generation()
+            if cpppo.timer() >= logged + self.rate and logging.getLogger().isEnabledFor( logging.INFO ):
+                logged		= cpppo.timer()
+                logging.info( "After %7.2fs of %s:\n%s", logged - start,
+                              None if not deadline else round( deadline - start, 2 ),
+                              lazy( tabulate.tabulate, self.status().items(), headers=["I/O", "Value"], tablefmt='orgtbl' ))
             done		= predicate()
         return done
 
@@ -338,19 +1391,56 @@ class smc_modbus( modbus_client_rtu ):
             JOG_PLUS
             INPUT_INVALID
 
+        The changes are coalesced into as few (multiple) coil writes as possible, each spanning a
+        contiguous range of coils; any unchanged coils within a range are rewritten with the values
+        last written to them, as remembered in the unit's shadow (never with possibly stale polled
+        values, and never DRIVE or RESET; see coil_writes).  A flag repeated (eg. "RESET", "reset") begins a following write, so
+        the changes to each coil are made in order.  Returns the latest polled status.
+
         """
         unit			= self.unit( uid=actuator )
+        image			= ( unit.shadow or {} ).get
+        batches			= [ {} ]
         for f in flags:
-            NAM			= f.upper()
-            nam			= f.lower()
-            key			= [ k for k in data.iterkeys( depth=0 )
-                                    if k.startswith( 'Y' ) and k.endswith( NAM ) ]
-            assert len( key ) == 1 and f in (NAM,nam), "invalid/ambiguous key name %s: %r" % ( f, key )
-            val			= 1 if f == NAM else 0
+            addr,val		= output( f )
             logging.detail( "%s/%-8s <== %s", unit.description, f, val )
-            unit.write( data[key[0]].addr, val )
+            if addr in batches[-1]:
+                batches.append( {} )
+            batches[-1][addr]	= val
+        for changes in batches:
+            for addr,values in coil_writes( changes, image ):
+                unit.write( addr, values if len( values ) > 1 else values[0] )
         return self.status( actuator=actuator )
 
+    def read_points( self, actuator=1, points=None ):
+        """Read the actuator's stored step data points (default: all POINTS) in the fewest multiple
+        register reads, returning {point: {name: value, ...}, ...}."""
+        unit			= self.unit( uid=actuator )
+        table			= {}
+        for first,count in point_spans( range( POINTS ) if points is None else points ):
+            with self.transfer( 3, count * POINT_SIZE ):
+                block		= unit._read( point_address( first ), count * POINT_SIZE )
+            for p in range( count ):
+                table[first+p]	= point_decode( block[p*POINT_SIZE:(p+1)*POINT_SIZE] )
+        logging.normal( "Points  : actuator %3d read   : %s", actuator, ','.join( map( str, sorted( table ))))
+        return table
+
+    def write_points( self, table, actuator=1 ):
+        """Write the {point: {name: value, ...}, ...} step data points to the actuator in the fewest
+        multiple register writes.  Each point's 'position' is required; any other step data not
+        supplied is filled from the data[...].default values."""
+        unit			= self.unit( uid=actuator )
+        table			= dict( (int( p ),kwds) for p,kwds in table.items() ) # eg. from JSON
+        for kwds in table.values():
+            step_keywords( kwds )
+        for first,count in point_spans( table ):
+            block		= []
+            for p in range( first, first + count ):
+                block.extend( step_data( table[p], {} )[2] )
+            with self.transfer( 16, count * POINT_SIZE ):
+                unit._write( point_address( first ), block )
+        logging.normal( "Points  : actuator %3d written: %s", actuator, ','.join( map( str, sorted( table ))))
+
     def alarm( self, actuator=1, forget=True, reset=True, timeout=None ):
         """Detects if the alarm register is set (X4B_ALARM is reverse logic, so 0 --> set) .
 
@@ -365,19 +1455,20 @@ class smc_modbus( modbus_client_rtu ):
         if timeout is None:
             timeout		= self.TIMEOUT
         unit			= self.unit( uid=actuator )
-        if forget:
-            unit.forget( data.X4F_ALARM.addr )  # Ensure we check freshly polled data
-        detected		= self.check(
-            predicate=lambda: unit.read( data.X4F_ALARM.addr ) is not None,
-            deadline=None if timeout is None else begin + timeout )
-        alarm			= unit.read( data.X4F_ALARM.addr )
-        if alarm is not None and not alarm and reset:  # alarm is reverse logic!
-            self.outputs( "RESET", actuator=actuator )
-            if not self.check(
-                    predicate=lambda: unit.read( data.X4F_ALARM.addr ) != 0,
-                    deadline=None if timeout is None else begin + timeout ):
-                logging.warning( "%s/X4F_ALARM: Failed to RESET", unit.description )
-            self.outputs( "reset", actuator=actuator )
+        with unit.phase( 'alarm', data.X4F_ALARM.addr ):
+            if forget:
+                unit.forget( data.X4F_ALARM.addr )  # Ensure we check freshly polled data
+            detected		= self.check(
+                predicate=lambda: unit.read( data.X4F_ALARM.addr ) is not None,
+                deadline=None if timeout is None else begin + timeout )
+            alarm		= unit.read( data.X4F_ALARM.addr )
+            if alarm is not None and not alarm and reset:  # alarm is reverse logic!
+                self.outputs( "RESET", actuator=actuator )
+                if not self.check(
+                        predicate=lambda: unit.read( data.X4F_ALARM.addr ) != 0,
+                        deadline=None if timeout is None else begin + timeout ):
+                    logging.warning( "%s/X4F_ALARM: Failed to RESET", unit.description )
+                self.outputs( "reset", actuator=actuator )
 
         return alarm  # None, 0 ==> Set (in alarm), !0 ==> Reset (no alarm)
 
@@ -397,9 +1488,10 @@ class smc_modbus( modbus_client_rtu ):
             timeout		= self.TIMEOUT
         unit			= self.unit( uid=actuator )
         # Loop on True/None; terminate only on False; X48_BUSY contains 0/False when complete
-        complete		= self.check(
-            predicate=lambda: unit.read( data.X48_BUSY.addr ) == False,
-            deadline=None if timeout is None else begin + timeout )
+        with unit.phase( 'busy', data.X48_BUSY.addr ):
+            complete		= self.check(
+                predicate=lambda: unit.read( data.X48_BUSY.addr ) == False,
+                deadline=None if timeout is None else begin + timeout )
         ( logging.warning if not complete else logging.detail )(
             "Complete: actuator %3d %s", actuator, "success" if complete else "failure" )
         if svoff and complete:
@@ -407,11 +1499,121 @@ class smc_modbus( modbus_client_rtu ):
             unit.write( data.Y19_SVON.addr, 0 )
         return complete
 
-    def position( self, actuator=1, timeout=TIMEOUT, home=True, noop=False, svoff=False, **kwds ):
+    def started( self, *units, deadline=None ):
+        """Await each actuator's acknowledgement of the D9100 Operation Start just written to the poller
+        'units' (its return to 0), and then a freshly polled X48_BUSY; any BUSY polled before the
+        acknowledgement may predate the move, and falsely indicate its completion.  Returns True iff
+        both are detected for every unit before the 'deadline'.
+
+        """
+        for unit in units:
+            unit.forget( data.operation_start.addr )  # Ensure we check freshly polled data
+        with contextlib.ExitStack() as phases:
+            for unit in units:
+                phases.enter_context( unit.phase( 'start', data.operation_start.addr, data.X48_BUSY.addr ))
+            if not self.check(
+                    predicate=lambda: all( unit.read( data.operation_start.addr ) == 0x0000 for unit in units ),
+                    deadline=deadline ):
+                return False
+            for unit in units:
+                unit.forget( data.X48_BUSY.addr )
+            return self.check(
+                predicate=lambda: all( unit.read( data.X48_BUSY.addr ) is not None for unit in units ),
+                deadline=deadline )
+
+    def drive( self, unit, point, deadline=None ):
+        """Start the stored step data 'point' already selected on the poller 'unit's IN0-IN5 with a
+        rising edge of DRIVE (Y1A), and await the actuator's acknowledgement: the driven step data No.
+        D9006 becoming 'point' (or, if it already was, a polled X48_BUSY), and then a freshly polled
+        X48_BUSY (see started).  DRIVE is then cleared, ready for the next move.  Returns True iff
+        both are detected before the 'deadline'.
+
+        Re-driving the point last driven leaves D9006 unchanged, and a move to where the actuator
+        already is may be BUSY too briefly to be polled; so, if a freshly polled current_position is
+        already within in_position of that (absolute) point's stored position, it is not driven.
+
+        """
+        previous		= unit.read( data.driving_data_no.addr )
+        if previous == point:
+            stored		= self.read_points( actuator=unit.unit, points=[ point ] )[point]
+            unit.forget( data.current_position.addr )
+            with unit.phase( 'start', data.current_position.addr, data.X48_BUSY.addr ):
+                if not self.check(
+                        predicate=lambda: unit.read( data.current_position.addr ) is not None,
+                        deadline=deadline ):
+                    return False
+            status		= unit.status()
+            if stored['movement_mode'] == 1 and status['X48_BUSY'] == False \
+               and abs( status['current_position'] - stored['position'] ) <= stored['in_position']:
+                logging.normal( "Position: actuator %3d already at point %d", unit.unit, point )
+                return True
+        unit.write( data.Y1A_DRIVE.addr, 0 )	# A rising edge is required (dropped, if already clear)
+        unit.forget( data.driving_data_no.addr ) # Ensure we check freshly polled data
+        unit.forget( data.X48_BUSY.addr )
+        try:
+            unit.write( data.Y1A_DRIVE.addr, 1 )
+            with unit.phase( 'start', data.driving_data_no.addr, data.X48_BUSY.addr ):
+                if not self.check(
+                        predicate=lambda: unit.read( data.driving_data_no.addr ) == point and (
+                            previous not in ( None, point ) or unit.read( data.X48_BUSY.addr )),
+                        deadline=deadline ):
+                    return False
+                unit.forget( data.X48_BUSY.addr )
+                return self.check(
+                    predicate=lambda: unit.read( data.X48_BUSY.addr ) is not None,
+                    deadline=deadline )
+        finally:
+            unit.write( data.Y1A_DRIVE.addr, 0 )
+
+    def trigger( self, *actuators, broadcast=False ):
+        """Write the D9100 Operation Start to all the (already staged) 'actuators' at once, without any
+        intervening polls: in one Modbus broadcast (unit 0) frame, or else in a burst of back-to-back
+        writes.  Returns the seconds taken (the spread of the actuators' starts).
+
+        A broadcast starts *every* actuator on the serial port (with whatever step data each holds), even
+        those never polled by this process, so it is only allowed if the 'bus_units' on the port have
+        been declared, and all of them are among the 'actuators'.
+
+        """
+        if broadcast:
+            assert self.bus_units is not None, \
+                "Cannot broadcast Operation Start; the actuators on %s are undeclared (see bus_units)" % (
+                    self.device )
+            undeclared		= sorted( set( actuators ) - set( self.bus_units ))
+            assert not undeclared, \
+                "Cannot broadcast Operation Start; actuators %r are not declared on %s" % (
+                    undeclared, self.device )
+            others		= sorted( ( set( self.bus_units ) | set( self.pollers )) - set( actuators ))
+            assert not others, \
+                "Cannot broadcast Operation Start; would also start actuators %r" % ( others )
+        units			= [ self.unit( uid=a ) for a in actuators ]
+        with self.priority( 'command' ), self: # block 'til scheduled; hold the bus 'til all started
+            begin		= cpppo.timer()
+            if broadcast:
+                assert self.connect(), \
+                    "Failed to connect to %s to broadcast Operation Start" % ( self.device )
+                self.execute( no_response_expected=True, request=WriteMultipleRegistersRequest(
+                    address=data.operation_start.addr - 40001, registers=[ 0x0100 ], dev_id=0 ))
+                time.sleep( PORT_TURNAROUND )	# Allow the actuators to act, before any other request
+            else:
+                for unit in units:
+                    assert unit.online, \
+                        "Failed to start %s: Offline" % ( unit.description )
+                    unit._write( data.operation_start.addr, 0x0100 )
+            spread		= cpppo.timer() - begin
+        logging.normal( "Started : actuator %s %s in %7.3fs", ','.join( map( str, actuators )),
+                        "broadcast" if broadcast else "burst", spread )
+        return spread
+
+    def position( self, actuator=1, timeout=TIMEOUT, home=True, noop=False, svoff=False,
+                  batch=None, chain=None, point=None, **kwds ):
         """Begin position operation on 'actuator' w/in 'timeout'.  
 
         :param home: Return to home position before any other movement
         :param noop: Do not perform final activation
+        :param batch: Write all step data D9102-D9111 in one transaction (default: self.batch)
+        :param chain: ... and include the D9100 operation start in it (default: self.chain)
+        :param point: Drive the stored step data point No. (0-63) instead; no step data is written
 
         Running with specified data
 
@@ -428,18 +1630,34 @@ class smc_modbus( modbus_client_rtu ):
         If no positioning kwds are provided, then no new position is configured.  If 'noop' is True,
         everything except the final activation is performed.
 
+        If 'batch', step 4 writes the whole D9102-D9111 step data in a single multi-register write;
+        any step data not supplied is filled from the actuator's currently polled values, or from
+        the data[...].default values.  If also 'chain', the D9100 operation start of step 5 is
+        written along with it, so a whole move's data and activation costs one transaction.
+
+        If a stored step data 'point' is specified (see write_points), step 4 instead selects it on
+        IN0-IN5 in one multiple coil write, and step 5 starts it with a rising edge of DRIVE (see
+        drive).  Along with the shadow of the values written (see smc_poller), a move to a stored point
+        costs just its selection and the DRIVE writes.
+
         """
         begin			= cpppo.timer()
         if timeout is None:
             timeout		= self.TIMEOUT
+        if batch is None:
+            batch		= self.batch
+        if chain is None:
+            chain		= self.chain
 
         # 0: Await completion of prior positioning request; does *NOT* disable servo
         assert self.complete( actuator=actuator, svoff=False, timeout=timeout ), \
             "Previous actuator position incomplete within timeout %r" % timeout
 
         status			= self.status( actuator=actuator )
-        if not kwds:
+        if not kwds and point is None:
             return status
+        assert point is None or not kwds, \
+            "Cannot supply step data when driving stored point %r: %r" % ( point, kwds )
 
         # Previous positioning complete, and possibly new position keywords provided.
         logging.detail( "Position: actuator %3d setdata: %r", actuator, kwds )
@@ -453,9 +1671,10 @@ class smc_modbus( modbus_client_rtu ):
             assert cpppo.timer() <= begin + timeout, \
                 "Failed to complete positioning SVON/SVRE within timeout"
         unit.write( data.Y19_SVON.addr, 1 )
-        svre			= self.check(
-            predicate=lambda: unit.read( data.Y19_SVON.addr ) and unit.read( data.X49_SVRE.addr ),
-            deadline=None if timeout is None else begin + timeout )
+        with unit.phase( 'svon', data.Y19_SVON.addr, data.X49_SVRE.addr ):
+            svre		= self.check(
+                predicate=lambda: unit.read( data.Y19_SVON.addr ) and unit.read( data.X49_SVRE.addr ),
+                deadline=None if timeout is None else begin + timeout )
         assert svre, \
             "Failed to set SVON True and read SVRE True"
 
@@ -466,9 +1685,10 @@ class smc_modbus( modbus_client_rtu ):
                 assert cpppo.timer() <= begin + timeout, \
                     "Failed to complete positioning SETUP/SETON within timeout"
             unit.write( data.Y1C_SETUP.addr, 1 )
-            seton			= self.check(
-                predicate=lambda: unit.read( data.Y1C_SETUP.addr ) and unit.read( data.X4A_SETON.addr ),
-                deadline=None if timeout is None else begin + timeout )
+            with unit.phase( 'seton', data.Y1C_SETUP.addr, data.X4A_SETON.addr ):
+                seton		= self.check(
+                    predicate=lambda: unit.read( data.Y1C_SETUP.addr ) and unit.read( data.X4A_SETON.addr ),
+                    deadline=None if timeout is None else begin + timeout )
             if not seton:
                 logging.warning( "Failed to set SETUP True and read SETON True" )
             # assert seton, \
@@ -478,33 +1698,45 @@ class smc_modbus( modbus_client_rtu ):
         
         # 4: Write any changed position data.  The actuator doesn't accept individual register
         # writes, so we use multiple register writes for each value.
-        for k,v in kwds.items():
-            assert k in data, \
-                "Unrecognized positioning keyword: %s == %r" % ( k, v )
-            assert STEP_DATA_BEG <= data[k].addr <= STEP_DATA_END, \
-                "Invalid positioning keyword: %s == %r; not within position data address range" % ( k, v )
-            format		= data[k].get( 'format' )
-            if format:
-                # Create a big-endian buffer.  This will be some multiple of register size.  Then,
-                # unpack it into some number of 16-bit big-endian registers (this will be a tuple).
-                buf		= struct.pack( '>'+format, v )
-                values		= [ struct.unpack_from( '>H', buf[o:] )[0] for o in range( 0, len( buf ), 2 ) ]
+        step_keywords( kwds )
+        chained			= False
+        with unit.phase( 'data' ):
+            if point is not None:
+                # Select the stored step data point on IN0-IN5
+                point_address( point )
+                logging.normal( "Position: actuator %3d selects: point %d", actuator, point )
+                unit.write( data.Y10_IN0.addr, [ ( point >> b ) & 1 for b in range( 6 ) ] )
+            elif batch:
+                # All the step data in a single write, filling gaps from polled values or defaults.
+                # If chaining the operation start, begin the write at D9100.
+                chained		= bool( chain and not noop )
+                address,values,block = step_data( kwds, status, chained=chained )
+                if timeout:
+                    assert cpppo.timer() <= begin + timeout, \
+                        "Failed to complete positioning data update within timeout"
+                logging.normal( "Position: actuator %3d updated: %r (== %s)", actuator, values, block )
+                unit.write( address, block )
             else:
-                values		= [ v ]
-            if timeout:
-                assert cpppo.timer() <= begin + timeout, \
-                    "Failed to complete positioning data update within timeout"
-            logging.normal( "Position: actuator %3d updated: %16s: %8s (== %s)", actuator, k, v, values )
-            unit.write( data[k].addr, values )
+                for k,v in kwds.items():
+                    # Encode into some number of 16-bit big-endian registers, biggest end first.
+                    addr,n,_	= registers.fields[k]
+                    values	= registers.encode( {k: v}, addr, n )
+                    if timeout:
+                        assert cpppo.timer() <= begin + timeout, \
+                            "Failed to complete positioning data update within timeout"
+                    logging.normal( "Position: actuator %3d updated: %16s: %8s (== %s)", actuator, k, v, values )
+                    unit.write( data[k].addr, values )
 
         # 5: set operation_start to 0x0100 (1 in high-order bytes) unless 'noop'
         # - returns to 0 after operation starts (see 10.2 Running with specified data)
         if not noop:
-            unit.write( data.operation_start.addr, 0x0100 )
-            unit.forget( data.operation_start.addr )  # Ensure we check freshly polled data
-            started			= self.check(
-                predicate=lambda: unit.read( data.operation_start.addr ) == 0x0000,
-                deadline=None if timeout is None else begin + timeout )
+            deadline		= None if timeout is None else begin + timeout
+            if point is not None:
+                started		= self.drive( unit, point, deadline=deadline )
+            else:
+                if not chained:
+                    unit.write( data.operation_start.addr, 0x0100 )
+                started		= self.started( unit, deadline=deadline )
             assert started, \
                 "Failed to detect positioning start within timeout"
             # 5a: If svoff specified, await completion and turn Servo off.
@@ -513,3 +1745,258 @@ class smc_modbus( modbus_client_rtu ):
                     "Current actuator position incomplete within timeout %r" % timeout
 
         return self.status( actuator=actuator )
+
+    def position_next( self, actuator=1, timeout=TIMEOUT, dwell=0, **kwds ):
+        """Start the next move on 'actuator' the moment its current move completes.  While the current
+        move is in motion, the next move's step data D9102-D9111 is validated and staged (any not
+        supplied is filled from the polled values or defaults, as for a 'batch' position), leaving
+        only the D9100 operation start to be written once X48_BUSY clears (and any 'dwell' seconds
+        elapse).  The servo must already be on (SVON/SVRE), eg. by a prior position() of the actuator.
+        The 'timeout' applies to the staging and completion of the current move, and (after any dwell)
+        again to the start of the next.
+
+        """
+        begin			= cpppo.timer()
+        if timeout is None:
+            timeout		= self.TIMEOUT
+        step_keywords( kwds )
+        unit			= self.unit( uid=actuator )
+
+        # 4: Stage the step data while the current move proceeds
+        address,values,block	= step_data( kwds, self.status( actuator=actuator ))
+        logging.normal( "Position: actuator %3d staged : %r (== %s)", actuator, values, block )
+        with unit.phase( 'data' ):
+            unit.write( address, block )
+
+        # 0: Await completion of the current move (and any dwell)
+        assert self.complete( actuator=actuator, svoff=False,
+                              timeout=None if timeout is None else max( 0, begin + timeout - cpppo.timer() )), \
+            "Previous actuator position incomplete within timeout %r" % timeout
+        if dwell:
+            logging.detail( "Position: actuator %3d dwells : %7.3fs", actuator, dwell )
+            time.sleep( dwell )
+
+        # 5: set operation_start to 0x0100 (1 in high-order bytes); the start has its own timeout
+        unit.write( data.operation_start.addr, 0x0100 )
+        assert self.started( unit, deadline=None if timeout is None else cpppo.timer() + timeout ), \
+            "Failed to detect positioning start within timeout"
+        return self.status( actuator=actuator )
+
+    def sequence( self, *moves, **kwds ):
+        """Position through a sequence of moves, each a dict of position() keywords; any numeric entry
+        dwells that many seconds after the prior move completes.  Any 'kwds' supply defaults for every
+        move, eg. actuator=1, speed=500, timeout=10.
+
+        The first move on an actuator is positioned normally.  Each following move on the same actuator
+        is streamed via position_next, staging its step data during the prior motion.  Any move on
+        another actuator, or with 'home', 'noop', 'svoff' or a stored 'point', awaits the prior move's
+        completion and is positioned normally.  Returns the actuator's status after the final move completes.
+
+        """
+        current			= None		# The actuator of a streamable move in progress
+        dwell			= 0
+        status			= None
+        for move in moves:
+            if isinstance( move, cpppo.natural.num_types ):
+                dwell	       += move
+                continue
+            move		= dict( kwds, **move )
+            actuator		= move.setdefault( 'actuator', 1 )
+            if current == actuator and move.get( 'point' ) is None \
+               and not any( move.get( k ) for k in ( 'home', 'noop', 'svoff' )):
+                status		= self.position_next( dwell=dwell, **dict(
+                    (k,v) for k,v in move.items() if k not in ( 'home', 'noop', 'svoff', 'batch', 'chain' )))
+            else:
+                if current is not None:
+                    assert self.complete( actuator=current, timeout=move.get( 'timeout' )), \
+                        "Previous actuator position incomplete within timeout %r" % move.get( 'timeout' )
+                if dwell:
+                    time.sleep( dwell )
+                status		= self.position( **move )
+            dwell		= 0
+            current		= None if move.get( 'noop' ) or move.get( 'svoff' ) else actuator
+        if current is not None:
+            assert self.complete( actuator=current, timeout=kwds.get( 'timeout' )), \
+                "Current actuator position incomplete within timeout %r" % kwds.get( 'timeout' )
+            status		= self.status( actuator=current )
+        if dwell:
+            time.sleep( dwell )
+        return status
+
+    def position_begin( self, **kwds ):
+        """Begin position( **kwds ) without blocking; returns a positioning handle, whose .wait() yields
+        the status (or raises the failure)."""
+        return positioning( self, **kwds )
+
+    def position_many( self, *moves, complete=False, timeout=None ):
+        """Position several distinct actuators concurrently; each move is a dict of position() keywords,
+        including its 'actuator'.  Their handshakes are interleaved on the bus, and their motions
+        overlap.  Returns a list of the statuses (after completion of all motions, if 'complete').
+
+        """
+        actuators		= [ m.get( 'actuator', 1 ) for m in moves ]
+        assert len( set( actuators )) == len( actuators ), \
+            "Cannot position the same actuator concurrently: %r" % ( actuators )
+        return positioning.wait_all( [ self.position_begin( **m ) for m in moves ],
+                                     timeout=timeout, complete=complete )
+
+    def position_sync( self, *moves, broadcast=False, complete=False, timeout=None ):
+        """Start several distinct actuators' moves together.  Each move (a dict of position() keywords,
+        including its 'actuator') is first staged concurrently: any prior motion completed, SVON, any
+        SETUP, and its step data written -- all but the D9100 Operation Start (as for noop=True).  Then,
+        all of them are started at once (see trigger), and each start is confirmed by polling.  Returns
+        a list of their statuses (after completion of all motions, if 'complete').
+
+        """
+        actuators		= stage_sync( self, moves, timeout=timeout )
+        self.trigger( *actuators, broadcast=broadcast )
+        deadline		= sync_deadline( self, timeout )
+        assert self.started( *[ self.unit( uid=a ) for a in actuators ], deadline=deadline ), \
+            "Failed to detect synchronized positioning start within timeout"
+        return sync_statuses( self, actuators, complete=complete, deadline=deadline )
+
+
+def stage_sync( gateway, moves, timeout=None ):
+    """Stage each synchronized move on the gateway (see smc_modbus.position_sync), returning the
+    actuators."""
+    actuators			= [ m.get( 'actuator', 1 ) for m in moves ]
+    assert not any( m.get( 'noop' ) or m.get( 'svoff' ) or m.get( 'point' ) is not None for m in moves ), \
+        "Cannot synchronize the start of a noop, svoff or stored point move"
+    gateway.position_many( *( dict( m, noop=True ) for m in moves ), timeout=timeout )
+    return actuators
+
+
+def sync_deadline( gateway, timeout=None ):
+    """The deadline for confirming synchronized starts, and any completion."""
+    if timeout is None:
+        timeout			= gateway.TIMEOUT
+    return None if timeout is None else cpppo.timer() + timeout
+
+
+def sync_statuses( gateway, actuators, complete=False, deadline=None ):
+    """The synchronized actuators' statuses, after awaiting their completion if 'complete'."""
+    if complete:
+        for a in actuators:
+            assert gateway.complete( actuator=a, timeout=None if deadline is None else max( 0, deadline - cpppo.timer() )), \
+                "Synchronized actuator %d position incomplete within timeout" % ( a )
+    return [ gateway.status( actuator=a ) for a in actuators ]
+
+
+class smc_multi( object ):
+    """Drive SMC actuators spread across several serial ports, via an independent smc_modbus bus
+    worker (with its own serial port, client lock and pollers) for each port.  Provides the same
+    positioning API as smc_modbus, routing each call to the bus of its actuator.
+
+    The 'actuators' map assigns each actuator to a serial port, eg. from the --config JSON:
+
+        { "actuators": { "1": "/dev/ttyUSB0", "2": "/dev/ttyUSB0", "3": "/dev/ttyUSB1" } }
+
+    Any other actuator is assumed to be on the default 'address'.  All remaining keywords (eg.
+    baudrate, rate) are supplied to every bus, except any statistics 'textfile', which is written
+    with the statistics of all the buses, and any 'bus_units' (every actuator, on all the ports); each
+    bus is given only those on its own port.
+
+    """
+    TIMEOUT			= smc_modbus.TIMEOUT
+
+    def __init__( self, address=PORT_MASTER, actuators=None, textfile=None, interval=STATS_INTERVAL,
+                  bus_units=None, **kwds ):
+        self.address		= address
+        self.actuators		= dict( ( int( a ), p ) for a,p in ( actuators or {} ).items() )
+        self.bus_units		= bus_units
+        self.kwds		= kwds
+        self.buses		= {} # {port: <smc_modbus>,}
+        for port in set( self.actuators.values() ):
+            self.bus( port=port )
+        self.textfile		= None if textfile is None else stats_textfile( self, textfile, interval )
+
+    def bus( self, actuator=None, port=None ):
+        """Return the smc_modbus bus worker for the actuator's (or the specified) serial port."""
+        if port is None:
+            port		= self.actuators.get( actuator, self.address )
+        if port not in self.buses:
+            units		= None if self.bus_units is None else [
+                a for a in self.bus_units if self.actuators.get( a, self.address ) == port ]
+            self.buses[port]	= smc_modbus( address=port, bus_units=units, **self.kwds )
+        return self.buses[port]
+
+    def close( self ):
+        if self.textfile:
+            self.textfile.close()
+        for bus in self.buses.values():
+            bus.close()
+
+    def stats( self ):
+        """The transaction statistics of each serial port's bus: {port: {unit: {function: ...}}}."""
+        return dict( (port,bus.stats()) for port,bus in self.buses.items() )
+
+    def prometheus( self ):
+        return prometheus( self.stats() )
+
+    def recover( self, *actuators ):
+        """Recover only the buses (and pollers) of the given actuators (all buses, if none)."""
+        if not actuators:
+            return all( [ bus.recover() for bus in self.buses.values() ] )
+        ports			= {}
+        for a in actuators:
+            ports.setdefault( self.actuators.get( a, self.address ), [] ).append( a )
+        return all( [ self.bus( port=port ).recover( *uids ) for port,uids in ports.items() ] )
+
+    def __repr__( self ):
+        return "\n".join( "%s: %r" % ( port, bus ) for port,bus in sorted( self.buses.items() ))
+
+    def unit( self, uid ):
+        return self.bus( uid ).unit( uid=uid )
+
+    def status( self, actuator=1 ):
+        return self.bus( actuator ).status( actuator=actuator )
+
+    def outputs( self, *flags, actuator=1 ):
+        return self.bus( actuator ).outputs( *flags, actuator=actuator )
+
+    def alarm( self, actuator=1, **kwds ):
+        return self.bus( actuator ).alarm( actuator=actuator, **kwds )
+
+    def read_points( self, actuator=1, **kwds ):
+        return self.bus( actuator ).read_points( actuator=actuator, **kwds )
+
+    def write_points( self, table, actuator=1 ):
+        return self.bus( actuator ).write_points( table, actuator=actuator )
+
+    def complete( self, actuator=1, **kwds ):
+        return self.bus( actuator ).complete( actuator=actuator, **kwds )
+
+    def position( self, actuator=1, **kwds ):
+        return self.bus( actuator ).position( actuator=actuator, **kwds )
+
+    def position_next( self, actuator=1, **kwds ):
+        return self.bus( actuator ).position_next( actuator=actuator, **kwds )
+
+    sequence			= smc_modbus.sequence # Routes each move via position/position_next
+
+    def position_begin( self, actuator=1, **kwds ):
+        return self.bus( actuator ).position_begin( actuator=actuator, **kwds )
+
+    def position_many( self, *moves, complete=False, timeout=None ):
+        """Position several distinct actuators concurrently, across all of their buses."""
+        actuators		= [ m.get( 'actuator', 1 ) for m in moves ]
+        assert len( set( actuators )) == len( actuators ), \
+            "Cannot position the same actuator concurrently: %r" % ( actuators )
+        return positioning.wait_all( [ self.position_begin( **m ) for m in moves ],
+                                     timeout=timeout, complete=complete )
+
+    def position_sync( self, *moves, broadcast=False, complete=False, timeout=None ):
+        """Start several distinct actuators' moves together, across all of their buses (see
+        smc_modbus.position_sync); each bus is triggered in turn, and then each start is confirmed."""
+        actuators		= stage_sync( self, moves, timeout=timeout )
+        ports			= {}
+        for a in actuators:
+            ports.setdefault( self.actuators.get( a, self.address ), [] ).append( a )
+        for port,uids in ports.items():
+            self.bus( port=port ).trigger( *uids, broadcast=broadcast )
+        deadline		= sync_deadline( self, timeout )
+        for port,uids in ports.items():
+            bus			= self.bus( port=port )
+            assert bus.started( *[ bus.unit( uid=a ) for a in uids ], deadline=deadline ), \
+                "Failed to detect synchronized positioning start on %s within timeout" % ( port )
+        return sync_statuses( self, actuators, complete=complete, deadline=deadline )
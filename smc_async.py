@@ -0,0 +1,351 @@
+
+#
+# Cpppo_positioner -- Actuator position control
+#
+# Copyright (c) 2014, Hard Consulting Corporation.
+#
+# Cpppo_positioner is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.  See the COPYING file at the top of the source tree.
+#
+# Cpppo_positioner is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry@hardconsulting.com"
+__copyright__                   = "Copyright (c) 2014 Hard Consulting Corporation"
+__license__                     = "Dual License: GPLv3 (or later) and Commercial (see LICENSE)"
+
+__all__				= ["smc_modbus_async"]
+
+import asyncio
+import logging
+
+import cpppo
+
+from pymodbus.client import AsyncModbusSerialClient
+from pymodbus.exceptions import ModbusException
+from pymodbus.framer import FramerType
+
+try:
+    from . import smc
+except ImportError:
+    import smc
+
+
+class smc_modbus_async( object ):
+    """Drive a set of SMC actuators via direct Modbus/RTU protocol from an asyncio event loop, using
+    the pymodbus async serial client.  Provides async versions of the smc_modbus positioning API.
+
+    There are no poller threads; each await reads exactly the registers it needs, directly.  Status
+    reads are the compiled smc.registers spans, and the positioning handshakes poll only the awaited
+    addresses, at their smc.POLL_RATES phase rate.  The client serializes the transactions of all
+    the tasks sharing its bus, so one event loop may position many actuators concurrently (see
+    position_many), on as many buses (one smc_modbus_async each) as required.
+
+    """
+    TIMEOUT			= smc.smc_modbus.TIMEOUT
+
+    def __init__( self, address=smc.PORT_MASTER, timeout=smc.PORT_TIMEOUT, baudrate=smc.PORT_BAUDRATE,
+                  stopbits=smc.PORT_STOPBITS, bytesize=smc.PORT_BYTESIZE, parity=smc.PORT_PARITY,
+                  rate=smc.POLL_RATE, rates=None, batch=False, chain=False ):
+        self.timing		= smc.rs485_timing( baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                                    stopbits=stopbits )
+        if timeout is None:
+            timeout		= self.timing.timeout
+        self.client		= AsyncModbusSerialClient(
+            port=address, framer=FramerType.RTU, stopbits=stopbits, bytesize=bytesize,
+            parity=parity, baudrate=baudrate, timeout=timeout )
+        self.address		= address
+        self.connecting		= asyncio.Lock()
+        self.rate		= rate
+        self.rates		= smc.poll_rates( rate, rates )	# Poll rate for each phase
+        self.batch		= batch		# position() step data in one multi-register write
+        self.chain		= chain		#   including the D9100 operation start
+
+    async def __aenter__( self ):
+        await self.connect()
+        return self
+
+    async def __aexit__( self, *exc ):
+        self.close()
+
+    async def connect( self ):
+        """Open the serial port, if not already open."""
+        async with self.connecting:
+            if not self.client.connected:
+                await self.client.connect()
+        return self.client.connected
+
+    def close( self ):
+        self.client.close()
+
+    def __repr__( self ):
+        return "SMC Modbus/RTU Gateway (async): %s" % ( self.address )
+
+    async def read( self, address, count=1, actuator=1 ):
+        """Read 'count' Coils, Discrete Inputs or Holding Registers from 'address'.  Returns a list of
+        the values, all None if communications fail."""
+        try:
+            if not await self.connect():
+                raise ModbusException( "Connect failure" )
+            if 40001 <= address <= 99999:
+                result		= await self.client.read_holding_registers(
+                    address - 40001, count=count, slave=actuator )
+                values		= None if result.isError() else result.registers
+            elif 10001 <= address <= 19999:
+                result		= await self.client.read_discrete_inputs(
+                    address - 10001, count=count, slave=actuator )
+                values		= None if result.isError() else [ int( b ) for b in result.bits ]
+            else:
+                assert 1 <= address <= 9999, \
+                    "Invalid Modbus address for read: %d" % ( address )
+                result		= await self.client.read_coils(
+                    address - 1, count=count, slave=actuator )
+                values		= None if result.isError() else [ int( b ) for b in result.bits ]
+            if values is None:
+                raise ModbusException( str( result ))
+        except ModbusException as exc:
+            logging.info( "SMC %s/%6d-%6d: Read failed: %s", actuator, address, address + count - 1, exc )
+            return [ None ] * count
+        return list( values[:count] )
+
+    async def write( self, address, value, actuator=1 ):
+        """Write a Coil (or several), or Holding Registers to 'address'.  The actuator doesn't accept
+        individual register writes, so registers are always written with a multiple register write.
+        Raises a ModbusException on failure.
+
+        """
+        multi			= hasattr( value, '__iter__' )
+        value			= list( value ) if multi else [ value ]
+        if not await self.connect():
+            raise ModbusException( "SMC %s/%6d: Write failed: Connect failure" % ( actuator, address ))
+        if 40001 <= address <= 99999:
+            result		= await self.client.write_registers(
+                address - 40001, value, slave=actuator )
+        else:
+            assert 1 <= address <= 9999, \
+                "Invalid Modbus address for write: %d" % ( address )
+            if multi:
+                result		= await self.client.write_coils(
+                    address - 1, list( map( bool, value )), slave=actuator )
+            else:
+                result		= await self.client.write_coil(
+                    address - 1, bool( value[0] ), slave=actuator )
+        if result.isError():
+            raise ModbusException( "SMC %s/%6d: Write failed: %s" % ( actuator, address, result ))
+
+    async def status( self, actuator=1 ):
+        """Read and decode all of the actuator's position data, status and control indicators, returning
+        all status values as a dictionary.  Will return None for any values when communications fail.
+
+        """
+        spans			= {}
+        for address,count,_ in smc.registers.spans:
+            spans[address]	= await self.read( address, count, actuator=actuator )
+        return smc.registers.decode( lambda address,count: spans[address] )
+
+    async def check( self, predicate, deadline=None, phase='idle' ):
+        """Check if the awaitable 'predicate' comes True before 'deadline', re-evaluating it at the
+        'phase' poll rate."""
+        rate			= self.rates.get( phase, self.rate )
+        done			= await predicate()
+        while not done and ( deadline is None or cpppo.timer() < deadline ):
+            await asyncio.sleep( rate if deadline is None
+                                 else min( rate, max( 0, deadline - cpppo.timer() )))
+            done		= await predicate()
+        return done
+
+    async def value( self, address, actuator=1 ):
+        """Read a single Coil, Discrete Input or Holding Register value (None if unable)."""
+        return ( await self.read( address, actuator=actuator ))[0]
+
+    async def outputs( self, *flags, actuator=1 ):
+        """Set one or more 'flag' matching 'NAME' (or clear it, if all lower case 'name' used).  Only
+        Y... (Coils) may be written.  See smc_modbus.outputs; lacking a polled image of the coils, only
+        changes to adjacent coils are coalesced into one write.
+
+        """
+        batches			= [ {} ]
+        for f in flags:
+            addr,val		= smc.output( f )
+            logging.detail( "SMC %s/%-8s <== %s", actuator, f, val )
+            if addr in batches[-1]:
+                batches.append( {} )
+            batches[-1][addr]	= val
+        for changes in batches:
+            for addr,values in smc.coil_writes( changes, lambda address: None ):
+                await self.write( addr, values if len( values ) > 1 else values[0], actuator=actuator )
+        return await self.status( actuator=actuator )
+
+    async def alarm( self, actuator=1, reset=True, timeout=None ):
+        """Detects if the alarm register is set (X4F_ALARM is reverse logic, so 0 --> set), optionally
+        resetting it.  Returns the value of the alarm register (before the optional reset), or None if
+        unable to read.
+
+        """
+        begin			= cpppo.timer()
+        if timeout is None:
+            timeout		= self.TIMEOUT
+        deadline		= None if timeout is None else begin + timeout
+        alarm			= None
+
+        async def detected():
+            nonlocal alarm
+            alarm		= await self.value( smc.data.X4F_ALARM.addr, actuator=actuator )
+            return alarm is not None
+        await self.check( predicate=detected, deadline=deadline, phase='alarm' )
+        if alarm is not None and not alarm and reset:  # alarm is reverse logic!
+            await self.outputs( "RESET", actuator=actuator )
+
+            async def cleared():
+                return await self.value( smc.data.X4F_ALARM.addr, actuator=actuator ) not in (0,None)
+            if not await self.check( predicate=cleared, deadline=deadline, phase='alarm' ):
+                logging.warning( "SMC %s/X4F_ALARM: Failed to RESET", actuator )
+            await self.outputs( "reset", actuator=actuator )
+
+        return alarm  # None, 0 ==> Set (in alarm), !0 ==> Reset (no alarm)
+
+    async def complete( self, actuator=1, svoff=False, timeout=None ):
+        """Ensure that any prior operation on the actuator is complete w/in timeout (the X48_BUSY flag
+        is clear); return True iff the current operation is detected as being complete.  If 'svoff' is
+        True, also turn off the servo (clear Y19_SVON) if we detect completion.
+
+        """
+        begin			= cpppo.timer()
+        if timeout is None:
+            timeout		= self.TIMEOUT
+
+        async def idle():
+            return await self.value( smc.data.X48_BUSY.addr, actuator=actuator ) == False
+        complete		= await self.check(
+            predicate=idle, deadline=None if timeout is None else begin + timeout, phase='busy' )
+        ( logging.warning if not complete else logging.detail )(
+            "Complete: actuator %3d %s", actuator, "success" if complete else "failure" )
+        if svoff and complete:
+            logging.detail( "ServoOff: actuator %3d", actuator )
+            await self.write( smc.data.Y19_SVON.addr, 0, actuator=actuator )
+        return complete
+
+    async def position( self, actuator=1, timeout=TIMEOUT, home=True, noop=False, svoff=False,
+                        batch=None, chain=None, **kwds ):
+        """Begin position operation on 'actuator' w/in 'timeout'.  Follows the same procedure (and
+        accepts the same options) as smc_modbus.position.
+
+        """
+        begin			= cpppo.timer()
+        if timeout is None:
+            timeout		= self.TIMEOUT
+        if batch is None:
+            batch		= self.batch
+        if chain is None:
+            chain		= self.chain
+        deadline		= None if timeout is None else begin + timeout
+
+        def both( a, b ):
+            async def predicate():
+                return ( await self.value( a, actuator=actuator )
+                         and await self.value( b, actuator=actuator ))
+            return predicate
+
+        # 0: Await completion of prior positioning request; does *NOT* disable servo
+        assert await self.complete( actuator=actuator, svoff=False, timeout=timeout ), \
+            "Previous actuator position incomplete within timeout %r" % timeout
+
+        if not kwds:
+            return await self.status( actuator=actuator )
+        smc.step_keywords( kwds )
+        logging.detail( "Position: actuator %3d setdata: %r", actuator, kwds )
+
+        # 1: set INPUT_INVALID; enabled operating instructions by serial communication
+        await self.write( smc.data.Y30_INPUT_INVALID.addr, 1, actuator=actuator )
+
+        # 2: set SVON (servo on), check SVRE
+        if timeout:
+            assert cpppo.timer() <= begin + timeout, \
+                "Failed to complete positioning SVON/SVRE within timeout"
+        await self.write( smc.data.Y19_SVON.addr, 1, actuator=actuator )
+        assert await self.check(
+            predicate=both( smc.data.Y19_SVON.addr, smc.data.X49_SVRE.addr ), deadline=deadline, phase='svon' ), \
+            "Failed to set SVON True and read SVRE True"
+
+        # 3: Return to home? set SETUP, check SETON.  Otherwise, clear SETUP.
+        if home:
+            if timeout:
+                assert cpppo.timer() <= begin + timeout, \
+                    "Failed to complete positioning SETUP/SETON within timeout"
+            await self.write( smc.data.Y1C_SETUP.addr, 1, actuator=actuator )
+            if not await self.check(
+                    predicate=both( smc.data.Y1C_SETUP.addr, smc.data.X4A_SETON.addr ), deadline=deadline, phase='seton' ):
+                logging.warning( "Failed to set SETUP True and read SETON True" )
+        else:
+            await self.write( smc.data.Y1C_SETUP.addr, 0, actuator=actuator )
+
+        # 4: Write the position data; all of it in one write if 'batch', optionally 'chain'ing the
+        # operation start, else each keyword in its own multiple register write.
+        chained			= bool( batch and chain and not noop )
+        if batch:
+            address,values,block = smc.step_data(
+                kwds, await self.status( actuator=actuator ), chained=chained )
+            writes		= [ (address, values, block) ]
+        else:
+            writes		= [ (smc.data[k].addr, {k: v}, smc.registers.encode(
+                                        {k: v}, smc.data[k].addr, smc.registers.fields[k][1] ))
+                                    for k,v in kwds.items() ]
+        for address,values,block in writes:
+            if timeout:
+                assert cpppo.timer() <= begin + timeout, \
+                    "Failed to complete positioning data update within timeout"
+            logging.normal( "Position: actuator %3d updated: %r (== %s)", actuator, values, block )
+            await self.write( address, block, actuator=actuator )
+
+        # 5: set operation_start to 0x0100 (1 in high-order bytes) unless 'noop'
+        # - returns to 0 after operation starts (see 10.2 Running with specified data)
+        if not noop:
+            if not chained:
+                await self.write( smc.data.operation_start.addr, [ 0x0100 ], actuator=actuator )
+
+            # Await the acknowledgement, and then read X48_BUSY afresh; any BUSY read before the
+            # acknowledgement may predate the move, and falsely indicate its completion (see
+            # smc_modbus.started).
+            async def started():
+                return await self.value( smc.data.operation_start.addr, actuator=actuator ) == 0x0000
+
+            async def busy():
+                return await self.value( smc.data.X48_BUSY.addr, actuator=actuator ) is not None
+            assert await self.check( predicate=started, deadline=deadline, phase='start' ) \
+                and await self.check( predicate=busy, deadline=deadline, phase='start' ), \
+                "Failed to detect positioning start within timeout"
+            # 5a: If svoff specified, await completion and turn Servo off.
+            if svoff:
+                assert await self.complete( actuator=actuator, svoff=True, timeout=timeout ), \
+                    "Current actuator position incomplete within timeout %r" % timeout
+
+        return await self.status( actuator=actuator )
+
+    async def position_many( self, *moves, complete=False, timeout=None ):
+        """Position several distinct actuators concurrently; each move is a dict of position() keywords,
+        including its 'actuator'.  Returns a list of the statuses (after completion of all motions, if
+        'complete').
+
+        """
+        actuators		= [ m.get( 'actuator', 1 ) for m in moves ]
+        assert len( set( actuators )) == len( actuators ), \
+            "Cannot position the same actuator concurrently: %r" % ( actuators )
+        statuses		= await asyncio.wait_for(
+            asyncio.gather( *( self.position( **m ) for m in moves )), timeout )
+        if complete:
+            assert all( await asyncio.gather( *(
+                self.complete( actuator=a, timeout=timeout ) for a in actuators ))), \
+                "Positioning incomplete within timeout %r" % timeout
+            statuses		= await asyncio.gather( *(
+                self.status( actuator=a ) for a in actuators ))
+        return statuses
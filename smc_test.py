@@ -4,32 +4,38 @@ import logging
 import os
 import pytest
 import re
+import socket
 import sys
 import threading
 import time
 
-from contextlib import suppress
-
-from pymodbus.framer import FramerType
-from pymodbus.datastore import ModbusServerContext, ModbusSlaveContext, ModbusSparseDataBlock
-
 import serial.tools.list_ports
 
 import cpppo
-from cpppo.remote.pymodbus_fixes import modbus_server_rtu
 from cpppo.modbus_test import start_modbus_simulator
 
-from . import smc
+from . import smc, simulator
 
 cpppo.log_cfg['level']		= logging.DETAIL
 logging.basicConfig( **cpppo.log_cfg )
 
 #
-# Set eg. SERIAL_TEST=ttyV to specific the correct target serial ports:
+# By default, the tests run over an in-process virtual RS-485 bus (see protocol_rs485.py), with ports
+# rs485://smc_test/0, /1 and /2.  Set eg. SERIAL_TEST=ttyV to specific the correct target serial ports:
 #
 # $ python3 ./ttyV-setup.py &
 # $ SERIAL_TEST=ttyV make test
 #
+# The virtual RS-485 bus is POSIX-only; elsewhere (eg. Windows), the default is the platform's serial
+# ports (eg. COM3, COM4 and COM5), and the tests requiring the bus are skipped.
+#
+try:
+    import fcntl
+    RS485			= True
+except ImportError:
+    RS485			= False
+requires_rs485			= pytest.mark.skipif( not RS485, reason="virtual RS-485 bus requires POSIX" )
+
 if sys.platform == 'win32':
     PORT_BASE_DEFAULT		= "COM"
     PORT_NUM_DEFAULT		= 3
@@ -38,7 +44,8 @@ else:
     PORT_NUM_DEFAULT		= 0
 
 # Handles eg. "3" (start default port name at 3), "COM2", "ttyS", and even ""
-PORT_BASE,PORT_NUM		= re.match( r'^(.*?)(\d*)$', os.environ.get( "SERIAL_TEST", "" )).groups()
+PORT_BASE,PORT_NUM		= re.match( r'^(.*?)(\d*)$', os.environ.get(
+    "SERIAL_TEST", "rs485://smc_test/" if RS485 else "" )).groups()
 PORT_NUM			= PORT_NUM or PORT_NUM_DEFAULT
 PORT_BASE			= PORT_BASE or PORT_BASE_DEFAULT
 
@@ -58,7 +65,7 @@ PORT_SLAVES			= {
 
 PORT_LIST			= list( p.name for p in serial.tools.list_ports.comports() )
 logging.warning( "Detected serial ports: {PORT_LIST!r}".format( PORT_LIST=PORT_LIST ))
-if PORT_MASTER not in PORT_LIST:
+if PORT_MASTER not in PORT_LIST and '://' not in PORT_MASTER:
     logging.warning( "PORT_MASTER: {PORT_MASTER} is NOT in serial PORT_LIST!".format( PORT_MASTER=PORT_MASTER ))
 
 
@@ -88,228 +95,15 @@ def simulated_actuator( tty ):
             'parity':   smc.PORT_PARITY,
             'baudrate': smc.PORT_BAUDRATE,
             'slaves':	PORT_SLAVES[tty],
-            'timeout':  smc.PORT_TIMEOUT,
+            'timeout':  smc.PORT_TIMEOUT or smc.rs485_timing().timeout,
             'ignore_missing_slaves': True,
         } )
     )
 
 
-async def asyncio_actuator_updater( context ):
-    """Update values in server.
-
-    This task runs continuously beside the server, looking at the units in the context, and
-    attempting to respond somewhat like an SMC Actuator would, to a positioning request.
-
-    It should be noted that getValues and setValues are not safe against concurrent use.  However,
-    we'll be reading input value (that are written by the client), and updating output values (that
-    are only polled by the client).
-
-    """
-    logging.detail( "SMC Actuator Updater running on units {units}".format( units=context.slaves() ))
-    #fc_as_hex = 3  # 1 --> Coil, 2 --> Discrete, 3 --> Holding, 4 --> Input
-    fc_coil = 1
-    fc_disc = 2  # noqa: F841
-    fc_hold = 3
-    fc_inpu = 4  # noqa: F841
-
-    #address = 0x10
-    #count = 6
-
-    # set values to zero
-    #values = context[unit].getValues(fc_as_hex, address, count=count)
-    #values = [0 for v in values]
-    #context[unit].setValues(fc_as_hex, address, values)
-
-    #txt = (
-    #    f"updating_task: started: initialised values: {values!s} at address {address!s}"
-    #)
-    #print(txt)
-    #_logger.debug(txt)
-
-    # Responding loop; see smc.py smc_modbus.position
-    # 1   - Set internal flag Y30 (input invalid flag)
-    # 2   - Write 1 to internal flag Y19 (SVON)
-    # 2a  -   and confirm internal flag X49 (SVRE) has become "1"
-    # 3   - Write 1 to internal flag Y1C (SETUP)
-    # 3a  -   and confirm internal flag X4A (SETON) has become "1"
-    # 4   - Write data to D9102-D9110
-    # 5   - Write Operation Start instruction "1" to D9100 (returns to 0 after processed)
-
-    STARTED			= { u:None for u in context.slaves() } # Toggle On --> Off after sleep
-    RESET			= { u:None for u in context.slaves() } # Observe Off -> On resets ALARM
-    while True:
-      await asyncio.sleep(1)
-      for unit in context.slaves():
-       try:
-        # If a unit positioning had been started, toggle off the flag
-        if STARTED[unit]:
-            logging.normal( "SMC Actuator Simulator unit {unit}; START (== {START}) ==> START (0): Positioning Complete".format(
-                unit=unit, START=STARTED[unit],
-            ))
-            context[unit].setValues( fc_hold, smc.data.operation_start.addr-40001, [0] )
-
-        # If a reset->RESET edge has been indicated, clear any existing X4F_ALARM (reverse logic)
-        if context[unit].getValues( fc_coil, smc.data.Y1B_RESET.addr-1, count=1 )[0]:
-            if not RESET[unit]:
-                # Rising reset-->RESET edge
-                logging.detail( "SMC Actuator Simulator unit {unit}; reset --> RESET".format(
-                    unit=unit ))
-                ALARM		= context[unit].getValues( fc_disc, smc.data.X4F_ALARM.addr-10001, count=1 )[0]
-                if ALARM == 0:
-                    logging.detail( "SMC Actuator Simulator unit {unit}; ALARM:  {ALARM!r} (==> {state})  *CLEAR ALARM* (due to RESET)".format(
-                        unit=unit, ALARM=ALARM, state='is Clear' if ALARM else 'is SET' ))
-                    context[unit].setValues( fc_disc, smc.data.X4F_ALARM.addr-10001, [1] )
-                RESET[unit]		= True
-        else:
-            if RESET[unit]:
-                # Falling RESET-->reset edge
-                logging.detail( "SMC Actuator Simulator unit {unit}; RESET --> reset".format(
-                    unit=unit ))
-                RESET[unit]			= False
-
-        # Read SVON Coil, write same value to SVRE Discrete
-        SVON			= context[unit].getValues( fc_coil, smc.data.Y19_SVON.addr-1, count=1 )[0]
-        SVRE			= context[unit].getValues( fc_disc, smc.data.X49_SVRE.addr-10001, count=1 )[0]
-        logging.info( "SMC Actuator Simulator unit {unit}; SVON:  {SVON!r},  SVRE: {SVRE!r}".format(
-            unit=unit, SVON=SVON, SVRE=SVRE ))
-        if bool( SVON ) != bool( SVRE ):
-            logging.detail( "SMC Actuator Simulator unit {unit}; SVON (== {SVON}) ==> SVRE ({SVRE})".format(
-                unit=unit, SVON=SVON, SVRE=SVON,
-            ))
-            context[unit].setValues( fc_disc, smc.data.X49_SVRE.addr-10001, [1 if SVON else 0] )
-
-        # Read SETUP, write same value to SETON
-        SETUP			= context[unit].getValues( fc_coil, smc.data.Y1C_SETUP.addr-1, count=1 )[0]
-        SETON			= context[unit].getValues( fc_disc, smc.data.X4A_SETON.addr-10001, count=1 )[0]
-        logging.info( "SMC Actuator Simulator unit {unit}; SETUP: {SETUP!r}, SETON: {SETON!r}".format(
-            unit=unit, SETUP=SETUP, SETON=SETON ))
-        if bool( SETUP ) != bool( SETON ):
-            logging.detail( "SMC Actuator Simulator unit {unit}; SETUP (== {SETUP}) ==> SETON ({SETON})".format(
-                unit=unit, SETUP=SETUP, SETON=SETUP,
-            ))
-            context[unit].setValues( fc_disc, smc.data.X4A_SETON-10001, [1 if SETUP else 0] )
-
-        # Read OPERATION_START (40001.. Holding); when set, clear INPUT_INVALID (1.. Coil) and vice.versa
-        STARTED[unit]		= context[unit].getValues( fc_hold, smc.data.operation_start.addr-40001, count=1 )[0]
-        INVALID			= context[unit].getValues( fc_coil, smc.data.Y30_INPUT_INVALID.addr-1, count=1 )[0]
-        logging.info( "SMC Actuator Simulator unit {unit}; START: {START!r}, INVAL: {INVAL!r}".format(
-            unit=unit, START=STARTED[unit], INVAL=INVALID ))
-        if bool( STARTED[unit] ) == bool( INVALID ):
-            logging.detail( "SMC Actuator Simulator unit {unit}; START (== {START}) ==> INVALID ({INVALID})".format(
-                unit=unit, START=STARTED[unit], INVALID=not bool( STARTED[unit] ),
-            ))
-            context[unit].setValues( fc_coil, smc.data.Y30_INPUT_INVALID.addr-1, [not bool( STARTED[unit] )] )
-
-        # While HOLD is set, turns on ALARM; when HOLD is cleared, clears ALARM.  This is probably
-        # not what a real device does, but we need something to set the ALARM and it seems close in
-        # concept to the STOP signal used by other SMC devices, so that's what we'll do...  However,
-        # we won't reset it when HOLD is released, so we can test the ALARM reset procedure.
-        HOLD			= context[unit].getValues( fc_coil, smc.data.Y18_HOLD.addr-1, count=1 )[0]
-        ALARM			= context[unit].getValues( fc_disc, smc.data.X4F_ALARM.addr-10001, count=1 )[0]
-        logging.info( "SMC Actuator Simulator unit {unit}; HOLD: {HOLD!r}, ALARM: {ALARM!r} (reverse logic)".format(
-            unit=unit, HOLD=HOLD, ALARM=ALARM ))
-        if HOLD and ALARM:  # Alarm is reverse logic; ALARM ==> ALARM Clear (NOT in ALARM state)
-            logging.detail( "SMC Actuator Simulator unit {unit}; *SET ALARM* (due to HOLD)".format(
-                unit=unit ))
-            context[unit].setValues( fc_disc, smc.data.X4F_ALARM.addr-10001, [0] )  # 0 ==> ALARM Set
-       except Exception as exc:
-        logging.warning( "Failed simulator loop: {exc}".format( exc=exc ))
-
-
 def asyncio_actuator( tty ):
-    """Initiates an asyncio-run Modbus/RTU actuator (registers only) in a Thread.
-
-    Executes an asyncio task to respond to positioning inputs with correct outputs.
-
-    """
-
-    #    '    17 -     64 = 0',	# Coil           0x10   - 0x30   (     1 +) (rounded to 16 bits)
-    #    ' 10065 -  10080 = 0',	# Discrete Input 0x40   - 0x4F   ( 10001 +)
-    #    ' 76865 -  77138 = 0',	# Holding Regs   0x9000 - 0x9111 ( 40001 +)
-    serial_args			= dict(
-        timeout		= smc.PORT_TIMEOUT,
-        # retries	= 3,
-        baudrate	= smc.PORT_BAUDRATE,
-        bytesize	= smc.PORT_BYTESIZE,
-        parity		= smc.PORT_PARITY,
-        stopbits	= smc.PORT_STOPBITS,
-        # handle_local_echo = False,
-    )
-
-    # The asyncio-run actuator, which emits globals as_info['server'] and 'loop' for later cleanup
-    async def actuator_start( port, units, as_info ):
-
-        logging.detail( "Starting Modbus Serial SMC Actuator Simulator units {units!r} on {port}".format(
-            units=units, port=port ))
-
-        context			= ModbusServerContext(
-            single	= False,
-            slaves	= {
-                unit: ModbusSlaveContext(
-                    co=ModbusSparseDataBlock(dict( (a,0) for a in range(   0x10,   0x3F+1 ))),
-                    di=ModbusSparseDataBlock(dict( (a,0) for a in range(   0x40,   0x50+1 ))),
-                    hr=ModbusSparseDataBlock(dict( (a,0) for a in range( 0x9000, 0x911F+1 ))),
-                    ir=ModbusSparseDataBlock(dict()),
-                )
-                for unit in units
-            },
-        )
-
-        # When communication is established, initiate the actuator updater task
-        class modbus_server_actuator( modbus_server_rtu ):
-            def callback_communication(self, established):
-                if hasattr( self, 'updater_task' ):
-                    if not established:
-                        # If the updater_task has been created, cancel it
-                        logging.info( "SMC Actuator Positioning Updater stopping" )
-                        self.updater_task.cancel()
-                else:
-                    if established:
-                        logging.info( "SMC Actuator Positioning Updater starting" )
-                        self.updater_task = asyncio.create_task( asyncio_actuator_updater(
-                            context	= self.context,
-                        ))
-                        self.updater_task.set_name( "SMC Actuator Positioning" )
-                super(modbus_server_actuator, self).callback_communication( established )
-
-        server			= modbus_server_actuator(
-            port	= port,
-            context	= context,
-            framer	= FramerType.RTU,
-            ignore_missing_slaves = True,
-            **serial_args,
-        )
-
-        as_info['server']	= server
-        as_info['loop']		= asyncio.get_event_loop()
-
-        with suppress(asyncio.exceptions.CancelledError):
-            await server.serve_forever()
-
-        logging.detail( "Stopping Modbus Serial SMC Actuator Simulator units {units!r} on {port}".format(
-            units=units, port=port ))
-
-
-    as_info			= dict()
-    
-    # Start the asyncio-run server in a Thread on the TTY, w/ as designated RS-485 units
-    thread			= threading.Thread(
-            target	= lambda **kwds: asyncio.run( actuator_start( **kwds )),
-            kwargs	= dict(
-                port	= tty,
-                units	= PORT_SLAVES[tty],
-                as_info	= as_info,   # Thread 
-            )
-        )
-    thread.daemon		= True
-    thread.start()
-
-    # Indicate to the caller what TTY the simulator has been started on
-    yield tty
-
-    # Shut down the asyncio-run server, and join its thread
-    asyncio.run_coroutine_threadsafe( as_info['server'].shutdown(), as_info['loop'] )
-    thread.join()
+    """Initiates an asyncio-run Modbus/RTU actuator simulator in a Thread, for the units on tty."""
+    yield from simulator.actuator_simulator( tty, PORT_SLAVES[tty] )
 
 
 @pytest.fixture( scope="module" )
@@ -330,6 +124,219 @@ def simulated_actuator_2( request ):
     yield from asyncio_actuator( PORT_SLAVE_2 )
 
 
+def serve_client( path, replies, name, *commands ):
+    """Send the commands to a positioner served on the Unix domain socket 'path' (see main.serve),
+    collecting its JSON replies in replies[name]."""
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as conn:
+        conn.connect( path )
+        conn.sendall( "".join( c + "\n" for c in commands ).encode( 'utf-8' ))
+        conn.shutdown( socket.SHUT_WR )
+        with conn.makefile( 'r' ) as f:
+            replies[name]	= [ json.loads( line ) for line in f ]
+
+
+def test_smc_registers():
+    """The compiled register map coalesces the Coils, Discretes and Holding Registers into the fewest
+    read spans, and decodes each span in one pass."""
+    spans			= [ (address, count) for address,count,_ in smc.registers.spans ]
+    assert spans == [
+        (     1 + 0x10,   0x30 - 0x10 + 1 ),	# Y10_IN0 - Y30_INPUT_INVALID
+        ( 10001 + 0x40,   0x4F - 0x40 + 1 ),	# X40_OUT0 - X4F_ALARM
+        ( 40001 + 0x9000, 0x9006 - 0x9000 + 1 ),	# current_position - driving_data_no
+        ( 40001 + 0x9100, 0x9111 - 0x9100 + 1 ),	# operation_start - in_position
+    ]
+
+    # Fake a poller cache w/ current_position 150.00mm, target_position -1, area_1 unknown
+    cache			= dict( (a,0) for a in smc.registers.addresses )
+    cache[smc.data.current_position.addr+1] = 0x3a98
+    cache[smc.data.target_position.addr]	= 0xffff
+    cache[smc.data.target_position.addr+1]	= 0xffff
+    cache[smc.data.area_1.addr]		= None
+    cache[smc.data.X4F_ALARM.addr]		= True
+    status			= smc.registers.decode(
+        lambda address, count: [ cache.get( a ) for a in range( address, address + count ) ] )
+    assert list( status ) == list( smc.data.iterkeys( depth=0 ))
+    assert status['current_position'] == 15000
+    assert status['target_position'] == -1
+    assert status['area_1'] is None
+    assert status['area_2'] == 0
+    assert status['X4F_ALARM'] is True
+
+    # Output flags are looked up by short or full name; upper case sets, lower case clears
+    assert smc.output( "SVON" ) == ( smc.data.Y19_SVON.addr, 1 )
+    assert smc.output( "y19_svon" ) == ( smc.data.Y19_SVON.addr, 0 )
+    assert smc.output( "INPUT_INVALID" ) == ( smc.data.Y30_INPUT_INVALID.addr, 1 )
+    assert smc.output( "INVALID" ) == ( smc.data.Y30_INPUT_INVALID.addr, 1 )	# Any unambiguous suffix
+    assert smc.output( "plus" ) == ( smc.data.Y1E_JOG_PLUS.addr, 0 )
+    with pytest.raises( AssertionError ):		# Ambiguous; JOG_MINUS or JOG_PLUS
+        smc.output( "US" )
+    with pytest.raises( AssertionError ):
+        smc.output( "Svon" )
+    with pytest.raises( AssertionError ):
+        smc.output( "OUT0" )
+
+
+def test_smc_timing():
+    """The RS-485 timing model derives silent intervals, round trips, timeouts and poll rates."""
+    fast			= smc.rs485_timing( baudrate=115200 )
+    slow			= smc.rs485_timing( baudrate=9600, parity=serial.PARITY_EVEN )
+    assert fast.bits == 10 and slow.bits == 11
+    assert fast.interframe == .00175 and fast.interchar == .00075
+    assert abs( slow.interframe - 3.5 * 11 / 9600 ) < 1e-9
+    assert smc.rs485_timing.frames( 3, 18 ) == ( 8, 41 )
+    assert smc.rs485_timing.frames( 16, 18 ) == ( 45, 8 )
+    assert smc.rs485_timing.function( smc.data.Y19_SVON.addr, write=True ) == 5
+    assert smc.rs485_timing.function( smc.data.X48_BUSY.addr ) == 2
+    assert fast.round_trip( 3, 18 ) < slow.round_trip( 3, 18 )
+    assert fast.timeout < smc.rs485_timing().timeout < slow.timeout
+    assert .05 < smc.rs485_timing().timeout < .1	# About the former fixed .075s at 38400 baud
+    assert fast.poll_rate( actuators=4 ) < fast.poll_rate() < 1 / fast.round_trip( 3, 18 )
+
+    positioner			= smc.smc_modbus( "nonexistent", baudrate=115200 )
+    try:
+        assert positioner.timing.baudrate == 115200
+        assert smc.Defaults.Timeout == fast.timeout
+    finally:
+        positioner.close()
+
+
+@requires_rs485
+def test_smc_rs485_bus( caplog ):
+    """Every byte written to an in-process virtual RS-485 bus endpoint is received by all the others;
+    with '?pace', only after its transmission time."""
+    a,b,c			= ( serial.serial_for_url( "rs485://test_bus/%d" % i, timeout=.1 ) for i in ( 0, 1, 2 ))
+    d				= serial.serial_for_url( "rs485://other_bus/0", timeout=.1 )
+    try:
+        assert a.write( b'hello' ) == 5
+        assert b.in_waiting == 5 and c.in_waiting == 5 and a.in_waiting == 0 and d.in_waiting == 0
+        assert b.read( 10 ) == b'hello'
+        c.reset_input_buffer()
+        assert c.read( 1 ) == b''
+
+        # An endpoint that falls behind loses (the rest of) each frame written, with a warning
+        frame			= b'x' * 1000
+        for i in range( 1000 ):
+            assert a.write( frame ) == len( frame )
+        assert b.in_waiting < 1000 * len( frame )
+        assert any( "of 1000 bytes to rs485://test_bus/1" in r.getMessage() for r in caplog.records )
+    finally:
+        for e in ( a, b, c, d ):
+            e.close()
+
+    paced			= serial.serial_for_url( "rs485://test_bus/0?pace", baudrate=9600 )
+    heard			= serial.serial_for_url( "rs485://test_bus/1", timeout=1 )
+    try:
+        begin			= cpppo.timer()
+        paced.write( b'x' * 96 )	# 96 x 10-bit characters @ 9600 baud: .1s
+        assert heard.read( 96 ) == b'x' * 96
+        assert .09 < cpppo.timer() - begin < .5
+    finally:
+        paced.close()
+        heard.close()
+
+
+@requires_rs485
+def test_smc_rs485_soak():
+    """The gateway and simulated actuators exchange frames over an in-process bus at full speed."""
+    running			= simulator.actuator_simulator( "rs485://test_soak/1", [1, 2] )
+    next( running )
+    try:
+        gateway			= smc.smc_modbus( address="rs485://test_soak/0" )
+        try:
+            assert gateway.connect()
+            count		= 500
+            begin		= cpppo.timer()
+            for i in range( count ):
+                with gateway:
+                    assert not gateway.read_holding_registers(
+                        smc.data.current_position.addr - 40001, count=7, slave=1 + i % 2 ).isError()
+            elapsed		= cpppo.timer() - begin
+            logging.normal( "Soak: %d transactions in %.3fs: %.0f/s", count, elapsed, count / elapsed )
+            assert sum( s[3]['responses'] for s in gateway.stats().values() ) == count
+        finally:
+            gateway.close()
+    finally:
+        next( running, None )
+
+
+def test_smc_simulator_kinematics():
+    """The simulated actuator follows a trapezoidal speed profile to the target of its step data."""
+    changed			= set()
+    unit			= simulator.actuator( 7, changed=changed )
+
+    def write( name, value ):
+        addr,count,_		= smc.registers.fields[name]
+        unit.setValues( *simulator.location( addr ), smc.registers.encode( {name: value}, addr, count ))
+
+    # The step data is initially the defaults, as a configured controller would hold
+    assert [ unit.get( k ) for k in ( 'movement_mode', 'speed', 'acceleration', 'deceleration' ) ] \
+        == [ 1, 500, 5000, 5000 ]
+
+    # Starting without the servo on raises an alarm, which a RESET clears
+    assert unit.get( 'X4F_ALARM' ) == 1
+    write( 'operation_start', 0x0100 )
+    assert changed == { 7 }
+    assert unit.update( 0.0 ) is False
+    assert unit.get( 'operation_start' ) == 0 and unit.get( 'X4F_ALARM' ) == 0
+    write( 'Y1B_RESET', 1 )
+    unit.update( 0.0 )
+    assert unit.get( 'X4F_ALARM' ) == 1
+
+    # 100mm at up to 500mm/s, accelerating/decelerating at 5000mm/s^2: 0.1s + 0.1s + 0.1s
+    write( 'Y19_SVON', 1 )
+    for k,v in dict( movement_mode=1, speed=500, position=10000, acceleration=5000,
+                     deceleration=5000, area_1=4000, area_2=6000, in_position=100 ).items():
+        write( k, v )
+    write( 'operation_start', 0x0100 )
+    assert unit.update( 1.0 ) is True
+    assert unit.get( 'X49_SVRE' ) == 1 and unit.get( 'X48_BUSY' ) == 1 and unit.get( 'X4B_INP' ) == 0
+    assert unit.get( 'target_position' ) == 10000
+    now				= 1.0
+    positions			= []
+    while unit.update( now ):
+        positions.append( unit.get( 'current_position' ))
+        if 4000 <= positions[-1] <= 6000:
+            assert unit.get( 'X4C_AREA' ) == 1 and unit.get( 'current_speed' ) == 500
+        now		       += .01
+    assert 1.29 < now < 1.32
+    assert positions == sorted( positions )
+    assert unit.get( 'current_position' ) == 10000 and unit.get( 'current_speed' ) == 0
+    assert unit.get( 'X48_BUSY' ) == 0 and unit.get( 'X4B_INP' ) == 1 and unit.get( 'X4C_AREA' ) == 0
+
+    # A relative move back, from a client-written current_position
+    write( 'current_position', 12000 )
+    write( 'movement_mode', 2 )
+    write( 'position', -2000 )
+    write( 'operation_start', 0x0100 )
+    unit.update( now )
+    assert unit.get( 'target_position' ) == 10000
+    while unit.update( now ):
+        now		       += .01
+    assert unit.get( 'current_position' ) == 10000
+
+
+def test_smc_benchmark_distribution():
+    """The benchmark summarizes latency samples as a distribution."""
+    from . import benchmark
+    dist			= benchmark.distribution( [ i / 100 for i in range( 100, 0, -1 ) ] )
+    assert dist['count'] == 100
+    assert dist['min'] == .01 and dist['max'] == 1.0
+    assert abs( dist['mean'] - .505 ) < 1e-9
+    assert dist['p50'] == .51 and dist['p90'] == .91 and dist['p99'] == 1.0
+    assert benchmark.distribution( [] ) == dict(
+        count=0, min=None, mean=None, p50=None, p90=None, p99=None, max=None )
+
+
+@requires_rs485
+def test_smc_benchmark():
+    """The benchmark's moves (supplying only a position) complete on a fresh simulator, within the
+    default timeout."""
+    from . import benchmark
+    samples			= benchmark.benchmark( "rs485://smc_bench/gw", "rs485://smc_bench/sim", repeat=2 )
+    assert len( samples['position'] ) == len( samples['complete'] ) == 2
+    assert max( samples['complete'] ) < smc.smc_modbus.TIMEOUT / 2
+
+
 def test_smc_basic( simulated_actuator_1 ):  # , simulated_actuator_2 ): # pymodbus 3.x broke multi-drop
 
     port_1			= simulated_actuator_1
@@ -432,5 +439,736 @@ def test_smc_position( simulated_actuator_1 ):
         in_position	= int( 1.00 / 0.01 ),	# in 0.01mm units (+'ve)
     )
 
+    # The simulated actuator moves from its prior current_position, so is (at least briefly) BUSY
+    assert status['X48_BUSY'] is not None
+    assert positioner.complete( actuator=1, timeout=5 )
+    status			= positioner.status( actuator=1 )
     assert status['X48_BUSY'] == False, "Should have detected positioning complete: %r" % ( status )
+    now				= cpppo.timer()
+    while cpppo.timer() < now + 2 and status['current_position'] != 0:
+        time.sleep( .1 )
+        status			= positioner.status( actuator=1 )
+    assert status['current_position'] == 0
     positioner.close()
+
+
+def test_smc_position_batch( simulated_actuator_1 ):
+    """All step data (and optionally the operation start) are written in a single transaction."""
+    block			= smc.registers.encode(
+        dict( operation_start=0x0100, position=-2, in_position=100 ),
+        smc.data.operation_start.addr, smc.STEP_DATA_END + 1 - smc.data.operation_start.addr )
+    assert block[:6] == [ 0x0100, None, None, None, 0xffff, 0xfffe ]
+    assert block[-2:] == [ 0x0000, 100 ]
+
+    positioner			= smc.smc_modbus( PORT_MASTER, batch=True, chain=True )
+    try:
+        status			= positioner.position(
+            actuator	= 1,
+            position	= 12345,
+            speed	= 250,
+            home	= False,
+            timeout	= 5,
+        )
+        assert positioner.complete( actuator=1, timeout=5 )
+        status			= positioner.status( actuator=1 )
+        assert status['X48_BUSY'] == False, "Should have detected positioning complete: %r" % ( status )
+
+        # The supplied step data was written, and the rest filled from polled values or defaults
+        now			= cpppo.timer()
+        while cpppo.timer() < now + 2 and status['position'] != 12345:
+            time.sleep( .1 )
+            status		= positioner.status( actuator=1 )
+        assert status['position'] == 12345
+        assert status['speed'] == 250
+        assert status['movement_mode'] in ( 1, smc.data.movement_mode.default )
+        assert status['in_position'] is not None
+    finally:
+        positioner.close()
+
+
+def test_smc_check_event():
+    """check() re-evaluates its predicate as soon as fresh polled data arrives, not after sleeping for
+    the (here, very long) poll rate."""
+    positioner			= smc.smc_modbus( address="nonexistent", rate=10 )
+    try:
+        unit			= positioner.unit( uid=1 )
+        addr			= smc.data.X48_BUSY.addr
+        def arrive():
+            unit.online		= True
+            unit._store( addr, 1 )
+        threading.Timer( .25, arrive ).start()
+        begin			= cpppo.timer()
+        assert positioner.check( predicate=lambda: unit.read( addr ) == 1, deadline=begin + 5 )
+        assert cpppo.timer() - begin < 1
+        assert unit.generation >= 1
+    finally:
+        positioner.close()
+
+
+def test_smc_status_snapshot():
+    """status() returns the same immutable snapshot until the unit's polled data changes; the
+    gateway's repr is only re-formatted when some unit's snapshot changes."""
+    positioner			= smc.smc_modbus( address="nonexistent", rate=10 )
+    try:
+        unit			= positioner.unit( uid=1 )
+        unit.online		= True
+        unit._store( smc.data.X48_BUSY.addr, 1 )
+        first			= positioner.status( actuator=1 )
+        assert first['X48_BUSY'] == 1
+        assert positioner.status( actuator=1 ) is first
+        formatted		= repr( positioner )
+        assert repr( positioner ) is formatted
+        with pytest.raises( TypeError ):
+            first['X48_BUSY']	= 0
+        assert json.loads( json.dumps( first ))['X48_BUSY'] == 1
+
+        unit._store( smc.data.X48_BUSY.addr, 1 )	# unchanged
+        assert positioner.status( actuator=1 ) is first
+        unit._store( smc.data.X48_BUSY.addr, 0 )
+        second			= positioner.status( actuator=1 )
+        assert second is not first and second['X48_BUSY'] == 0 and first['X48_BUSY'] == 1
+        assert second.generation > first.generation
+        assert repr( positioner ) != formatted
+
+        # Log arguments are only formatted if the record is emitted
+        calls			= []
+        def formatter():
+            calls.append( True )
+            return "formatted"
+        logging.debug( "Not emitted: %s", smc.lazy( formatter ))
+        assert not calls
+        assert str( smc.lazy( formatter )) == "formatted" and calls
+    finally:
+        positioner.close()
+
+
+def test_smc_poll_phases():
+    """Each unit's poll rate follows its positioning phase, as configured."""
+    positioner			= smc.smc_modbus( address="nonexistent", rate=1, rates=dict( busy=.01 ), linger=.2 )
+    try:
+        assert positioner.rates['idle'] == 1 and positioner.rates['svoff'] == 4	# Derived from rate
+        unit			= positioner.unit( uid=1 )
+        with unit.phase( 'svon' ):
+            assert unit.current() == 'svon'
+            assert unit.interval() == smc.POLL_RATES['svon']
+            assert unit.focus() == set()		# svon needs every address
+            with unit.phase( 'busy' ):
+                assert unit.interval() == .01
+            assert unit.current() == 'svon'
+        with unit.phase( 'busy', smc.data.X48_BUSY.addr ):
+            assert unit.focus() == { smc.data.X48_BUSY.addr }
+            with unit.phase( 'alarm', smc.data.X4F_ALARM.addr ):
+                assert unit.focus() == { smc.data.X48_BUSY.addr, smc.data.X4F_ALARM.addr }
+            with unit.phase( 'svon' ):
+                assert unit.focus() == set()
+        with unit.phase( 'svon' ):
+            pass
+        assert unit.current() == 'svon'		# lingering
+        time.sleep( .25 )
+        unit.online		= False
+        assert unit.current() is None
+        assert unit.interval() == 1		# offline/unknown; uses the supplied rate
+    finally:
+        positioner.close()
+
+
+def test_smc_position_many( simulated_actuator_1 ):
+    """Several actuators on the same bus may be positioned concurrently."""
+    positioner			= smc.smc_modbus( PORT_MASTER, batch=True )
+    try:
+        handle			= positioner.position_begin( actuator=3, position=300, home=False, timeout=5 )
+        assert handle.wait( timeout=10 )['X48_BUSY'] is not None
+        assert positioner.complete( actuator=3, timeout=10 )
+
+        statuses		= positioner.position_many(
+            dict( actuator=1, position=100, home=False, timeout=5 ),
+            dict( actuator=3, position=200, home=False, timeout=5 ),
+            complete=True )
+        assert len( statuses ) == 2
+        assert all( s['X48_BUSY'] == False for s in statuses )
+
+        with pytest.raises( AssertionError ):
+            positioner.position_many( dict( actuator=1 ), dict( actuator=1 ))
+    finally:
+        positioner.close()
+
+
+def test_smc_position_sync( simulated_actuator_1 ):
+    """Several staged actuators are started together, by a burst of writes or one broadcast frame."""
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        speeds			= dict( speed=500, acceleration=5000, deceleration=5000, home=False, timeout=5 )
+        statuses		= positioner.position_sync(
+            dict( actuator=1, position=1100, **speeds ),
+            dict( actuator=3, position=1300, **speeds ),
+            complete=True )
+        assert [ s['position'] for s in statuses ] == [ 1100, 1300 ]
+        assert all( s['X48_BUSY'] == False for s in statuses )
+
+        with pytest.raises( AssertionError ):		# The actuators on the port are undeclared
+            positioner.trigger( 1, 3, broadcast=True )
+        positioner.bus_units	= [ 1, 3, 5 ]
+        with pytest.raises( AssertionError ):		# Would also start actuator 5, never polled
+            positioner.trigger( 1, 3, broadcast=True )
+        positioner.bus_units	= [ 1, 3 ]
+        with pytest.raises( AssertionError ):		# Would also start actuator 3
+            positioner.trigger( 1, broadcast=True )
+
+        statuses		= positioner.position_sync(
+            dict( actuator=1, position=2100, **speeds ),
+            dict( actuator=3, position=2300, **speeds ),
+            broadcast=True, complete=True )
+        assert [ s['position'] for s in statuses ] == [ 2100, 2300 ]
+        assert all( s['X48_BUSY'] == False for s in statuses )
+        assert positioner.check(				# Both actually moved
+            predicate=lambda: [ positioner.status( actuator=a )['current_position'] for a in ( 1, 3 ) ] == [ 2100, 2300 ],
+            deadline=cpppo.timer() + 5 )
+        broadcasts		= positioner.stats()[0][16]	# Write Multiple Registers to unit 0
+        assert broadcasts['requests'] == broadcasts['responses'] == 1
+        assert broadcasts['received'] == 0
+
+        with pytest.raises( AssertionError ):
+            positioner.position_sync( dict( actuator=1, position=100, svoff=True ))
+    finally:
+        positioner.close()
+
+
+def test_smc_shadow( simulated_actuator_1 ):
+    """Writes that would change none of the actuator's coils or step data are dropped."""
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        move			= dict( speed=500, acceleration=5000, deceleration=5000, home=False, timeout=5 )
+        positioner.position( actuator=1, position=1200, **move )
+        assert positioner.complete( actuator=1, timeout=5 )
+        unit			= positioner.unit( uid=1 )
+        assert unit.shadow[smc.data.Y19_SVON.addr] == 1
+        assert unit.shadow[smc.data.speed.addr] == 500
+        assert smc.data.operation_start.addr not in unit.shadow
+
+        dropped			= unit.dropped
+        positioner.position( actuator=1, position=1400, **move )
+        assert positioner.check(				# Once the step data is polled again
+            predicate=lambda: positioner.status( actuator=1 )['position'] == 1400,
+            deadline=cpppo.timer() + 1 )
+        assert unit.dropped - dropped == 6		# INPUT_INVALID, SVON, SETUP, speed, acc-, deceleration
+        assert positioner.complete( actuator=1, timeout=5 )
+
+        positioner.outputs( "RESET", "reset", actuator=1 )	# RESET discards the shadow
+        assert list( unit.shadow ) == []
+        dropped			= unit.dropped
+        positioner.position( actuator=1, position=1200, **move )
+        assert unit.dropped == dropped
+
+        unit.shadow[smc.data.speed.addr] = 499	# A contradicting poll discards the shadow
+        assert positioner.check( predicate=lambda: not unit.shadow, deadline=cpppo.timer() + 1 )
+    finally:
+        positioner.close()
+
+    positioner			= smc.smc_modbus( PORT_MASTER, shadow=False )
+    try:
+        positioner.position( actuator=1, position=1400, **move )
+        positioner.position( actuator=1, position=1200, **move )
+        assert positioner.unit( uid=1 ).dropped == 0
+    finally:
+        positioner.close()
+
+
+def test_smc_outputs( simulated_actuator_1 ):
+    """Output flag changes are coalesced into contiguous multiple coil writes, bridging only coils whose
+    values were written by us, and never DRIVE or RESET."""
+    image			= { 18: False, 20: True, 27: 0, 28: 0 }.get
+    assert smc.coil_writes( { 17: 1, 19: 0, 21: 1, 25: 1, 26: 1, 49: 0 }, image ) == [
+        ( 17, [ 1, 0, 0, 1, 1 ] ), ( 25, [ 1, 1 ] ), ( 49, [ 0 ] ) ]
+    assert smc.coil_writes( { 26: 1, 29: 1 }, image ) == [ ( 26, [ 1 ] ), ( 29, [ 1 ] ) ]
+
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        unit			= positioner.unit( uid=1 )
+        assert positioner.check( predicate=lambda: all( unit.read( a ) is not None for a in range( 17, 32 ) if a not in ( 23, 24 )),
+                                 deadline=cpppo.timer() + 1 )
+        def requests( function ):
+            return positioner.stats()[1].get( function, {} ).get( 'requests', 0 )
+        before			= requests( 5 ),requests( 15 )
+        positioner.outputs( "in0", "in1", "in2", "hold", "svon", actuator=1 )	# Only adjacent coils
+        assert ( requests( 5 ),requests( 15 )) == ( before[0], before[1] + 2 )	# in0-in2, hold-svon
+        before			= requests( 5 ),requests( 15 )
+        status			= positioner.outputs( "IN0", "IN2", "HOLD", "SVON", actuator=1 )	# in1 was written
+        assert ( requests( 5 ),requests( 15 )) == ( before[0], before[1] + 2 )	# IN0-IN2, HOLD-SVON
+        assert 'current_position' in status
+        assert positioner.check( predicate=lambda: [ unit.read( a ) for a in ( 17, 18, 19, 25, 26 ) ] == [ 1, 0, 1, 1, 1 ],
+                                 deadline=cpppo.timer() + 1 )
+
+        # A RESET pulse, followed at once by coils either side of it (before any poll shows it cleared)
+        positioner.outputs( "RESET", "reset", actuator=1 )
+        before			= requests( 5 ),requests( 15 )
+        positioner.outputs( "svon", "SETUP", actuator=1 )
+        assert ( requests( 5 ),requests( 15 )) == ( before[0] + 2, before[1] )	# Not bridged
+        unit.forget( smc.data.Y1B_RESET.addr )
+        assert positioner.check( predicate=lambda: unit.read( smc.data.Y1B_RESET.addr ) is not None,
+                                 deadline=cpppo.timer() + 1 )
+        assert unit.read( smc.data.Y1B_RESET.addr ) == 0 and unit.read( smc.data.Y1A_DRIVE.addr ) == 0
+
+        positioner.outputs( "in0", "in2", "hold", "setup", actuator=1 )
+        assert positioner.alarm( actuator=1 ) == 0	# The simulator sets ALARM on HOLD; reset it
+        assert positioner.alarm( actuator=1 )
+    finally:
+        positioner.close()
+
+
+def test_smc_points( simulated_actuator_1 ):
+    """The stored step data points are written and read in bulk, and driven by number."""
+    assert smc.point_spans( [ 9, 0, 1, 2, 3, 4, 5, 6, 7, 63 ] ) == [ ( 0, 7 ), ( 7, 1 ), ( 9, 1 ), ( 63, 1 ) ]
+    with pytest.raises( AssertionError ):
+        smc.point_spans( [ 64 ] )
+
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        def requests( function ):
+            return positioner.stats().get( 1, {} ).get( function, {} ).get( 'requests', 0 )
+        table			= dict( (p, dict( position=1000 * ( p + 1 ), speed=500, acceleration=5000, deceleration=5000 ))
+                                        for p in range( 9 ))
+        before			= requests( 16 )
+        positioner.write_points( table, actuator=1 )
+        points			= positioner.read_points( actuator=1, points=range( 9 ))
+        assert requests( 16 ) == before + 2	# Points 0-6, 7-8
+        assert sorted( points ) == list( range( 9 ))
+        assert points[8]['position'] == 9000 and points[8]['speed'] == 500
+        assert points[0]['in_position'] == smc.data.in_position.default
+        assert len( positioner.read_points( actuator=1 )) == smc.POINTS
+
+        unit			= positioner.unit( uid=1 )
+        status			= positioner.position( actuator=1, point=2, home=False, timeout=5 )
+        assert status['driving_data_no'] == 2
+        assert positioner.complete( actuator=1, timeout=5 )
+        assert positioner.check( predicate=lambda: positioner.status( actuator=1 )['current_position'] == 3000,
+                                 deadline=cpppo.timer() + 1 )
+        assert unit.read( smc.data.Y1A_DRIVE.addr ) is not None
+        assert unit.shadow[smc.data.Y1A_DRIVE.addr] == 0
+
+        dropped			= unit.dropped
+        positioner.position( actuator=1, point=5, home=False, timeout=5 )
+        assert positioner.complete( actuator=1, timeout=5 )
+        positioner.position( actuator=1, point=5, home=False, timeout=5 )	# Again; already there, so not driven
+        assert positioner.complete( actuator=1, timeout=5 )
+        assert unit.dropped - dropped >= 8
+        assert positioner.check( predicate=lambda: positioner.status( actuator=1 )['current_position'] == 6000,
+                                 deadline=cpppo.timer() + 1 )
+
+        status			= positioner.sequence( dict( point=1 ), dict( point=4 ), .1, dict( point=4 ),
+                                               actuator=1, home=False, timeout=5 )
+        assert status['driving_data_no'] == 4 and status['X48_BUSY'] == False
+        assert positioner.check( predicate=lambda: positioner.status( actuator=1 )['current_position'] == 5000,
+                                 deadline=cpppo.timer() + 1 )
+
+        with pytest.raises( AssertionError ):
+            positioner.position( actuator=1, point=1, position=100 )
+        with pytest.raises( AssertionError ):
+            positioner.position_sync( dict( actuator=1, point=0 ), dict( actuator=3, position=100 ))
+        with pytest.raises( AssertionError ):
+            positioner.write_points( { 1: dict( speed=100 ) }, actuator=1 )	# No position
+    finally:
+        positioner.close()
+
+
+def test_smc_multi( simulated_actuator_1 ):
+    """A multi-bus gateway routes each actuator to the bus worker for its serial port."""
+    positioner			= smc.smc_multi( address="nonexistent", actuators={ "1": PORT_MASTER } )
+    try:
+        assert list( positioner.buses ) == [ PORT_MASTER ]
+        assert positioner.bus( 1 ) is positioner.bus( port=PORT_MASTER )
+        assert positioner.bus( 2 ) is not positioner.bus( 1 )
+        assert positioner.unit( 1 ) is positioner.bus( 1 ).unit( 1 )
+
+        status			= positioner.position( actuator=1, position=500, home=False, timeout=5 )
+        assert status['X48_BUSY'] is not None
+        assert positioner.complete( actuator=1, timeout=5 )
+        assert positioner.status( actuator=2 )['current_position'] is None
+    finally:
+        positioner.close()
+
+
+def test_smc_sequence( simulated_actuator_1 ):
+    """A motion sequence streams each following move on an actuator via position_next."""
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        staged			= []
+        position_next		= positioner.position_next
+        def position_next_logged( **kwds ):
+            staged.append( kwds['position'] )
+            return position_next( **kwds )
+        positioner.position_next = position_next_logged
+
+        status			= positioner.sequence(
+            dict( position=1000 ), .1, dict( position=2000, speed=400 ), dict( position=3000 ),
+            dict( actuator=3, position=4000 ), dict( actuator=3, position=5000 ),
+            actuator=1, home=False, timeout=5 )
+        assert staged == [ 2000, 3000, 5000 ]
+        assert status['X48_BUSY'] == False
+        assert status['position'] == 5000
+        assert positioner.status( actuator=1 )['position'] == 3000
+        assert positioner.status( actuator=1 )['speed'] == 400
+
+        # A dwell longer than the timeout doesn't count against the following move's start
+        status			= positioner.sequence(
+            dict( position=1000 ), 1.5, dict( position=1200 ),
+            actuator=1, home=False, timeout=1, speed=500, acceleration=5000, deceleration=5000 )
+        assert status['position'] == 1200 and status['X48_BUSY'] == False
+    finally:
+        positioner.close()
+
+
+def test_smc_recorder( simulated_actuator_1, tmp_path ):
+    """The recorder retains the latest samples of each actuator's polled motion in fixed-size rings,
+    and spills them to a memory-mapped file."""
+    from . import recorder
+
+    r				= recorder.ring( capacity=4 )
+    for i in range( 6 ):
+        r.append( dict( time=i, current_position=-i, current_speed=i, current_thrust=0, flags=0 ))
+    first,columns		= r.since( 0 )
+    assert first == 2 and list( columns['current_position'] ) == [ -2, -3, -4, -5 ]
+    first,columns		= r.since( 5 )
+    assert first == 5 and list( columns['time'] ) == [ 5.0 ]
+
+    path			= str( tmp_path / "motion.rec" )
+    recording			= recorder.recorder( path=path, capacity=1000, interval=.1 )
+    positioner			= smc.smc_modbus( PORT_MASTER, recorder=recording )
+    try:
+        positioner.position( actuator=1, position=2000, home=False, timeout=5 )
+        assert positioner.complete( actuator=1, timeout=5 )
+        time.sleep( .5 )
+        samples			= recording.samples( 1 )
+        assert len( samples['time'] ) > 2
+        assert 1 in samples['busy']
+        assert samples['current_position'][-1] == 2000 and samples['busy'][-1] == 0
+    finally:
+        positioner.close()
+        recording.close()
+
+    spilled			= recorder.load( path )[1]
+    assert len( spilled['time'] ) >= len( samples['time'] )
+    assert list( spilled['time'] ) == sorted( spilled['time'] )
+    assert recording.dropped == 0
+
+    # Concurrent spills (eg. a background spill outlasting close's join) write each sample once
+    path			= str( tmp_path / "spills.rec" )
+    recording			= recorder.recorder( path=path, capacity=1000, interval=60 )
+    spillers			= []
+    for i in range( 500 ):
+        recording.sample( 1, lambda address: 1, when=i )
+        if i % 50 == 0:
+            spillers.append( threading.Thread( target=recording.spill ))
+            spillers[-1].start()
+    spillers.append( threading.Thread( target=recording.spill ))
+    spillers[-1].start()
+    recording.close()
+    for s in spillers:
+        s.join( timeout=5 )
+    assert list( recorder.load( path )[1]['time'] ) == list( range( 500 ))
+
+    # The spill file is a fixed-size ring, retaining only the latest samples
+    assert recorder.spans( 100, 250 ) == [ ( 50, 50 ), ( 0, 50 ) ]
+    assert recorder.spans( 100, 60 ) == [ ( 0, 60 ) ] and recorder.spans( 100, 0 ) == []
+    path			= str( tmp_path / "ring.rec" )
+    recording			= recorder.recorder( path=path, capacity=1000, interval=60, file_capacity=100 )
+    size			= os.path.getsize( path )
+    assert size == recorder.FILE_HEADER.size + recorder.FILE_RECORD.size * 100
+    for i in range( 250 ):
+        recording.sample( 2, lambda address: 1, when=i )
+        if i % 30 == 0:
+            recording.spill()
+    assert len( recording.file.map ) == size
+    recording.close()
+    assert os.path.getsize( path ) == size
+    assert list( recorder.load( path )[2]['time'] ) == list( range( 150, 250 ))
+    recording			= recorder.recorder( path=path, interval=60 )	# Keeps its capacity
+    recording.sample( 2, lambda address: 1, when=250 )
+    recording.close()
+    assert os.path.getsize( path ) == size
+    assert list( recorder.load( path )[2]['time'] ) == list( range( 151, 251 ))
+
+
+def test_smc_publisher( simulated_actuator_1, tmp_path ):
+    """The publisher shares each unit's status via a shared-memory segment, read consistently by any
+    subscriber without bus traffic."""
+    from . import publisher
+
+    path			= str( tmp_path / "smc.status" )
+    publishing			= publisher.publisher( path=path )
+    positioner			= smc.smc_modbus( PORT_MASTER, publisher=publishing )
+    try:
+        subscribing		= publisher.subscriber( path=path, timeout=.1 )
+        assert subscribing.names == smc.registers.names
+        assert subscribing.status( 1 ) is None and subscribing.actuators() == []
+
+        positioner.position( actuator=1, position=1500, speed=500, acceleration=5000, deceleration=5000,
+                             timeout=5 )
+        assert positioner.complete( actuator=1, timeout=5 )
+        assert positioner.check( lambda: positioner.status( actuator=1 )['current_position'] == 1500,
+                                 deadline=cpppo.timer() + 5 )
+        deadline		= cpppo.timer() + 5
+        while cpppo.timer() < deadline:
+            status		= positioner.status( actuator=1 )
+            online,when,published = subscribing.read( 1 )
+            if published.generation == status.generation:
+                break
+            time.sleep( .05 )
+        assert online and when <= time.time()
+        assert published == status and published['current_position'] == 1500
+        assert subscribing.actuators() == [ 1 ]
+
+        # A slot being changed (odd sequence) is retried, 'til the subscriber's timeout
+        offset			= subscribing.offset + subscribing.codec.size * 1
+        sequence,		= publisher.SLOT_SEQUENCE.unpack_from( publishing.map, offset )
+        publisher.SLOT_SEQUENCE.pack_into( publishing.map, offset, sequence + 1 )
+        with pytest.raises( AssertionError ):
+            subscribing.read( 1 )
+        publisher.SLOT_SEQUENCE.pack_into( publishing.map, offset, sequence )
+        assert subscribing.status( 1 ) == published
+
+        # A slot changed while being copied is copied again
+        codec			= subscribing.codec
+        class changing( object ):
+            size		= codec.size
+            calls		= 0
+            def unpack( self, buffer ):
+                changing.calls += 1
+                if changing.calls == 1:
+                    publishing.write( 1, dict( published, current_position=1600 ), published.generation + 1 )
+                return codec.unpack( buffer )
+        subscribing.codec	= changing()
+        assert subscribing.status( 1 )['current_position'] == 1600 and changing.calls == 2
+        subscribing.codec	= codec
+
+        assert not subscribing.stale()
+        subscribing.close()
+    finally:
+        positioner.close()
+        publishing.close()
+    assert not os.path.exists( path )
+
+
+def test_smc_serve( simulated_actuator_1, tmp_path ):
+    """A served positioner keeps one gateway open, executing the commands of many concurrent clients
+    and replying to each with a line of JSON."""
+    from . import main
+
+    service			= main.positioner( smc.smc_modbus, address=PORT_MASTER )
+    path			= str( tmp_path / "smc.sock" )
+    server			= main.serve( service, path )
+    threading.Thread( target=server.serve_forever, daemon=True ).start()
+    replies			= {}
+
+    try:
+        clients			= [
+            threading.Thread( target=serve_client, args=( path, replies,
+                'move', '# Move actuator 1', '{"actuator": 1, "position": 900, "speed": 500, '
+                '"acceleration": 5000, "deceleration": 5000, "timeout": 5}', '{"actuator": 1, "timeout": 5}' )),
+            threading.Thread( target=serve_client, args=( path, replies,
+                'flags', '[3, "SVON"]', '0.1', '{"actuator": 3', '[3, "svon"]' )),
+        ]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join( timeout=15 )
+        assert [ r['command'] for r in replies['move'] ] == [
+            { "actuator": 1, "position": 900, "speed": 500, "acceleration": 5000, "deceleration": 5000,
+              "timeout": 5 }, { "actuator": 1, "timeout": 5 } ]
+        assert replies['move'][0]['status']['X48_BUSY'] is not None
+        assert replies['move'][1]['status']['X48_BUSY'] is False
+        flags			= replies['flags']
+        assert len( flags ) == 4
+        assert flags[0]['command'] == [ 3, "SVON" ] and 'status' in flags[0]
+        assert flags[1] == { "delay": .1 }
+        assert 'Invalid position data' in flags[2]['error']
+        assert flags[3]['command'] == [ 3, "svon" ] and 'status' in flags[3]
+        assert ( server.count, server.success ) == ( 4, 4 )
+        gateway			= service.gateway
+        assert gateway.check( lambda: gateway.status( actuator=3 )['Y19_SVON'] is False,
+                              deadline=cpppo.timer() + 5 )
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+    assert not os.path.exists( path )
+
+
+def test_smc_serve_failing( simulated_actuator_1, tmp_path ):
+    """A served client's failing command (eg. on an unplugged actuator) never disconnects the shared
+    gateway under other clients' commands; it is abandoned after its retries, or as soon as its
+    client disconnects."""
+    from . import main
+
+    service			= main.positioner( smc.smc_modbus, address=PORT_MASTER, recover=1 )
+    path			= str( tmp_path / "smc.sock" )
+    server			= main.serve( service, path, retries=2 )
+    threading.Thread( target=server.serve_forever, daemon=True ).start()
+    replies			= {}
+
+    try:
+        assert service.shared
+        gateway			= service.connect()
+        clients			= [
+            threading.Thread( target=serve_client, args=( path, replies,
+                'unplugged', '{"actuator": 2, "position": 500, "timeout": 1}' )),
+            threading.Thread( target=serve_client, args=( path, replies,
+                'move', '{"actuator": 1, "position": 600, "speed": 500, '
+                '"acceleration": 5000, "deceleration": 5000, "timeout": 5}', '{"actuator": 1, "timeout": 10}' )),
+        ]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join( timeout=30 )
+        assert 'Command failed; 3 attempts' in replies['unplugged'][0]['error']
+        assert [ 'status' in r for r in replies['move'] ] == [ True, True ]
+        assert replies['move'][1]['status']['X48_BUSY'] is False
+        assert service.gateway is gateway
+
+        # A client closing its connection abandons its command (never retried 'til shutdown)
+        server.retries		= None
+        conn			= socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        conn.connect( path )
+        conn.sendall( b'{"actuator": 2, "position": 500, "timeout": 1}\n' )
+        time.sleep( .5 )
+        assert service.actuators[2].locked()
+        conn.close()
+        assert service.actuators[2].acquire( timeout=15 )
+        service.actuators[2].release()
+        assert service.gateway is gateway
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_smc_bus_scheduler( simulated_actuator_1 ):
+    """The bus is granted to commands, then handshake polls, then status polls; any overdue waiter
+    goes first.  Commands aren't delayed by the polling of many other units."""
+    def contend( scheduler, *priorities ):
+        order			= []
+
+        def transaction( priority ):
+            scheduler.acquire( priority )
+            order.append( priority )
+            scheduler.release()
+
+        scheduler.acquire( 'status' )
+        threads			= []
+        for p in priorities:
+            threads.append( threading.Thread( target=transaction, args=( p, )))
+            threads[-1].start()
+            time.sleep( .01 )	# Ensure arrival order
+        scheduler.release()
+        for t in threads:
+            t.join( timeout=1 )
+        return order
+
+    scheduler			= smc.bus_scheduler()
+    assert contend( scheduler, 'status', 'handshake', 'command', 'status' ) \
+        == [ 'command', 'handshake', 'status', 'status' ]
+    assert scheduler.stats()['status']['count'] == 3 and scheduler.stats()['status']['overdue'] == 0
+
+    scheduler			= smc.bus_scheduler( deadlines=dict( status=0 ))
+    assert contend( scheduler, 'status', 'command' ) == [ 'status', 'command' ]
+    assert scheduler.stats()['status']['overdue'] == 1
+
+    # Poll units 1 and 3 as fast as possible; commands still get the bus
+    positioner			= smc.smc_modbus( PORT_MASTER, rate=0 )
+    try:
+        for u in ( 1, 3 ):
+            positioner.unit( u )
+        time.sleep( .5 )
+        for i in range( 10 ):
+            positioner.unit( 3 ).write( smc.data.Y1C_SETUP.addr, i % 2 )
+        with pytest.raises( AssertionError ):
+            with positioner.priority( 'urgent' ):
+                pass
+        stats			= positioner.scheduler.stats()
+        assert stats['command']['count'] >= 10 and stats['status']['count'] > 10
+        # Each command awaits at most the one transaction underway
+        assert stats['command']['maximum'] < positioner.timing.timeout
+    finally:
+        positioner.close()
+
+
+def test_smc_recover( simulated_actuator_1 ):
+    """Recovery restarts only the failed actuators' pollers, keeping the gateway's serial port open."""
+    positioner			= smc.smc_modbus( PORT_MASTER )
+    try:
+        unit_1,unit_3		= positioner.unit( 1 ),positioner.unit( 3 )
+        assert positioner.position( actuator=1, position=700, home=False, timeout=5 )['X48_BUSY'] is not None
+        assert positioner.recover( 1 )
+        assert not unit_1.is_alive() and positioner.unit( 1 ) is not unit_1
+        assert positioner.unit( 3 ) is unit_3 and unit_3.is_alive()
+        assert positioner.complete( actuator=1, timeout=10 )
+        assert positioner.check(
+            predicate=lambda: positioner.status( actuator=1 )['current_position'] is not None,
+            deadline=cpppo.timer() + 5 )
+    finally:
+        positioner.close()
+
+    positioner			= smc.smc_multi( address="nonexistent", actuators={ "1": PORT_MASTER } )
+    try:
+        unit_1			= positioner.unit( 1 )
+        assert positioner.recover( 1 )
+        assert positioner.unit( 1 ) is not unit_1
+    finally:
+        positioner.close()
+
+
+def test_smc_stats( simulated_actuator_1, tmp_path ):
+    """Each Modbus transaction's outcome, latency, retries and bytes are recorded, by unit and function
+    code, and may be written to a Prometheus textfile."""
+    textfile			= str( tmp_path / "smc.prom" )
+    positioner			= smc.smc_modbus( PORT_MASTER, textfile=textfile, interval=.1 )
+    try:
+        positioner.position( actuator=1, position=800, home=False, timeout=5 )
+        positioner.unit( 2 ) # Not present on the bus; all its polls fail
+        time.sleep( 1 )
+        stats			= positioner.stats()
+        read			= stats[1][3]	# Read Holding Registers
+        assert read['requests'] == read['responses'] + read['exceptions'] + read['failures']
+        assert read['responses'] > 0 and read['sent'] > 0 and read['received'] > 0
+        assert read['latency']['count'] == read['requests']
+        assert list( read['latency']['buckets'] ) == list( smc.STATS_BUCKETS )
+        assert stats[1][16]['responses'] >= 1	# Write Multiple Registers
+        absent			= stats[2][1]	# Read Coils
+        assert absent['failures'] > 0 and absent['responses'] == 0 and absent['received'] == 0
+        assert absent['timeouts'] == absent['failures'] * ( absent['retries'] // absent['failures'] + 1 )
+        time.sleep( .2 )
+        with open( textfile ) as f:
+            text		= f.read()
+        assert 'smc_modbus_requests_total{port="%s",unit="1",function="3"}' % ( PORT_MASTER ) in text
+        assert 'smc_modbus_latency_seconds_bucket{port="%s",unit="2",function="1",le="+Inf"}' % ( PORT_MASTER ) in text
+    finally:
+        positioner.close()
+
+
+def test_smc_async( simulated_actuator_1 ):
+    """The asyncio gateway positions actuators from a single event loop, without poller threads."""
+    from . import smc_async
+
+    async def positioning():
+        async with smc_async.smc_modbus_async( PORT_MASTER, batch=True, rate=.25 ) as positioner:
+            assert positioner.rates == smc.poll_rates( .25 ) and positioner.rates['svoff'] == 1
+            status		= await positioner.status( actuator=1 )
+            assert status['current_position'] is not None
+            assert await positioner.alarm( actuator=1 ) is not None
+
+            status		= await positioner.position( actuator=1, position=600, home=False, timeout=5 )
+            assert status['X48_BUSY'] is not None
+            assert await positioner.complete( actuator=1, timeout=10 )
+            assert ( await positioner.status( actuator=1 ))['current_position'] == 600
+
+            statuses		= await positioner.position_many(
+                dict( actuator=1, position=100, home=False, timeout=5 ),
+                dict( actuator=3, position=200, home=False, timeout=5 ),
+                complete=True, timeout=10 )
+            assert [ s['X48_BUSY'] for s in statuses ] == [ False, False ]
+
+            status		= await positioner.outputs( "HOLD", actuator=1 )
+            assert status['Y18_HOLD'] == 1
+            status		= await positioner.outputs( "hold", actuator=1 )
+            assert status['Y18_HOLD'] == 0
+
+    asyncio.run( positioning() )